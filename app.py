@@ -11,31 +11,80 @@
 ##########################################################
 
 
-from flask import Flask, render_template, request, jsonify, send_file, session, redirect, url_for, flash
-from pathlib import Path
+from flask import Flask, render_template, request, jsonify, send_file, session, redirect, url_for, flash, Response, g
 import os
 import json
 import hashlib
+import hmac
 import shutil
 import psutil
 from datetime import datetime, timedelta
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
+from werkzeug.http import http_date
 import re
 import mimetypes
 import flask
 import platform
 import sys
 import logging
+import threading
+import time
+import uuid
+import bisect
+import base64
+import ctypes
+import ctypes.util
+import struct
+import sqlite3
+import zipfile
+import socket
+import errno
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from hnas_workers import render_thumbnail, hash_file, partial_hash
+
+try:
+    from PIL import Image
+except ImportError:  # 未安裝 Pillow 時停用縮圖功能
+    Image = None
+try:
+    import brotli
+except ImportError:  # 未安裝 brotli 時僅使用 gzip
+    brotli = None
+import zlib
+import html
+import codecs
+from urllib.parse import quote
+import copy
+import importlib.util
+try:
+    import fcntl
+except ImportError:  # Windows 沒有 fcntl，僅使用程序內的鎖
+    fcntl = None
 
 app = Flask(__name__)
-app.secret_key = 'secret-key'
+
+def load_config_class(env):
+    """從 static/config.py 取得對應環境的設定類別（development/production/testing）"""
+    config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'config.py')
+    spec = importlib.util.spec_from_file_location('hnas_config', config_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.config.get(env, module.config['default'])
+
+# 以環境變數 HNAS_ENV 選擇設定（預設為開發環境）
+HNAS_ENV = os.environ.get('HNAS_ENV', 'default')
+app.config.from_object(load_config_class(HNAS_ENV))
 app.permanent_session_lifetime = timedelta(hours=24)  # 24小時 session
 
 # 記錄服務啟動時間
 START_TIME = datetime.now()
 
 # 配置
-UPLOAD_FOLDER = 'data'
+UPLOAD_FOLDER = app.config.get('UPLOAD_FOLDER', 'data')
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'mp4', 'mp3', 'doc', 'docx', 'zip', 'rar',
                      'bmp', 'webp', 'svg', 'avi', 'mkv', 'mov', 'wmv', 'flv', 'webm', 'wav', 'flac', 
                      'aac', 'ogg', 'wma', 'rtf', 'odt', 'xls', 'xlsx', 'ppt', 'pptx', '7z', 'tar', 
@@ -45,9 +94,136 @@ MAX_CONTENT_LENGTH = 2 * 1024 * 1024 * 1024  # 500MB
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 
+# 目錄大小索引
+SIZE_INDEX_FILE = os.path.join(UPLOAD_FOLDER, 'system', 'size_index.db')
+SIZE_RECONCILE_INTERVAL = 600  # 背景校正間隔（秒）
+
+# 串流設定
+STREAM_CHUNK_SIZE = 256 * 1024  # 每次讀取 256KB
+MAX_STREAM_RANGES = 16  # 單一請求最多處理的區段數
+
+# 目錄列表設定
+LISTING_PAGE_SIZE = 500  # 預設每頁筆數
+MAX_LISTING_PAGE_SIZE = 5000
+LISTING_SORT_FIELDS = {'name', 'size', 'modified', 'type'}
+LISTING_CACHE_SIZE = 256  # 最多快取的目錄數
+
+# 目錄變動事件（SSE）設定
+CHANGE_FEED_HISTORY = 1000  # 保留最近的事件數，供斷線重連時補送
+CHANGE_FEED_QUEUE_SIZE = 1000  # 單一連線未送出的事件上限，超過時改送 reset
+CHANGE_FEED_HEARTBEAT = 15  # 無事件時送出心跳的間隔（秒）
+CHANGE_FEED_DEDUP_WINDOW = 2  # API 已發布的變動，此時間內的 inotify 事件視為重複（秒）
+CHANGE_FEED_SETTLE = 0.3  # inotify 事件稍候合併再發布，同一項目的連續事件只發布一次（秒）
+CHANGE_FEED_RETRY_MS = 3000  # 瀏覽器斷線後重連的等待時間
+# 每條串流會一直佔用一個請求執行緒，保留其餘執行緒給下載、上傳與列表
+CHANGE_FEED_MAX_STREAMS = app.config.get('EVENT_STREAMS') or max(1, app.config.get('THREADS', 8) // 2)
+CHANGE_FEED_BUSY_RETRY = 30  # 串流已滿時請用戶端稍後重試（秒）
+
+# 檔名搜尋設定
+SEARCH_DB_FILE = os.path.join(UPLOAD_FOLDER, 'system', 'search.db')
+SEARCH_REINDEX_INTERVAL = 3600  # 背景重新整理間隔（秒）
+SEARCH_PAGE_SIZE = 100
+MAX_SEARCH_PAGE_SIZE = 1000
+
+# 全文內容搜尋設定
+CONTENT_DB_FILE = os.path.join(UPLOAD_FOLDER, 'system', 'content.db')
+CONTENT_INDEX_EXTENSIONS = {'txt', 'py', 'js', 'html', 'css', 'java', 'c', 'cpp', 'php'}
+CONTENT_INDEX_MAX_BYTES = 4 * 1024 * 1024  # 單一檔案最多索引的內容
+CONTENT_INDEX_FILES_PER_SEC = 200  # 背景索引速率上限
+CONTENT_INDEX_BYTES_PER_SEC = 16 * 1024 * 1024
+CONTENT_INDEX_RECONCILE_INTERVAL = 3600  # 與磁碟同步（納入應用程式以外的變動）的間隔（秒）
+CONTENT_SEARCH_PAGE_SIZE = 20
+MAX_CONTENT_SEARCH_PAGE_SIZE = 100
+
+# 重複檔案分析設定
+HASH_CACHE_FILE = os.path.join(UPLOAD_FOLDER, 'system', 'hashes.db')
+HASH_CACHE_RETENTION_DAYS = 30  # 超過天數未再出現的快取紀錄會被清除
+DUPLICATE_PARTIAL_BLOCK = 64 * 1024  # 初篩時讀取檔頭與檔尾各 64KB
+DUPLICATE_WORKERS = max(2, min(os.cpu_count() or 2, 8))  # 計算雜湊的程序數
+DUPLICATE_MAX_GROUPS = 1000  # 結果最多保留的重複群組數（依可節省空間排序）
+
+# 資料完整性檢查設定
+INTEGRITY_DB_FILE = os.path.join(UPLOAD_FOLDER, 'system', 'integrity.db')
+SCRUB_BYTES_PER_SEC = 32 * 1024 * 1024  # 背景重新讀取的速率上限
+SCRUB_VERIFY_INTERVAL_DAYS = 30  # 每個檔案重新驗證的週期
+SCRUB_IDLE_INTERVAL = 600  # 沒有到期檔案時的檢查間隔（秒）
+SCRUB_RECONCILE_INTERVAL = 86400  # 與磁碟同步（納入應用程式以外的新檔案）的間隔（秒）
+SCRUB_CLAIM_TIMEOUT = 3600  # 認領後超過此秒數未完成（程序中斷）即可由其他程序重新認領
+
+# 內容定址（去重複）儲存設定
+BLOB_FOLDER = os.path.join(UPLOAD_FOLDER, 'system', 'blobs')
+BLOB_GC_INTERVAL = 600  # 定期回收未被參照的內容（秒）
+
+# 背景工作設定
+JOB_DB_FILE = os.path.join(UPLOAD_FOLDER, 'system', 'jobs.db')
+JOB_WORKERS = 2  # 同時執行的工作數
+JOB_PROGRESS_INTERVAL = 0.5  # 進度寫入資料庫的最短間隔（秒）
+JOB_RETENTION_DAYS = 7  # 已結束的工作保留天數
+
+# 批次操作設定
+BATCH_MAX_OPERATIONS = 10000  # 單次請求最多的操作數
+BATCH_INLINE_LIMIT = 200  # 超過此數量改由背景工作執行
+
+# 複製設定
+COPY_INLINE_MAX = 64 * 1024 * 1024  # 此大小以下的單一檔案直接在請求中複製，其餘交給背景工作
+COPY_RANGE_CHUNK = 64 * 1024 * 1024  # copy_file_range 每次複製的量（兩次之間回報進度、檢查取消）
+FICLONE = 0x40049409  # Linux ioctl：在 btrfs、XFS 等支援 CoW 的檔案系統上建立共用資料區塊的複本
+
+# 資源回收筒設定
+TRASH_FOLDER = os.path.join(UPLOAD_FOLDER, 'system', 'trash')
+TRASH_DB_FILE = os.path.join(UPLOAD_FOLDER, 'system', 'trash.db')
+TRASH_VOLUME_FOLDER = '.hnas-trash'  # 其他磁碟區的回收區，位於該磁碟區的掛載點
+TRASH_PURGE_INTERVAL = 600  # 背景清除檢查間隔（秒）
+TRASH_RETENTION_DAYS = 30  # 預設保留天數（設定 trash_retention_days）
+TRASH_MAX_SIZE_GB = 10  # 預設容量上限（設定 trash_max_size_gb）
+TRASH_PURGE_FILES_PER_SEC = 500  # 清除速率上限，避免影響前景傳輸
+TRASH_PURGE_BYTES_PER_SEC = 256 * 1024 * 1024
+
+# ZIP 下載設定
+ZIP_ARCHIVE_LIMIT = 10000  # 單次最多選取的項目數
+
+# 縮圖設定
+THUMBNAIL_FOLDER = os.path.join(UPLOAD_FOLDER, 'system', 'thumbnails')
+THUMBNAIL_SIZES = {'small': 256, 'large': 1600}  # 最長邊像素
+THUMBNAIL_CACHE_LIMIT = 1024 * 1024 * 1024  # 快取上限 1GB
+THUMBNAIL_WORKERS = 2  # 背景產生縮圖的程序數
+THUMBNAIL_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'}
+
+# 快取策略（依內容類型）：預覽與下載一律帶驗證標頭，重複開啟只需一次 stat 與 304
+CACHE_POLICIES = {
+    'attachment': 'private, no-cache',  # 下載
+    'media': 'private, max-age=300, must-revalidate',  # 影音：拖曳時大量 Range 請求，短時間內不必重新驗證
+    'document': 'private, no-cache',  # 圖片、PDF、文字等預覽
+    'thumbnail': 'private, no-cache',
+    'thumbnail_versioned': 'private, max-age=31536000, immutable',  # 網址帶有目前的修改時間
+}
+
+# 回應壓縮設定
+COMPRESSION_MIN_SIZE = 1024  # 小於此大小不壓縮
+COMPRESSION_GZIP_LEVEL = 6
+COMPRESSION_BROTLI_QUALITY = 5  # 即時壓縮
+COMPRESSION_ASSET_QUALITY = 11  # 靜態檔與頁面只壓縮一次，使用最高壓縮率
+COMPRESSION_CACHE_LIMIT = 32 * 1024 * 1024  # 預先壓縮快取上限
+COMPRESSIBLE_TYPES = {'application/json', 'application/javascript', 'application/xml', 'image/svg+xml',
+                      'application/x-javascript', 'application/x-sh', 'application/x-yaml'}
+COMPRESSION_ASSET_TYPES = {'text/html', 'text/css', 'text/javascript', 'application/javascript', 'image/svg+xml'}
+
+# 監控指標設定
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # 秒
+METRICS_LISTING_BUCKETS = (10, 100, 1000, 10000, 100000)  # 目錄列表筆數
+METRICS_TOKEN = os.environ.get('HNAS_METRICS_TOKEN')  # 設定後可用 Bearer token 抓取 /metrics
+UPLOAD_ENDPOINTS = {'api_upload', 'api_upload_stream', 'api_upload_session_chunk'}
+DOWNLOAD_ENDPOINTS = {'api_download', 'api_download_zip', 'api_stream', 'api_thumbnail'}
+
+# 分段上傳設定
+UPLOAD_SESSION_FOLDER = os.path.join(UPLOAD_FOLDER, 'system', 'uploads')
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # 建議區塊大小 8MB
+MAX_UPLOAD_CHUNK_SIZE = 64 * 1024 * 1024  # 單一區塊上限 64MB
+UPLOAD_SESSION_TTL = 24 * 3600  # 未完成的上傳保留 24 小時
+
 # 啟用日誌
-logging.basicConfig(level=logging.DEBUG)
-app.logger.setLevel(logging.DEBUG)
+logging.basicConfig(level=app.config.get('LOG_LEVEL', 'DEBUG'))
+app.logger.setLevel(app.config.get('LOG_LEVEL', 'DEBUG'))
 
 # 確保必要的目錄存在
 def setup_folders():
@@ -76,6 +252,41 @@ if not os.path.exists(user_dir):
 # 直接執行初始化
 setup_folders()
 
+def load_secret_key():
+    """未設定 SECRET_KEY 時使用 data/system/secret_key（首次自動產生），讓所有 worker 使用同一把金鑰"""
+    key_file = os.path.join(UPLOAD_FOLDER, 'system', 'secret_key')
+    try:
+        with open(key_file, 'r', encoding='utf-8') as f:
+            key = f.read().strip()
+        if key:
+            return key
+    except FileNotFoundError:
+        pass
+    # 先寫暫存檔再以 link 建立，多個程序同時啟動時只有一個會成功
+    tmp_path = f'{key_file}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(os.urandom(32).hex())
+        f.flush()
+        os.fsync(f.fileno())
+    os.chmod(tmp_path, 0o600)
+    try:
+        os.link(tmp_path, key_file)
+    except FileExistsError:
+        pass
+    finally:
+        os.remove(tmp_path)
+    with open(key_file, 'r', encoding='utf-8') as f:
+        return f.read().strip()
+
+app.secret_key = app.config.get('SECRET_KEY') or load_secret_key()
+
+@app.after_request
+def apply_security_headers(response):
+    """套用設定中的安全標頭（ProductionConfig.SECURITY_HEADERS）"""
+    for name, value in app.config.get('SECURITY_HEADERS', {}).items():
+        response.headers.setdefault(name, value)
+    return response
+
 # 在應用啟動時
 def init_app():
     # 確保必要的目錄存在
@@ -93,66 +304,3149 @@ def ensure_folders():
        not os.path.exists(os.path.join(UPLOAD_FOLDER, 'system')):
         setup_folders()   
 
-def load_users():
-    """加載用戶數據"""
+class Metrics:
+    """程序內監控指標（計數器、量表、直方圖），以 Prometheus 文字格式輸出；每次記錄只做一次加鎖的整數累加"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}  # 名稱 -> (類型, 說明, 直方圖分界)
+        self._values = {}  # (名稱, 標籤) -> 數值
+        self._histograms = {}  # (名稱, 標籤) -> [各區間計數..., 總和]
+        self._collectors = []
+
+    def describe(self, name, kind, help_text, buckets=None):
+        self._meta[name] = (kind, help_text, buckets)
+
+    def inc(self, name, labels=(), value=1):
+        """計數器或量表累加（labels 為 (鍵, 值) 組成的 tuple）"""
+        key = (name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        """直方圖記錄一個觀測值"""
+        buckets = self._meta[name][2]
+        index = bisect.bisect_left(buckets, value)
+        key = (name, labels)
+        with self._lock:
+            counts = self._histograms.get(key)
+            if counts is None:
+                counts = self._histograms[key] = [0] * (len(buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def add_collector(self, func):
+        """註冊抓取時才計算的指標：func() 回傳 [(名稱, 標籤, 數值), ...]"""
+        self._collectors.append(func)
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = tuple(labels) + tuple(extra)
+        if not pairs:
+            return ''
+        escaped = (k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+                   for k, v in pairs)
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self):
+        """輸出 Prometheus 文字格式"""
+        with self._lock:
+            values = dict(self._values)
+            histograms = {key: list(counts) for key, counts in self._histograms.items()}
+        for collector in self._collectors:
+            try:
+                for name, labels, value in collector():
+                    values[(name, labels)] = value
+            except Exception as e:
+                app.logger.warning(f'監控指標收集失敗: {str(e)}')
+        
+        by_name = {}
+        for (name, labels), value in values.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for (name, labels), counts in histograms.items():
+            by_name.setdefault(name, []).append((labels, counts))
+        
+        lines = []
+        for name in sorted(by_name):
+            kind, help_text, buckets = self._meta.get(name, ('untyped', '', None))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+                if kind != 'histogram':
+                    lines.append(f'{name}{self._format_labels(labels)} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets, value):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{self._format_labels(labels, [("le", bound)])} {cumulative}')
+                cumulative += value[len(buckets)]
+                lines.append(f'{name}_bucket{self._format_labels(labels, [("le", "+Inf")])} {cumulative}')
+                lines.append(f'{name}_sum{self._format_labels(labels)} {value[-1]}')
+                lines.append(f'{name}_count{self._format_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.describe('hnas_http_requests_total', 'counter', '請求數（依端點、方法與狀態碼分類）')
+metrics.describe('hnas_http_request_duration_seconds', 'histogram', '請求處理時間（至回應開始傳送）',
+                 METRICS_LATENCY_BUCKETS)
+metrics.describe('hnas_upload_bytes_total', 'counter', '上傳的位元組數')
+metrics.describe('hnas_download_bytes_total', 'counter', '下載的位元組數')
+metrics.describe('hnas_transfers_in_flight', 'gauge', '進行中的上傳／下載')
+metrics.describe('hnas_download_offloaded_total', 'counter', '交由反向代理傳送的下載數')
+metrics.describe('hnas_listing_entries', 'histogram', '目錄列表的項目數', METRICS_LISTING_BUCKETS)
+
+class TransferIterator:
+    """包裝上傳／下載的回應內容：累計送出的位元組，回應結束（close）時才寫入指標並減少進行中數量"""
+
+    def __init__(self, app_iter, transfer, labels, count_bytes):
+        self.app_iter = app_iter
+        self.transfer = transfer
+        self.labels = labels
+        self.count_bytes = count_bytes
+        self.sent = 0
+        self._closed = False
+
+    def __iter__(self):
+        if not self.count_bytes:
+            yield from self.app_iter
+            return
+        for chunk in self.app_iter:
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            if self.sent:
+                metrics.inc('hnas_download_bytes_total', self.labels, self.sent)
+            metrics.inc('hnas_transfers_in_flight', self.transfer, -1)
+
+class TrackedFile:
+    """wsgi.file_wrapper 內檔案的代理：保留 fileno 讓伺服器能以 sendfile 傳送，關閉時結算指標"""
+
+    def __init__(self, filelike, on_close):
+        self._filelike = filelike
+        self._on_close = on_close
+
+    def __getattr__(self, name):
+        return getattr(self._filelike, name)
+
+    def close(self):
+        try:
+            self._filelike.close()
+        finally:
+            on_close, self._on_close = self._on_close, None
+            if on_close:
+                on_close()
+
+class MetricsMiddleware:
+    """WSGI 中介層：傳輸類請求的回應由 TransferIterator 包裝，確保傳送完畢才結算"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        app_iter = self.wsgi_app(environ, start_response)
+        tracked = environ.get('hnas.metrics_transfer')
+        if tracked is None:
+            return app_iter
+        transfer, labels, count_bytes, length = tracked
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None and isinstance(app_iter, file_wrapper) and hasattr(app_iter, 'filelike'):
+            # 檔案回應需維持 file_wrapper 型別伺服器才會使用 sendfile，改以 Content-Length 結算
+            def on_close():
+                if length:
+                    metrics.inc('hnas_download_bytes_total', labels, length)
+                metrics.inc('hnas_transfers_in_flight', transfer, -1)
+            return file_wrapper(TrackedFile(app_iter.filelike, on_close), getattr(app_iter, 'blksize', 8192))
+        return TransferIterator(app_iter, transfer, labels, count_bytes)
+
+app.wsgi_app = MetricsMiddleware(app.wsgi_app)
+
+@app.before_request
+def metrics_start_request():
+    g.metrics_start = time.perf_counter()
+    if request.endpoint in UPLOAD_ENDPOINTS or request.endpoint in DOWNLOAD_ENDPOINTS:
+        direction = 'upload' if request.endpoint in UPLOAD_ENDPOINTS else 'download'
+        g.metrics_transfer = (('direction', direction),)
+        metrics.inc('hnas_transfers_in_flight', g.metrics_transfer)
+
+@app.after_request
+def metrics_finish_request(response):
+    """記錄請求數、延遲與上傳量；下載量於回應送完後由 TransferIterator 記錄"""
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return response
+    endpoint = request.endpoint or 'unmatched'
+    metrics.inc('hnas_http_requests_total',
+                (('endpoint', endpoint), ('method', request.method), ('status', response.status_code)))
+    metrics.observe('hnas_http_request_duration_seconds', (('endpoint', endpoint),), time.perf_counter() - start)
+    
+    transfer = g.pop('metrics_transfer', None)
+    if transfer is not None:
+        labels = (('endpoint', endpoint),)
+        is_upload = endpoint in UPLOAD_ENDPOINTS
+        if is_upload:
+            metrics.inc('hnas_upload_bytes_total', labels, request.content_length or 0)
+        length = response.content_length if request.method != 'HEAD' else None
+        request.environ['hnas.metrics_transfer'] = (transfer, labels, not is_upload, length)
+    return response
+
+def is_compressible(mimetype):
+    """文字類內容才壓縮；zip、影音、圖片等已壓縮格式略過"""
+    return bool(mimetype) and (mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES)
+
+def compress_bytes(data, encoding, quality=None):
+    if encoding == 'br':
+        return brotli.compress(data, quality=quality or COMPRESSION_BROTLI_QUALITY)
+    compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL if quality is None else 9, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+def iter_compressed(iterable, encoding):
+    """邊讀邊壓縮串流內容"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+        compress, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+        compress, finish = compressor.compress, compressor.flush
     try:
-        with open('data/system/users.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        # 創建默認管理員用戶
-        default_users = {
-            "admin": {
-                "password": hashlib.md5("admin123".encode()).hexdigest(),
-                "role": "admin",
-                "created_at": datetime.now().isoformat()
-            }
+        for chunk in iterable:
+            data = compress(chunk)
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+class CompressionCache:
+    """預先壓縮快取：靜態檔（以路徑與 mtime 為鍵）與頁面（以內容雜湊為鍵）只壓縮一次，LRU 淘汰"""
+
+    def __init__(self, max_bytes=COMPRESSION_CACHE_LIMIT):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, produce):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+            self.misses += 1
+        data = produce()
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = data
+                self._size += len(data)
+                while self._size > self.max_bytes and self._entries:
+                    self._size -= len(self._entries.popitem(last=False)[1])
+        return data
+
+compression_cache = CompressionCache()
+
+# 回應內容編碼時 ETag 會加上此尾碼，以區分不同編碼的表示
+ETAG_ENCODING_SUFFIXES = ('-br', '-gzip')
+
+@app.before_request
+def strip_encoded_etags():
+    """將 If-None-Match 內壓縮版本的 ETag 還原，讓各 API 以原本的 ETag 比對"""
+    header = request.environ.get('HTTP_IF_NONE_MATCH')
+    if header and any(suffix + '"' in header for suffix in ETAG_ENCODING_SUFFIXES):
+        for suffix in ETAG_ENCODING_SUFFIXES:
+            if suffix + '"' in header:
+                g.etag_encoding = suffix[1:]  # 304 回應需帶回相同編碼的 ETag
+                header = header.replace(suffix + '"', '"')
+        request.environ['HTTP_IF_NONE_MATCH'] = header
+
+def negotiate_encoding():
+    """依 Accept-Encoding 選擇 br 或 gzip"""
+    return request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+
+def encode_etag(response, encoding):
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(f'{etag}-{encoding}', weak)
+
+@app.after_request
+def compress_response(response):
+    """依 Accept-Encoding 壓縮文字回應：一般回應整體壓縮，串流回應邊傳邊壓縮，靜態檔與頁面使用預先壓縮快取"""
+    if request.method == 'HEAD' or 'Content-Encoding' in response.headers \
+            or 'no-transform' in response.headers.get('Cache-Control', ''):
+        return response
+    if response.status_code == 304:
+        encoding = g.pop('etag_encoding', None)
+        if encoding:
+            response.vary.add('Accept-Encoding')
+            encode_etag(response, encoding)
+        return response
+    if response.status_code != 200 or not is_compressible(response.mimetype):
+        return response
+    if 'X-Accel-Redirect' in response.headers or 'X-Sendfile' in response.headers:
+        return response  # 內容由反向代理傳送
+    if response.headers.get('Accept-Ranges') == 'bytes' and request.endpoint not in ('static', 'api_stream'):
+        # 下載（attachment）保留 sendfile 與 Range，大型文字檔、日誌才能續傳；
+        # 靜態檔走預先壓縮快取，inline 預覽（api_stream）由檢視器一次載入整個文字檔
+        return response
+    
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding()
+    length = response.content_length
+    if not encoding or (length is not None and length < COMPRESSION_MIN_SIZE):
+        return response
+    
+    if request.endpoint == 'static':
+        # 靜態檔：以檔案路徑與修改時間為鍵，只壓縮一次
+        file_path = os.path.join(app.static_folder, request.view_args['filename'])
+        st = os.stat(file_path)
+        key = ('static', file_path, st.st_mtime_ns, st.st_size, encoding)
+        
+        def produce():
+            with open(file_path, 'rb') as f:
+                return compress_bytes(f.read(), encoding, COMPRESSION_ASSET_QUALITY)
+        response.response.close()
+        response.direct_passthrough = False
+        response.set_data(compression_cache.get(key, produce))
+    elif response.is_streamed:
+        # 串流（例如文字檔預覽）：邊讀邊壓縮，長度未知
+        response.response = iter_compressed(response.response, encoding)
+        response.direct_passthrough = False
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if response.mimetype in COMPRESSION_ASSET_TYPES:
+            # 頁面內容大多相同：以內容雜湊快取壓縮結果
+            key = ('body', hashlib.sha1(data).digest(), encoding)
+            compressed = compression_cache.get(key, lambda: compress_bytes(data, encoding, COMPRESSION_ASSET_QUALITY))
+        else:
+            compressed = compress_bytes(data, encoding)
+        response.set_data(compressed)
+    
+    # 編碼後的內容不能再依原始檔案的位移續傳
+    response.headers.pop('Accept-Ranges', None)
+    response.headers['Content-Encoding'] = encoding
+    encode_etag(response, encoding)
+    return response
+
+class JsonStore:
+    """JSON 設定檔存取：解析結果快取在記憶體（以 mtime 驗證），寫入時先寫暫存檔再 rename，並以檔案鎖讓多個程序安全共用"""
+
+    def __init__(self, path, default_factory):
+        self.path = path
+        self.lock_path = os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.lock')
+        self.default_factory = default_factory
+        self._lock = threading.RLock()
+        self._data = None
+        self._signature = None
+
+    def _stat_signature(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _file_lock(self):
+        """跨程序的排他鎖（fcntl.flock），沒有 fcntl 時回傳 None"""
+        if fcntl is None:
+            return None
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    @staticmethod
+    def _file_unlock(fd):
+        if fd is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _read(self):
+        """讀取目前內容（快取仍有效時不重新解析）；呼叫端需持有 self._lock"""
+        signature = self._stat_signature()
+        if signature is not None and signature == self._signature:
+            return self._data
+        if signature is None:
+            return None
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        self._data, self._signature = data, signature
+        return data
+
+    def _write(self, data):
+        """寫入暫存檔、fsync 後 rename 取代原檔；呼叫端需持有鎖"""
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = os.path.join(directory, f'.{os.path.basename(self.path)}.{uuid.uuid4().hex}.tmp')
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=2, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if hasattr(os, 'O_DIRECTORY'):
+            dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        self._data, self._signature = copy.deepcopy(data), self._stat_signature()
+
+    def load(self):
+        """取得內容（回傳副本，可直接修改後 save）；檔案不存在時建立預設值"""
+        with self._lock:
+            data = self._read()
+            if data is None:
+                fd = self._file_lock()
+                try:
+                    data = self._read()
+                    if data is None:
+                        data = self.default_factory()
+                        self._write(data)
+                finally:
+                    self._file_unlock(fd)
+            return copy.deepcopy(data)
+
+    def save(self, data):
+        """整份覆寫"""
+        with self._lock:
+            fd = self._file_lock()
+            try:
+                self._write(data)
+            finally:
+                self._file_unlock(fd)
+
+    def update(self, func):
+        """在鎖內讀取、修改並寫回（func 直接修改傳入的資料，回傳 False 時不寫回），回傳 func 的結果"""
+        with self._lock:
+            fd = self._file_lock()
+            try:
+                data = self._read()
+                data = copy.deepcopy(data) if data is not None else self.default_factory()
+                result = func(data)
+                if result is not False:
+                    self._write(data)
+                return result
+            finally:
+                self._file_unlock(fd)
+
+def default_users():
+    """預設管理員用戶"""
+    return {
+        "admin": {
+            "password": hashlib.md5("admin123".encode()).hexdigest(),
+            "role": "admin",
+            "created_at": datetime.now().isoformat()
         }
-        save_users(default_users)
-        return default_users
+    }
+
+def default_settings():
+    """預設系統設定"""
+    return {
+        "system_name": "HNAS",
+        "language": "zh-TW",
+        "dark_mode": False,
+        "max_file_size": 500,
+        "auto_cleanup": True,
+        "trash_retention_days": 30,
+        "trash_max_size_gb": 10,
+        "dedup_storage": False,
+        "last_updated": datetime.now().isoformat()
+    }
+
+users_store = JsonStore(os.path.join(UPLOAD_FOLDER, 'system', 'users.json'), default_users)
+settings_store = JsonStore(os.path.join(UPLOAD_FOLDER, 'system', 'settings.json'), default_settings)
+
+def load_users():
+    """加載用戶數據"""
+    return users_store.load()
 
 def save_users(users):
     """保存用戶數據"""
-    with open('data/system/users.json', 'w', encoding='utf-8') as f:
-        json.dump(users, f, indent=2, ensure_ascii=False)
+    users_store.save(users)
 
 def load_settings():
     """載入系統設定"""
-    try:
-        with open('data/system/settings.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        # 創建預設設定
-        default_settings = {
-            "system_name": "HNAS",
-            "language": "zh-TW",
-            "dark_mode": False,
-            "max_file_size": 500,
-            "auto_cleanup": True,
-            "last_updated": datetime.now().isoformat()
-        }
-        save_settings(default_settings)
-        return default_settings
+    return settings_store.load()
 
 def save_settings(settings):
     """儲存系統設定"""
     settings["last_updated"] = datetime.now().isoformat()
-    with open('data/system/settings.json', 'w', encoding='utf-8') as f:
-        json.dump(settings, f, indent=2, ensure_ascii=False)
+    settings_store.save(settings)
+
+def normalize_rel_path(path):
+    """將相對路徑正規化為 'a/b' 格式（根目錄為空字串）"""
+    path = os.path.normpath((path or '').replace('\\', '/')).replace('\\', '/')
+    return '' if path == '.' else path.strip('/')
+
+def scan_directory_sizes(root):
+    """走訪目錄樹，回傳 {相對路徑: 遞迴總大小}；略過隱藏項目（上傳暫存、複製與刪除中的暫存、回收區）"""
+    sizes = {}
+
+    def walk(abs_dir, rel_dir):
+        total = 0
+        try:
+            with os.scandir(abs_dir) as it:
+                entries = list(it)
+        except OSError:
+            sizes[rel_dir] = 0
+            return 0
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    child = f'{rel_dir}/{entry.name}' if rel_dir else entry.name
+                    total += walk(entry.path, child)
+                elif entry.is_file(follow_symlinks=False):
+                    total += entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                pass
+        sizes[rel_dir] = total
+        return total
+
+    walk(root, '')
+    return sizes
+
+class DirSizeIndex:
+    """目錄大小索引（SQLite，各程序共用）：記錄每個目錄（含子目錄）的總大小，API 異動時增量更新，
+    背景定期校正；每筆的 version 在大小變動時遞增，供列表快取判斷是否過期"""
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS dirs (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    '''
+
+    def __init__(self, root, db_file):
+        self.root = root
+        self.db_file = db_file
+        self._local = threading.local()
+        self._thread = None
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _ancestors(rel_dir):
+        """由自身往上列出所有祖先目錄（含根目錄 ''）"""
+        rel_dir = normalize_rel_path(rel_dir)
+        while rel_dir:
+            yield rel_dir
+            rel_dir = rel_dir.rpartition('/')[0]
+        yield ''
+
+    @staticmethod
+    def _ready(conn):
+        """索引是否已建立（尚未建立時的增量更新略過，建立時會直接反映磁碟現況）"""
+        return conn.execute("SELECT 1 FROM dirs WHERE path = ''").fetchone() is not None
+
+    @staticmethod
+    def _add_to_ancestors(conn, rel_dir, delta):
+        paths = list(DirSizeIndex._ancestors(rel_dir))
+        conn.executemany('INSERT OR IGNORE INTO dirs (path, size) VALUES (?, 0)', [(p,) for p in paths])
+        conn.execute(f"UPDATE dirs SET size = MAX(size + ?, 0), version = version + 1 "
+                     f"WHERE path IN ({', '.join('?' * len(paths))})", (delta, *paths))
+
+    def total(self, rel_dir=''):
+        """取得目錄總大小（O(1)；索引尚未建立時為 0，不在請求中走訪目錄樹）"""
+        row = self._connect().execute('SELECT size FROM dirs WHERE path = ?',
+                                      (normalize_rel_path(rel_dir),)).fetchone()
+        return row['size'] if row else 0
+
+    def version(self, rel_dir):
+        """目錄大小（含子目錄）的版本，任何子孫變動都會改變"""
+        row = self._connect().execute('SELECT version FROM dirs WHERE path = ?',
+                                      (normalize_rel_path(rel_dir),)).fetchone()
+        return row['version'] if row else -1
+
+    def add_bytes(self, rel_dir, delta):
+        """目錄內檔案大小變動 delta 位元組"""
+        with self._connect() as conn:
+            if self._ready(conn):
+                self._add_to_ancestors(conn, rel_dir, delta)
+
+    def add_dir(self, rel_dir):
+        """登記新建立的目錄"""
+        with self._connect() as conn:
+            if self._ready(conn):
+                conn.executemany('INSERT OR IGNORE INTO dirs (path, size) VALUES (?, 0)',
+                                 [(p,) for p in self._ancestors(rel_dir)])
+
+    @staticmethod
+    def _pop_tree(conn, key):
+        """刪除子樹並回傳子樹根的大小"""
+        row = conn.execute('SELECT size FROM dirs WHERE path = ?', (key,)).fetchone()
+        conn.execute('DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)', (key, *subtree_bounds(key)))
+        return row['size'] if row else 0
+
+    def add_tree(self, rel_dir):
+        """新增整個目錄子樹（複製、還原等操作後呼叫）"""
+        key = normalize_rel_path(rel_dir)
+        if not key:
+            return
+        sizes = scan_directory_sizes(os.path.join(self.root, key))
+        with self._connect() as conn:
+            if not self._ready(conn):
+                return
+            delta = sizes.get('', 0) - self._pop_tree(conn, key)
+            conn.executemany('INSERT INTO dirs (path, size) VALUES (?, ?)',
+                             [(f'{key}/{k}' if k else key, v) for k, v in sizes.items()])
+            self._add_to_ancestors(conn, key.rpartition('/')[0], delta)
+
+    def remove_tree(self, rel_dir):
+        """移除整個目錄子樹"""
+        key = normalize_rel_path(rel_dir)
+        if not key:
+            return
+        with self._connect() as conn:
+            if self._ready(conn):
+                self._add_to_ancestors(conn, key.rpartition('/')[0], -self._pop_tree(conn, key))
+
+    def move_tree(self, old_dir, new_dir):
+        """目錄搬移或重新命名"""
+        old_key = normalize_rel_path(old_dir)
+        new_key = normalize_rel_path(new_dir)
+        if not old_key or not new_key or old_key == new_key:
+            return
+        with self._connect() as conn:
+            if not self._ready(conn):
+                return
+            row = conn.execute('SELECT size FROM dirs WHERE path = ?', (old_key,)).fetchone()
+            size = row['size'] if row else 0
+            self._add_to_ancestors(conn, old_key.rpartition('/')[0], -size)
+            self._pop_tree(conn, new_key)
+            conn.execute('UPDATE dirs SET path = ? || substr(path, ?), version = version + 1 '
+                         'WHERE path = ? OR (path >= ? AND path < ?)',
+                         (new_key, len(old_key) + 1, old_key, *subtree_bounds(old_key)))
+            self._add_to_ancestors(conn, new_key.rpartition('/')[0], size)
+
+    def rebuild(self):
+        """完整走訪目錄樹校正索引（走訪時不持有交易，結束後只寫入有差異的目錄）"""
+        sizes = scan_directory_sizes(self.root)
+        with self._connect() as conn:
+            indexed = {row['path']: row['size'] for row in conn.execute('SELECT path, size FROM dirs')}
+            changed = [(path, size) for path, size in sizes.items() if indexed.pop(path, None) != size]
+            conn.executemany('INSERT INTO dirs (path, size) VALUES (?, ?) ON CONFLICT (path) '
+                             'DO UPDATE SET size = excluded.size, version = version + 1', changed)
+            conn.executemany('DELETE FROM dirs WHERE path = ?', [(path,) for path in indexed])
+        app.logger.debug(f'目錄大小索引已校正: {len(sizes)} 個目錄，{len(changed)} 個有變動')
+
+    def _claim_rebuild(self, interval):
+        """到了校正時間時認領這一輪（多個程序只有一個會走訪）"""
+        conn = self._connect()
+        now = datetime.now()
+        with conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'rebuilt_at'").fetchone()
+            if row is None:
+                return conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('rebuilt_at', ?)",
+                                    (now.isoformat(),)).rowcount == 1
+            if (now - datetime.fromisoformat(row['value'])).total_seconds() < interval:
+                return False
+            return conn.execute("UPDATE meta SET value = ? WHERE key = 'rebuilt_at' AND value = ?",
+                                (now.isoformat(), row['value'])).rowcount == 1
+
+    def _run(self, interval):
+        while True:
+            try:
+                if self._claim_rebuild(interval):
+                    self.rebuild()
+            except Exception as e:
+                app.logger.error(f'目錄大小索引校正失敗: {str(e)}', exc_info=True)
+            time.sleep(min(interval, 60))
+
+    def start(self, interval=SIZE_RECONCILE_INTERVAL):
+        """啟動背景校正執行緒，用來同步應用程式以外的變動"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(interval,), name='size-index', daemon=True)
+            self._thread.start()
+
+size_index = DirSizeIndex(os.path.join(UPLOAD_FOLDER, 'user'), SIZE_INDEX_FILE)
+
+class InotifyWatcher:
+    """以 inotify 監看目錄變動（僅 Linux，無法使用時自動停用）"""
+
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+                  IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        self._refs = {}
+        self._dir_to_wd = {}
+        self._wd_to_dir = {}
+        self._listeners = []
+        self._thread = None
+        self._fd = None
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = self._libc.inotify_init1(os.O_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), 'inotify_init1 失敗')
+            self._fd = fd
+        except (OSError, AttributeError) as e:
+            app.logger.info(f'inotify 無法使用，僅以 mtime 驗證快取: {str(e)}')
+
+    @property
+    def available(self):
+        return self._fd is not None
+
+    def add_listener(self, callback):
+        """註冊事件回呼 callback(目錄, 名稱, mask)；佇列溢位時目錄與名稱為 None"""
+        self._listeners.append(callback)
+
+    def watch(self, rel_dir):
+        """開始監看目錄（參考計數）"""
+        if not self.available:
+            return
+        rel_dir = normalize_rel_path(rel_dir)
+        with self._lock:
+            self._refs[rel_dir] = self._refs.get(rel_dir, 0) + 1
+            if rel_dir in self._dir_to_wd:
+                return
+            path = os.path.join(self.root, rel_dir)
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self.WATCH_MASK)
+            if wd < 0:
+                return
+            self._dir_to_wd[rel_dir] = wd
+            self._wd_to_dir[wd] = rel_dir
+        self.start()
+
+    def unwatch(self, rel_dir):
+        """停止監看目錄（參考計數歸零時才移除）"""
+        if not self.available:
+            return
+        rel_dir = normalize_rel_path(rel_dir)
+        with self._lock:
+            refs = self._refs.get(rel_dir, 0) - 1
+            if refs > 0:
+                self._refs[rel_dir] = refs
+                return
+            self._refs.pop(rel_dir, None)
+            wd = self._dir_to_wd.pop(rel_dir, None)
+            if wd is not None:
+                self._wd_to_dir.pop(wd, None)
+                self._libc.inotify_rm_watch(self._fd, wd)
+
+    def _dispatch(self, rel_dir, name, mask):
+        for callback in self._listeners:
+            try:
+                callback(rel_dir, name, mask)
+            except Exception as e:
+                app.logger.error(f'inotify 事件處理失敗: {str(e)}', exc_info=True)
+
+    def _run(self):
+        header_size = self.EVENT_HEADER.size
+        while True:
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except OSError as e:
+                app.logger.error(f'inotify 讀取失敗: {str(e)}')
+                time.sleep(1)
+                continue
+            offset = 0
+            while offset + header_size <= len(buf):
+                wd, mask, _cookie, length = self.EVENT_HEADER.unpack_from(buf, offset)
+                name = os.fsdecode(buf[offset + header_size:offset + header_size + length].rstrip(b'\0'))
+                offset += header_size + length
+                if mask & self.IN_Q_OVERFLOW:
+                    self._dispatch(None, None, mask)
+                    continue
+                with self._lock:
+                    rel_dir = self._wd_to_dir.get(wd)
+                    if mask & self.IN_IGNORED and rel_dir is not None:
+                        self._wd_to_dir.pop(wd, None)
+                        self._dir_to_wd.pop(rel_dir, None)
+                if rel_dir is not None:
+                    self._dispatch(rel_dir, name, mask)
+
+    def start(self):
+        if self.available and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='inotify', daemon=True)
+            self._thread.start()
+
+dir_watcher = InotifyWatcher(os.path.join(UPLOAD_FOLDER, 'user'))
+
+class ListingCache:
+    """目錄列表快取：以目錄為鍵、LRU 淘汰；以目錄 mtime 驗證，API 異動與 inotify 事件會使其失效"""
+
+    def __init__(self, max_entries=LISTING_CACHE_SIZE, watcher=None):
+        self.max_entries = max_entries
+        self.watcher = watcher
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # 目錄 -> ((mtime_ns, 大小索引版本), 列表, etag)
+        self.hits = 0
+        self.misses = 0
 
-def get_directory_size(path):
-    """計算目錄總大小"""
-    total = 0
+    def get(self, rel_dir, full_path):
+        """取得目錄列表與版本標記 (entries, etag)；除了目錄 mtime，也比對目錄大小索引的版本，
+        其他程序的異動使子資料夾大小改變時同樣會重新列出"""
+        stamp = (os.stat(full_path).st_mtime_ns, size_index.version(rel_dir))
+        with self._lock:
+            cached = self._entries.get(rel_dir)
+            if cached and cached[0] == stamp:
+                self._entries.move_to_end(rel_dir)
+                self.hits += 1
+                return cached[1], cached[2]
+            self.misses += 1
+        
+        entries = list_directory(rel_dir, full_path)
+        etag = hashlib.sha1(repr(entries).encode('utf-8', 'surrogateescape')).hexdigest()
+        evicted = []
+        with self._lock:
+            is_new = rel_dir not in self._entries
+            self._entries[rel_dir] = (stamp, entries, etag)
+            self._entries.move_to_end(rel_dir)
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[0])
+        if self.watcher:
+            if is_new:
+                self.watcher.watch(rel_dir)
+            for key in evicted:
+                self.watcher.unwatch(key)
+        return entries, etag
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _drop(self, keys):
+        with self._lock:
+            dropped = [key for key in keys if self._entries.pop(key, None) is not None]
+        if self.watcher:
+            for key in dropped:
+                self.watcher.unwatch(key)
+
+    def invalidate(self, rel_dir):
+        """目錄內容變動：清除該目錄與所有上層（上層的資料夾大小也會改變）"""
+        self._drop(list(DirSizeIndex._ancestors(rel_dir)))
+
+    def invalidate_tree(self, rel_dir):
+        """目錄被刪除或搬移：清除整個子樹"""
+        key = normalize_rel_path(rel_dir)
+        prefix = key + '/'
+        with self._lock:
+            keys = [k for k in self._entries if k == key or k.startswith(prefix)]
+        self._drop(keys)
+
+    def clear(self):
+        with self._lock:
+            keys = list(self._entries)
+        self._drop(keys)
+
+    def _on_fs_event(self, rel_dir, name, mask):
+        if rel_dir is None:
+            self.clear()
+        else:
+            self._drop([rel_dir])
+
+listing_cache = ListingCache(watcher=dir_watcher)
+dir_watcher.add_listener(listing_cache._on_fs_event)
+
+def invalidate_listing(rel_dir):
+    """目錄內容被 API 變動後呼叫（批次操作期間延到結束時才處理）"""
+    pending = getattr(_batch_state, 'dirs', None)
+    if pending is not None:
+        pending.add(normalize_rel_path(rel_dir))
+        return
+    listing_cache.invalidate(rel_dir)
+
+class ChangeSubscription:
+    """單一 SSE 連線的事件佇列"""
+
+    def __init__(self, dirs):
+        self.dirs = dirs
+        self._cond = threading.Condition()
+        self._events = deque()
+        self._overflowed = False
+
+    def push(self, item):
+        with self._cond:
+            if len(self._events) >= CHANGE_FEED_QUEUE_SIZE:
+                # 用戶端跟不上：丟棄累積的事件，改請用戶端重新載入
+                self._events.clear()
+                self._overflowed = True
+            else:
+                self._events.append(item)
+            self._cond.notify()
+
+    def wait(self, timeout):
+        """等待事件，回傳 (事件列表, 是否溢位)"""
+        with self._cond:
+            if not self._events and not self._overflowed:
+                self._cond.wait(timeout)
+            events = list(self._events)
+            self._events.clear()
+            overflowed, self._overflowed = self._overflowed, False
+        return events, overflowed
+
+class ChangeFeed:
+    """目錄變動事件：API 異動與 inotify 事件依目錄發布給 SSE 訂閱者，並保留最近的事件供斷線重連時補送"""
+
+    def __init__(self, watcher, history=CHANGE_FEED_HISTORY):
+        self.watcher = watcher
+        self.instance = uuid.uuid4().hex[:8]  # 事件 ID 前綴：重連到其他程序時無法補送，改請用戶端重新載入
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._history = deque(maxlen=history)  # (序號, 目錄, 事件 ID, 事件)
+        self._subscribers = {}  # 目錄 -> set(ChangeSubscription)
+        self._recent = {}  # (目錄, 名稱) -> API 發布時間
+        self._pending = {}  # (目錄, 名稱) -> 是否為新增；等待合併的 inotify 事件
+        self._pending_event = threading.Event()
+        self._thread = None
+
+    def subscribe(self, dirs, last_event_id=None):
+        """訂閱目錄，回傳 (訂閱, 需補送的事件, 是否完整)；無法補送時「是否完整」為 False"""
+        sub = ChangeSubscription(dirs)
+        backlog, complete = [], True
+        with self._lock:
+            for rel_dir in dirs:
+                self._subscribers.setdefault(rel_dir, set()).add(sub)
+            if last_event_id:
+                instance, _, seq = last_event_id.partition('-')
+                oldest = self._history[0][0] if self._history else self._seq + 1
+                if instance != self.instance or not seq.isdigit() or int(seq) < oldest - 1:
+                    complete = False
+                else:
+                    backlog = [(event_id, event) for n, rel_dir, event_id, event in self._history
+                               if n > int(seq) and rel_dir in dirs]
+        for rel_dir in dirs:
+            self.watcher.watch(rel_dir)
+        return sub, backlog, complete
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            dirs = [rel_dir for rel_dir in sub.dirs if sub in self._subscribers.get(rel_dir, ())]
+            for rel_dir in dirs:
+                subs = self._subscribers[rel_dir]
+                subs.discard(sub)
+                if not subs:
+                    del self._subscribers[rel_dir]
+        for rel_dir in dirs:
+            self.watcher.unwatch(rel_dir)
+
+    def publish(self, rel_dir, event, from_watcher=False):
+        event['dir'] = rel_dir
+        keys = {(rel_dir, event.get(field)) for field in ('name', 'old_name') if event.get(field)}
+        with self._lock:
+            if from_watcher:
+                now = time.monotonic()
+                if any(now - self._recent.get(key, 0) < CHANGE_FEED_DEDUP_WINDOW for key in keys):
+                    return
+            else:
+                self._mark_recent(keys)
+            self._seq += 1
+            event_id = f'{self.instance}-{self._seq}'
+            self._history.append((self._seq, rel_dir, event_id, event))
+            subs = list(self._subscribers.get(rel_dir, ()))
+        for sub in subs:
+            sub.push((event_id, event))
+
+    def _mark_recent(self, keys):
+        """記錄 API 已發布（或將於批次結束時發布）的項目，略過隨後的 inotify 事件（需持有鎖）"""
+        now = time.monotonic()
+        for key in keys:
+            self._recent[key] = now
+            self._pending.pop(key, None)
+        if len(self._recent) > 1024:
+            self._recent = {k: t for k, t in self._recent.items() if now - t < CHANGE_FEED_DEDUP_WINDOW}
+
+    def notify(self, kind, rel_path, old_path=None, from_watcher=False):
+        """發布單一項目的變動：kind 為 created / changed / deleted / renamed"""
+        pending = getattr(_batch_state, 'events', None)
+        if pending is not None and not from_watcher:
+            pending.append((kind, rel_path, old_path))
+            with self._lock:
+                self._mark_recent({normalize_rel_path(p).rpartition('/')[::2] for p in (rel_path, old_path) if p})
+            return
+        rel_dir, _, name = normalize_rel_path(rel_path).rpartition('/')
+        if name.startswith('.'):
+            return
+        event = {'type': kind, 'name': name}
+        if old_path:
+            event['old_name'] = normalize_rel_path(old_path).rpartition('/')[2]
+        if kind != 'deleted':
+            event['entry'] = listing_entry(rel_path)
+            if event['entry'] is None:
+                return
+        self.publish(rel_dir, event, from_watcher)
+
+    def reset(self, rel_dir=None):
+        """無法得知細節的變動（inotify 佇列溢位、目錄本身被移除、大量批次操作）：請用戶端重新載入"""
+        if rel_dir is not None:
+            self.publish(rel_dir, {'type': 'reset'})
+            return
+        with self._lock:
+            subs = {sub for subs in self._subscribers.values() for sub in subs}
+        for sub in subs:
+            sub.push((None, {'type': 'reset', 'dir': None}))
+
+    def _on_fs_event(self, rel_dir, name, mask):
+        if rel_dir is None:
+            self.reset()
+            return
+        if rel_dir not in self._subscribers:
+            return
+        if not name:
+            self.reset(rel_dir)
+            return
+        if name.startswith('.'):
+            return
+        created = bool(mask & (InotifyWatcher.IN_CREATE | InotifyWatcher.IN_MOVED_TO))
+        with self._lock:
+            key = (rel_dir, name)
+            self._pending[key] = self._pending.get(key, False) or created
+        self._pending_event.set()
+        self.start()
+
+    def _flush_pending(self):
+        """依項目目前的狀態發布合併後的事件"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for (rel_dir, name), created in pending.items():
+            rel_path = f'{rel_dir}/{name}' if rel_dir else name
+            if not os.path.lexists(resolve_user_path(rel_path)):
+                self.notify('deleted', rel_path, from_watcher=True)
+            else:
+                self.notify('created' if created else 'changed', rel_path, from_watcher=True)
+
+    def _run(self):
+        while True:
+            self._pending_event.wait()
+            time.sleep(CHANGE_FEED_SETTLE)  # API 掛勾通常在這段時間內發布，可略過重複的事件
+            self._pending_event.clear()
+            try:
+                self._flush_pending()
+            except Exception as e:
+                app.logger.error(f'變動事件發布失敗: {str(e)}', exc_info=True)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='change-feed', daemon=True)
+            self._thread.start()
+
+change_feed = ChangeFeed(dir_watcher)
+dir_watcher.add_listener(change_feed._on_fs_event)
+
+_batch_state = threading.local()
+
+@contextmanager
+def batch_updates(max_events=BATCH_INLINE_LIMIT):
+    """批次操作：期間的目錄列表失效與變動事件延到結束時一次處理；事件過多時每個目錄只送一次 reset"""
+    if getattr(_batch_state, 'dirs', None) is not None:
+        yield
+        return
+    _batch_state.dirs = set()
+    _batch_state.events = []
     try:
-        for dirpath, dirnames, filenames in os.walk(path):
-            for f in filenames:
-                fp = os.path.join(dirpath, f)
+        yield
+    finally:
+        dirs, events = _batch_state.dirs, _batch_state.events
+        _batch_state.dirs = _batch_state.events = None
+        for rel_dir in dirs:
+            listing_cache.invalidate(rel_dir)
+        if len(events) <= max_events:
+            for kind, rel_path, old_path in events:
+                change_feed.notify(kind, rel_path, old_path)
+        else:
+            parents = set()
+            for kind, rel_path, old_path in events:
+                for path in (rel_path, old_path):
+                    if path:
+                        parents.add(normalize_rel_path(path).rpartition('/')[0])
+            for rel_dir in parents:
+                change_feed.reset(rel_dir)
+
+def escape_like(text):
+    """跳脫 SQL LIKE 的萬用字元"""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def subtree_bounds(rel_path):
+    """子樹路徑範圍 [prefix/, prefix0)，可直接使用路徑索引"""
+    return rel_path + '/', rel_path + '0'
+
+def sqlite_trigram_available():
+    """SQLite 是否支援 FTS5 trigram 分詞（需 3.34 以上且編譯時啟用 FTS5）"""
+    conn = sqlite3.connect(':memory:')
+    try:
+        conn.execute("CREATE VIRTUAL TABLE probe USING fts5(body, tokenize='trigram')")
+        return True
+    except sqlite3.Error:
+        return False
+    finally:
+        conn.close()
+
+SQLITE_TRIGRAM = sqlite_trigram_available()
+if not SQLITE_TRIGRAM:
+    app.logger.warning(f'SQLite {sqlite3.sqlite_version} 不支援 FTS5 trigram，檔名搜尋改用 LIKE 掃描')
+
+class FileSearchIndex:
+    """檔名搜尋索引（SQLite FTS5 trigram；不支援時以 LIKE 掃描），API 異動時增量更新，背景定期與磁碟同步"""
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            name TEXT NOT NULL COLLATE NOCASE,
+            ext TEXT NOT NULL,
+            is_dir INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            generation INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS files_name ON files(name);
+        CREATE INDEX IF NOT EXISTS files_ext ON files(ext);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    '''
+    FTS_SCHEMA = '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(
+            name, content='files', content_rowid='id', tokenize='trigram');
+        CREATE TRIGGER IF NOT EXISTS files_ai AFTER INSERT ON files BEGIN
+            INSERT INTO files_fts(rowid, name) VALUES (new.id, new.name);
+        END;
+        CREATE TRIGGER IF NOT EXISTS files_ad AFTER DELETE ON files BEGIN
+            INSERT INTO files_fts(files_fts, rowid, name) VALUES ('delete', old.id, old.name);
+        END;
+        CREATE TRIGGER IF NOT EXISTS files_au AFTER UPDATE OF name ON files BEGIN
+            INSERT INTO files_fts(files_fts, rowid, name) VALUES ('delete', old.id, old.name);
+            INSERT INTO files_fts(rowid, name) VALUES (new.id, new.name);
+        END;
+    '''
+    FTS_TRIGGERS = ('files_ai', 'files_ad', 'files_au')
+    UPSERT_SQL = '''
+        INSERT INTO files (path, name, ext, is_dir, size, mtime, generation)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(path) DO UPDATE SET
+            is_dir = excluded.is_dir, size = excluded.size,
+            mtime = excluded.mtime, generation = excluded.generation
+    '''
+
+    def __init__(self, root, db_file):
+        self.root = root
+        self.db_file = db_file
+        self._local = threading.local()
+        self._thread = None
+        self.indexing = False
+        self.fts = SQLITE_TRIGRAM
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+            had_triggers = conn.execute(
+                f"SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name IN "
+                f"({', '.join('?' * len(self.FTS_TRIGGERS))})", self.FTS_TRIGGERS).fetchone()[0]
+            if self.fts:
+                conn.executescript(self.FTS_SCHEMA)
+                if had_triggers < len(self.FTS_TRIGGERS):
+                    # 先前在不支援的環境執行過，全文索引未同步，依 files 重建
+                    conn.execute("INSERT INTO files_fts(files_fts) VALUES ('rebuild')")
+            else:
+                # 沒有 FTS5 時觸發程序無法執行，寫入 files 會失敗
+                for name in self.FTS_TRIGGERS:
+                    conn.execute(f'DROP TRIGGER IF EXISTS {name}')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _get_meta(self, key, default=None):
+        row = self._connect().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row['value'] if row else default
+
+    @staticmethod
+    def _row(rel_path, is_dir, size, mtime, generation=0):
+        name = rel_path.rpartition('/')[2]
+        ext = '' if is_dir else os.path.splitext(name)[1].lower().lstrip('.')
+        return (rel_path, name, ext, int(is_dir), size, mtime, generation)
+
+    def upsert(self, rel_path, is_dir, size, mtime):
+        """新增或更新一筆（並補上尚未索引的上層資料夾）"""
+        rel_path = normalize_rel_path(rel_path)
+        if not rel_path:
+            return
+        parents = []
+        parent = rel_path.rpartition('/')[0]
+        while parent:
+            try:
+                parent_mtime = os.path.getmtime(os.path.join(self.root, parent))
+            except OSError:
+                parent_mtime = time.time()
+            parents.append(self._row(parent, True, 0, parent_mtime))
+            parent = parent.rpartition('/')[0]
+        with self._connect() as conn:
+            conn.executemany('INSERT OR IGNORE INTO files (path, name, ext, is_dir, size, mtime, generation) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?)', parents)
+            conn.execute(self.UPSERT_SQL, self._row(rel_path, is_dir, size, mtime))
+
+    def remove(self, rel_path):
+        """移除一筆（資料夾連同子樹）"""
+        rel_path = normalize_rel_path(rel_path)
+        low, high = subtree_bounds(rel_path)
+        with self._connect() as conn:
+            conn.execute('DELETE FROM files WHERE path = ? OR (path >= ? AND path < ?)', (rel_path, low, high))
+
+    def move(self, old_path, new_path):
+        """搬移或重新命名（資料夾連同子樹）"""
+        old_path = normalize_rel_path(old_path)
+        new_path = normalize_rel_path(new_path)
+        low, high = subtree_bounds(old_path)
+        _, name, ext, *_ = self._row(new_path, False, 0, 0)
+        with self._connect() as conn:
+            conn.execute('DELETE FROM files WHERE path = ? OR (path >= ? AND path < ?)',
+                         (new_path, *subtree_bounds(new_path)))
+            conn.execute('''
+                UPDATE files SET
+                    path = ? || substr(path, ?),
+                    name = CASE WHEN path = ? THEN ? ELSE name END,
+                    ext = CASE WHEN path = ? AND is_dir = 0 THEN ? ELSE ext END
+                WHERE path = ? OR (path >= ? AND path < ?)
+            ''', (new_path, len(old_path) + 1, old_path, name, old_path, ext, old_path, low, high))
+
+    def search(self, query='', mode='substring', ext=None, scope='', cursor=None, limit=SEARCH_PAGE_SIZE):
+        """搜尋檔名，mode 為 prefix 或 substring；依路徑排序，cursor 為上一頁最後一筆路徑"""
+        conditions = []
+        params = []
+        joins = ''
+        if query:
+            if mode == 'prefix':
+                conditions.append("f.name LIKE ? ESCAPE '\\'")
+                params.append(escape_like(query) + '%')
+            elif len(query) >= 3 and self.fts:
+                # trigram 至少需要 3 個字元
+                joins = 'JOIN files_fts ON files_fts.rowid = f.id'
+                conditions.append('files_fts MATCH ?')
+                params.append('"' + query.replace('"', '""') + '"')
+            else:
+                conditions.append("f.name LIKE ? ESCAPE '\\'")
+                params.append('%' + escape_like(query) + '%')
+        if ext:
+            exts = [e.strip().lower().lstrip('.') for e in ext.split(',') if e.strip()]
+            conditions.append(f"f.ext IN ({','.join('?' * len(exts))})")
+            params.extend(exts)
+        scope = normalize_rel_path(scope)
+        if scope:
+            conditions.append('f.path >= ? AND f.path < ?')
+            params.extend(subtree_bounds(scope))
+        if cursor:
+            conditions.append('f.path > ?')
+            params.append(cursor)
+        where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+        rows = self._connect().execute(
+            f'SELECT f.path, f.name, f.ext, f.is_dir, f.size, f.mtime FROM files f {joins} {where} '
+            f'ORDER BY f.path LIMIT ?', (*params, limit + 1)).fetchall()
+        next_cursor = rows[limit - 1]['path'] if len(rows) > limit else None
+        return rows[:limit], next_cursor
+
+    def _index_tree(self, start_dir, generation):
+        """走訪 start_dir 底下所有項目並分批寫入索引"""
+        conn = self._connect()
+        batch = []
+
+        def flush_batch():
+            with conn:
+                conn.executemany(self.UPSERT_SQL, batch)
+            batch.clear()
+
+        stack = [start_dir]
+        while stack:
+            rel_dir = stack.pop()
+            try:
+                with os.scandir(os.path.join(self.root, rel_dir)) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                rel_path = f'{rel_dir}/{entry.name}' if rel_dir else entry.name
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                batch.append(self._row(rel_path, is_dir, 0 if is_dir else st.st_size, st.st_mtime, generation))
+                if is_dir:
+                    stack.append(rel_path)
+                if len(batch) >= 5000:
+                    flush_batch()
+        flush_batch()
+
+    def add_tree(self, rel_path):
+        """新增整個資料夾子樹（複製、還原等操作後呼叫）"""
+        rel_path = normalize_rel_path(rel_path)
+        st = os.stat(os.path.join(self.root, rel_path))
+        self.upsert(rel_path, True, 0, st.st_mtime)
+        self._index_tree(rel_path, int(self._get_meta('generation', '0')))
+
+    def rebuild(self):
+        """走訪整棵目錄樹與索引同步（以世代編號找出已不存在的項目）"""
+        self.indexing = True
+        try:
+            generation = int(self._get_meta('generation', '0')) + 1
+            self._index_tree('', generation)
+            conn = self._connect()
+            with conn:
+                conn.execute('DELETE FROM files WHERE generation < ?', (generation,))
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('generation', ?)", (str(generation),))
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('indexed_at', ?)",
+                             (datetime.now().isoformat(),))
+            app.logger.debug(f'檔名索引已同步，第 {generation} 代')
+        finally:
+            self.indexing = False
+
+    def _run(self, interval):
+        while True:
+            try:
+                indexed_at = self._get_meta('indexed_at')
+                age = (datetime.now() - datetime.fromisoformat(indexed_at)).total_seconds() if indexed_at else None
+                if age is None or age >= interval:
+                    self.rebuild()
+            except Exception as e:
+                app.logger.error(f'檔名索引同步失敗: {str(e)}', exc_info=True)
+            time.sleep(min(interval, 60))
+
+    def start(self, interval=SEARCH_REINDEX_INTERVAL):
+        """啟動背景同步執行緒，用來納入應用程式以外的變動"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(interval,), name='search-index', daemon=True)
+            self._thread.start()
+
+search_index = FileSearchIndex(os.path.join(UPLOAD_FOLDER, 'user'), SEARCH_DB_FILE)
+
+class BlobStore:
+    """內容定址儲存：檔案本體以 SHA-256 命名存放，使用者路徑為硬連結參照（連結數即參照計數）"""
+
+    def __init__(self, root):
+        self.root = root
+        self.saved_bytes = 0  # 因重複內容而省下的空間
+        self.blob_count = 0
+        self._gc_event = threading.Event()
+        self._thread = None
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def adopt(self, file_path, digest=None):
+        """將使用者檔案納入儲存區；內容已存在時改為參照既有內容，回傳是否為重複內容。
+        使用者檔案與儲存區不在同一檔案系統（或不支援硬連結）時不進行去重複。
+        不修改檔案權限：硬連結共用同一個 inode，權限會直接反映在使用者的檔案上；
+        應用程式內的寫入都是寫新檔再替換，不會改到共用內容"""
+        if digest is None:
+            digest = hash_file(file_path)
+        blob = self.blob_path(digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        st = os.stat(file_path)
+        try:
+            for _ in range(3):
                 try:
-                    total += os.path.getsize(fp)
-                except (OSError, FileNotFoundError):
+                    os.link(file_path, blob)
+                    return False
+                except FileExistsError:
                     pass
-    except (OSError, PermissionError):
-        pass
-    return total
+                link_tmp = os.path.join(os.path.dirname(file_path),
+                                        f'.{os.path.basename(file_path)}.{uuid.uuid4().hex}.link')
+                try:
+                    blob_st = os.stat(blob)
+                    if blob_st.st_ino == st.st_ino:
+                        return False
+                    if blob_st.st_size != st.st_size:
+                        app.logger.warning(f'內容大小不符，不進行去重複: {digest}')
+                        return False
+                    os.link(blob, link_tmp)
+                except FileNotFoundError:
+                    continue  # 既有內容剛好被回收，重試
+                os.replace(link_tmp, file_path)
+                self.saved_bytes += st.st_size
+                return True
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+                raise
+            app.logger.debug(f'無法建立硬連結，不進行去重複: {file_path}: {str(e)}')
+        return False
+
+    def collect_garbage(self):
+        """回收已沒有使用者參照的內容（連結數只剩儲存區本身），並重新統計省下的空間"""
+        saved = 0
+        count = 0
+        removed = 0
+        try:
+            buckets = list(os.scandir(self.root))
+        except FileNotFoundError:
+            buckets = []
+        for bucket in buckets:
+            try:
+                blobs = list(os.scandir(bucket.path))
+            except OSError:
+                continue
+            for blob in blobs:
+                try:
+                    st = blob.stat(follow_symlinks=False)
+                    if st.st_nlink <= 1:
+                        os.remove(blob.path)
+                        removed += 1
+                        continue
+                    if not st.st_mode & 0o200:
+                        os.chmod(blob.path, st.st_mode & 0o7777 | 0o200)  # 舊版曾設為唯讀，連帶使用者的檔案也無法修改
+                except OSError:
+                    continue
+                count += 1
+                saved += st.st_size * (st.st_nlink - 2)
+        self.saved_bytes = saved
+        self.blob_count = count
+        if removed:
+            app.logger.debug(f'已回收 {removed} 個未被參照的內容')
+
+    def schedule_gc(self):
+        """刪除檔案後呼叫，由背景執行緒合併處理"""
+        self._gc_event.set()
+
+    def _run(self, interval):
+        while True:
+            self._gc_event.wait(interval)
+            time.sleep(2)  # 合併短時間內的多次刪除
+            self._gc_event.clear()
+            try:
+                self.collect_garbage()
+            except Exception as e:
+                app.logger.error(f'內容回收失敗: {str(e)}', exc_info=True)
+
+    def start(self, interval=BLOB_GC_INTERVAL):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(interval,), name='blob-gc', daemon=True)
+            self._thread.start()
+
+blob_store = BlobStore(BLOB_FOLDER)
+
+def create_process_pool(workers, thread_name_prefix):
+    """建立程序池：以 forkserver 從單執行緒的伺服程序分出子程序，不會繼承本程序其他執行緒
+    （監看、索引、工作、gunicorn 請求執行緒）當下持有的鎖；平台不支援時改用執行緒"""
+    try:
+        context = multiprocessing.get_context('forkserver')
+    except ValueError:
+        return ThreadPoolExecutor(workers, thread_name_prefix=thread_name_prefix)
+    context.set_forkserver_preload(['hnas_workers'])
+    return ProcessPoolExecutor(workers, mp_context=context)
+
+class ThumbnailCache:
+    """縮圖快取：以 路徑+mtime+大小 為鍵存於 data/system，由程序池背景產生，超過上限時依 LRU 淘汰"""
+
+    def __init__(self, root, max_bytes=THUMBNAIL_CACHE_LIMIT, workers=THUMBNAIL_WORKERS):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._failed = OrderedDict()
+        self._executor = None
+        self._total = None
+        self._scanning = False
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def available(self):
+        return Image is not None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = create_process_pool(self.workers, 'thumbnail')
+        return self._executor
+
+    def cache_path(self, rel_path, st, variant):
+        """回傳 (快取鍵, 縮圖路徑)"""
+        key = hashlib.sha1(f'{rel_path}\0{st.st_mtime_ns}\0{st.st_size}\0{variant}'.encode()).hexdigest()
+        return key, os.path.join(self.root, key[:2], key + '.jpg')
+
+    def lookup(self, rel_path, variant='small'):
+        """查詢縮圖，回傳 (狀態, 縮圖路徑)；狀態為 ready、pending 或 failed"""
+        rel_path = normalize_rel_path(rel_path)
+        full_path = resolve_user_path(rel_path)
+        st = os.stat(full_path)
+        key, thumb_path = self.cache_path(rel_path, st, variant)
+        try:
+            thumb_mtime = os.path.getmtime(thumb_path)
+            if time.time() - thumb_mtime > 3600:
+                os.utime(thumb_path)  # 以 mtime 作為 LRU 時間，最多每小時更新一次
+            self.hits += 1
+            return 'ready', thumb_path
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self.misses += 1
+            if key in self._failed:
+                return 'failed', None
+            if key not in self._pending:
+                os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+                try:
+                    future = self._get_executor().submit(render_thumbnail, full_path, thumb_path,
+                                                         THUMBNAIL_SIZES[variant])
+                except RuntimeError:  # 程序池已損壞，重建後再送一次
+                    self._executor = None
+                    future = self._get_executor().submit(render_thumbnail, full_path, thumb_path,
+                                                         THUMBNAIL_SIZES[variant])
+                self._pending[key] = future
+                future.add_done_callback(lambda f, key=key: self._on_done(key, f))
+        return 'pending', None
+
+    def prefetch(self, rel_path):
+        """上傳圖片後預先產生小縮圖"""
+        if self.available and os.path.splitext(rel_path)[1].lower() in THUMBNAIL_EXTENSIONS:
+            try:
+                self.lookup(rel_path, 'small')
+            except OSError:
+                pass
+
+    def _on_done(self, key, future):
+        with self._lock:
+            self._pending.pop(key, None)
+            error = future.exception()
+            if error is not None:
+                self._failed[key] = True
+                while len(self._failed) > 10000:
+                    self._failed.popitem(last=False)
+                app.logger.debug(f'縮圖產生失敗: {error}')
+                return
+            if self._total is None:
+                # 第一次需要總量時才走訪快取目錄；走訪不持有鎖，避免 lookup() 被擋住
+                scan = not self._scanning
+                self._scanning = True
+                over_limit = False
+            else:
+                scan = False
+                self._total += future.result()
+                over_limit = self._total > self.max_bytes
+        if scan:
+            total = self._scan()[1]
+            with self._lock:
+                self._total = total
+                over_limit = total > self.max_bytes
+        if over_limit:
+            self.evict()
+
+    def _scan(self):
+        files = []
+        total = 0
+        for dirpath, _dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        return files, total
+
+    def evict(self):
+        """刪除最久未使用的縮圖，直到低於上限的 90%"""
+        files, total = self._scan()
+        files.sort()
+        target = self.max_bytes * 0.9
+        for _mtime, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._total = total
+
+thumbnail_cache = ThumbnailCache(THUMBNAIL_FOLDER)
+
+def dedup_enabled():
+    """是否啟用去重複儲存（系統設定 dedup_storage）"""
+    return bool(load_settings().get('dedup_storage', False))
+
+def record_file_written(rel_path, old_size=0, digest=None):
+    """檔案寫入（上傳、覆寫）完成後更新各索引與快取；啟用去重複儲存時一併納入儲存區"""
+    rel_path = normalize_rel_path(rel_path)
+    rel_dir = rel_path.rpartition('/')[0]
+    full_path = resolve_user_path(rel_path)
+    if dedup_enabled():
+        blob_store.adopt(full_path, digest)
+    if old_size:
+        blob_store.schedule_gc()  # 被覆寫的舊內容可能已無參照
+    st = os.stat(full_path)
+    size_index.add_dir(rel_dir)
+    size_index.add_bytes(rel_dir, st.st_size - old_size)
+    invalidate_listing(rel_dir)
+    search_index.upsert(rel_path, False, st.st_size, st.st_mtime)
+    thumbnail_cache.prefetch(rel_path)
+    content_index.schedule(rel_path)
+    integrity_catalog.record(rel_path, digest)
+    change_feed.notify('changed' if old_size else 'created', rel_path)
+
+def record_folder_created(rel_path):
+    """資料夾建立後更新各索引與快取"""
+    rel_path = normalize_rel_path(rel_path)
+    size_index.add_dir(rel_path)
+    invalidate_listing(rel_path.rpartition('/')[0])
+    search_index.upsert(rel_path, True, 0, os.path.getmtime(resolve_user_path(rel_path)))
+    change_feed.notify('created', rel_path)
+
+def record_removed(rel_path, is_dir, size=0):
+    """檔案或資料夾刪除後更新各索引與快取（檔案需提供原大小）"""
+    rel_path = normalize_rel_path(rel_path)
+    rel_dir = rel_path.rpartition('/')[0]
+    if is_dir:
+        size_index.remove_tree(rel_path)
+        listing_cache.invalidate_tree(rel_path)
+    else:
+        size_index.add_bytes(rel_dir, -size)
+    invalidate_listing(rel_dir)
+    search_index.remove(rel_path)
+    content_index.remove(rel_path)
+    integrity_catalog.remove(rel_path)
+    blob_store.schedule_gc()
+    change_feed.notify('deleted', rel_path)
+
+def record_moved(old_path, new_path, is_dir):
+    """檔案或資料夾搬移、重新命名後更新各索引與快取"""
+    old_path = normalize_rel_path(old_path)
+    new_path = normalize_rel_path(new_path)
+    old_dir = old_path.rpartition('/')[0]
+    new_dir = new_path.rpartition('/')[0]
+    if is_dir:
+        size_index.move_tree(old_path, new_path)
+        listing_cache.invalidate_tree(old_path)
+    elif old_dir != new_dir:
+        size = os.path.getsize(resolve_user_path(new_path))
+        size_index.add_bytes(old_dir, -size)
+        size_index.add_bytes(new_dir, size)
+    invalidate_listing(old_dir)
+    invalidate_listing(new_dir)
+    search_index.move(old_path, new_path)
+    content_index.move(old_path, new_path, is_dir)
+    integrity_catalog.move(old_path, new_path)
+    if old_dir == new_dir:
+        change_feed.notify('renamed', new_path, old_path)
+    else:
+        change_feed.notify('deleted', old_path)
+        change_feed.notify('created', new_path)
+
+def record_tree_added(rel_path):
+    """整個資料夾子樹新增（複製、還原）後更新各索引與快取"""
+    rel_path = normalize_rel_path(rel_path)
+    full_path = resolve_user_path(rel_path)
+    if not os.path.isdir(full_path):
+        record_file_written(rel_path)
+        return
+    size_index.add_tree(rel_path)
+    listing_cache.invalidate_tree(rel_path)
+    invalidate_listing(rel_path.rpartition('/')[0])
+    search_index.add_tree(rel_path)
+    content_index.schedule(rel_path)
+    integrity_catalog.add_tree(rel_path)
+    change_feed.notify('created', rel_path)
+
+def to_rel_path(full_path):
+    """將 data/user 下的絕對路徑轉回相對路徑"""
+    root = os.path.abspath(os.path.join(UPLOAD_FOLDER, 'user'))
+    return normalize_rel_path(os.path.relpath(os.path.abspath(full_path), root))
+
+def unique_destination(full_path):
+    """目的地已存在時改用「名稱 (n)」"""
+    if not os.path.lexists(full_path):
+        return full_path
+    base, ext = os.path.splitext(full_path)
+    if os.path.isdir(full_path):
+        base, ext = full_path, ''
+    n = 1
+    while os.path.lexists(f'{base} ({n}){ext}'):
+        n += 1
+    return f'{base} ({n}){ext}'
+
+def tree_size(full_path):
+    """檔案或資料夾的總大小（資料夾由目錄大小索引取得）"""
+    if os.path.isdir(full_path):
+        return size_index.total(to_rel_path(full_path))
+    return os.path.getsize(full_path)
+
+class JobCancelled(Exception):
+    """工作被使用者取消"""
+
+class JobContext:
+    """傳給工作處理函式：提供參數、進度回報與取消檢查"""
+
+    def __init__(self, manager, job_id, params):
+        self.manager = manager
+        self.job_id = job_id
+        self.params = params
+        self.done = 0
+        self.total = 0
+        self._last_write = 0
+
+    def progress(self, done, total=None, message=None):
+        """回報進度（節流寫入資料庫）；工作被取消時拋出 JobCancelled"""
+        self.done = done
+        if total is not None:
+            self.total = total
+        now = time.monotonic()
+        if message is not None or now - self._last_write >= JOB_PROGRESS_INTERVAL:
+            self._last_write = now
+            if self.manager.update_progress(self.job_id, self.done, self.total, message):
+                raise JobCancelled()
+
+    def check_cancelled(self):
+        if self.manager.is_cancel_requested(self.job_id):
+            raise JobCancelled()
+
+class JobManager:
+    """背景工作：以執行緒池執行耗時的檔案操作，工作狀態存於 SQLite（多個程序可共用）"""
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            type TEXT NOT NULL,
+            params TEXT NOT NULL,
+            username TEXT NOT NULL,
+            status TEXT NOT NULL,
+            progress_done INTEGER NOT NULL DEFAULT 0,
+            progress_total INTEGER NOT NULL DEFAULT 0,
+            message TEXT,
+            result TEXT,
+            error TEXT,
+            worker TEXT,
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL,
+            started_at TEXT,
+            finished_at TEXT
+        );
+        CREATE INDEX IF NOT EXISTS jobs_user ON jobs(username, created_at);
+        CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status);
+    '''
+    FINISHED = ('completed', 'failed', 'cancelled')
+
+    def __init__(self, db_file, workers=JOB_WORKERS):
+        self.db_file = db_file
+        self.workers = workers
+        self.handlers = {}
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}'
+        self._local = threading.local()
+        self._executor = None
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def register(self, job_type):
+        """註冊工作處理函式的裝飾器"""
+        def decorator(func):
+            self.handlers[job_type] = func
+            return func
+        return decorator
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='job')
+            return self._executor
+
+    def submit(self, job_type, params, username):
+        """建立工作並排入佇列，回傳工作 ID"""
+        if job_type not in self.handlers:
+            raise ValueError(f'未知的工作類型: {job_type}')
+        job_id = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute('INSERT INTO jobs (id, type, params, username, status, created_at) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         (job_id, job_type, json.dumps(params, ensure_ascii=False), username, 'queued',
+                          datetime.now().isoformat()))
+        self._get_executor().submit(self._execute, job_id)
+        return job_id
+
+    def _execute(self, job_id):
+        conn = self._connect()
+        with conn:
+            claimed = conn.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, started_at = ? "
+                "WHERE id = ? AND status = 'queued' AND cancel_requested = 0",
+                (self.worker_id, datetime.now().isoformat(), job_id)).rowcount
+        if not claimed:
+            return
+        row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        ctx = JobContext(self, job_id, json.loads(row['params']))
+        status, result, error = 'completed', None, None
+        try:
+            result = self.handlers[row['type']](ctx)
+        except JobCancelled:
+            status = 'cancelled'
+        except Exception as e:
+            app.logger.error(f'背景工作 {job_id} 失敗: {str(e)}', exc_info=True)
+            status, error = 'failed', str(e)
+        with conn:
+            conn.execute('UPDATE jobs SET status = ?, result = ?, error = ?, progress_done = ?, '
+                         'progress_total = ?, finished_at = ? WHERE id = ?',
+                         (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error,
+                          ctx.done, ctx.total, datetime.now().isoformat(), job_id))
+
+    def update_progress(self, job_id, done, total, message=None):
+        """寫入進度，回傳是否已要求取消"""
+        conn = self._connect()
+        with conn:
+            conn.execute('UPDATE jobs SET progress_done = ?, progress_total = ?, message = COALESCE(?, message) '
+                         'WHERE id = ?', (done, total, message, job_id))
+        return self.is_cancel_requested(job_id)
+
+    def is_cancel_requested(self, job_id):
+        row = self._connect().execute('SELECT cancel_requested FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return bool(row and row['cancel_requested'])
+
+    def cancel(self, job_id):
+        """要求取消；尚未開始的工作直接標記為已取消"""
+        with self._connect() as conn:
+            conn.execute('UPDATE jobs SET cancel_requested = 1 WHERE id = ?', (job_id,))
+            conn.execute("UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'queued'",
+                         (datetime.now().isoformat(), job_id))
+
+    def get(self, job_id, username=None):
+        row = self._connect().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None or (username is not None and row['username'] != username):
+            return None
+        return self.to_dict(row)
+
+    def status_counts(self):
+        """各狀態的工作數"""
+        return dict(self._connect().execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+    def latest(self, username, job_type):
+        """某類型最近一次完成的工作"""
+        row = self._connect().execute(
+            "SELECT * FROM jobs WHERE username = ? AND type = ? AND status = 'completed' "
+            "ORDER BY finished_at DESC LIMIT 1", (username, job_type)).fetchone()
+        return self.to_dict(row) if row else None
+
+    def list(self, username, status=None, limit=50):
+        query = 'SELECT * FROM jobs WHERE username = ?'
+        params = [username]
+        if status:
+            query += ' AND status = ?'
+            params.append(status)
+        query += ' ORDER BY created_at DESC LIMIT ?'
+        params.append(limit)
+        return [self.to_dict(row) for row in self._connect().execute(query, params)]
+
+    @staticmethod
+    def to_dict(row):
+        total = row['progress_total']
+        return {
+            'id': row['id'],
+            'type': row['type'],
+            'params': json.loads(row['params']),
+            'status': row['status'],
+            'progress': {
+                'done': row['progress_done'],
+                'total': total,
+                'percent': round(row['progress_done'] / total * 100, 1) if total else None
+            },
+            'message': row['message'],
+            'result': json.loads(row['result']) if row['result'] else None,
+            'error': row['error'],
+            'cancel_requested': bool(row['cancel_requested']),
+            'created_at': row['created_at'],
+            'started_at': row['started_at'],
+            'finished_at': row['finished_at']
+        }
+
+    def recover(self):
+        """重新排入上次中斷的工作（執行中的程序已不存在者），並清除過舊的紀錄"""
+        conn = self._connect()
+        cutoff = (datetime.now() - timedelta(days=JOB_RETENTION_DAYS)).isoformat()
+        hostname = socket.gethostname()
+        with conn:
+            conn.execute('DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?', (cutoff,))
+            for row in conn.execute("SELECT id, worker FROM jobs WHERE status = 'running'").fetchall():
+                host, _, pid = (row['worker'] or '').rpartition(':')
+                if host == hostname and pid.isdigit() and psutil.pid_exists(int(pid)):
+                    continue
+                conn.execute("UPDATE jobs SET status = 'queued' WHERE id = ? AND status = 'running'", (row['id'],))
+        for row in conn.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at").fetchall():
+            self._get_executor().submit(self._execute, row['id'])
+
+job_manager = JobManager(JOB_DB_FILE)
+
+def clone_file(fsrc, fdst):
+    """嘗試以 reflink 複製（只建立中繼資料，瞬間完成），不支援時回傳 False"""
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except OSError:
+        return False
+
+def copy_file_with_progress(src, dst, ctx=None, done=0):
+    """複製檔案並回報進度，回傳累計位元組：依序嘗試 reflink、copy_file_range（核心內複製），
+    都不支援時才逐塊讀寫"""
+    def progress(value):
+        if ctx:
+            ctx.progress(value)
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        if size and clone_file(fsrc, fdst):
+            done += size
+            progress(done)
+        else:
+            copied = 0
+            if hasattr(os, 'copy_file_range'):
+                try:
+                    while True:
+                        n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), COPY_RANGE_CHUNK)
+                        if n == 0:
+                            break
+                        copied += n
+                        progress(done + copied)
+                except OSError as e:
+                    # 舊核心、跨檔案系統或特殊檔案系統不支援時，從目前位置改用一般讀寫
+                    if e.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM):
+                        raise
+            fsrc.seek(copied)
+            fdst.seek(copied)
+            while True:
+                data = fsrc.read(STREAM_CHUNK_SIZE)
+                if not data:
+                    break
+                fdst.write(data)
+                copied += len(data)
+                progress(done + copied)
+            done += copied
+    shutil.copystat(src, dst)
+    return done
+
+def copy_tree_with_progress(src, dst, ctx=None):
+    """複製檔案或資料夾到 dst（dst 不可存在）"""
+    if not os.path.isdir(src):
+        return copy_file_with_progress(src, dst, ctx, 0)
+    done = 0
+    for dirpath, dirnames, filenames in os.walk(src):
+        target_dir = os.path.join(dst, os.path.relpath(dirpath, src))
+        os.makedirs(target_dir, exist_ok=True)
+        # 隱藏項目（其他工作的 .copying-*、上傳中的 .*.part 等暫存）不複製；
+        # os.walk 不會進入指向資料夾的連結，和檔案連結一樣重建為連結
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for name in list(dirnames):
+            source = os.path.join(dirpath, name)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), os.path.join(target_dir, name))
+                dirnames.remove(name)
+        for name in filenames:
+            if name.startswith('.'):
+                continue
+            source = os.path.join(dirpath, name)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), os.path.join(target_dir, name))
+            else:
+                done = copy_file_with_progress(source, os.path.join(target_dir, name), ctx, done)
+        shutil.copystat(dirpath, target_dir)
+    return done
+
+def copy_into_folder(src, dst_dir, staging_name, ctx=None):
+    """複製到目的資料夾：先寫入隱藏的暫存名稱，完成後才改名（同名時改用「名稱 (n)」），失敗或取消時刪除暫存"""
+    target = unique_destination(os.path.join(dst_dir, os.path.basename(src)))
+    staging = os.path.join(dst_dir, staging_name)
+    remove_path(staging)  # 程序中斷後重新執行的工作可能留有上次的暫存
+    try:
+        copy_tree_with_progress(src, staging, ctx)
+        os.rename(staging, target)
+    except BaseException:
+        remove_path(staging)
+        raise
+    record_tree_added(to_rel_path(target))
+    return target
+
+def remove_path(path):
+    """刪除檔案或資料夾（不存在時略過）"""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+@job_manager.register('delete')
+def job_delete(ctx):
+    """刪除工作：刪除已改名為隱藏目錄的資料夾；取消時把剩下的內容還原"""
+    staging = resolve_user_path(ctx.params['staging'])
+    total = ctx.params.get('bytes', 0)
+    done = 0
+    count = 0
+    ctx.progress(0, total)
+    try:
+        for dirpath, dirnames, filenames in os.walk(staging, topdown=False):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    size = os.lstat(path).st_size
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                done += size
+                count += 1
+                ctx.progress(done)
+            for name in dirnames:
+                path = os.path.join(dirpath, name)
+                if os.path.islink(path):
+                    os.remove(path)
+                else:
+                    os.rmdir(path)
+        if os.path.isdir(staging):
+            os.rmdir(staging)
+    except JobCancelled:
+        original = resolve_user_path(ctx.params['path'])
+        if os.path.isdir(staging) and not os.path.lexists(original):
+            os.rename(staging, original)
+            record_tree_added(ctx.params['path'])
+        raise
+    finally:
+        blob_store.schedule_gc()
+    return {'deleted_files': count, 'deleted_bytes': done}
+
+@job_manager.register('copy')
+def job_copy(ctx):
+    """複製工作：先複製到目的地的隱藏暫存名稱，完成後才改名，取消時刪除暫存"""
+    src = resolve_user_path(ctx.params['src'])
+    dst_dir = resolve_user_path(ctx.params['dst'])
+    ctx.progress(0, tree_size(src))
+    target = copy_into_folder(src, dst_dir, f'.copying-{ctx.job_id}', ctx)
+    return {'path': to_rel_path(target)}
+
+@job_manager.register('move')
+def job_move(ctx):
+    """搬移工作：同一檔案系統直接改名，否則先複製到目的地的隱藏暫存名稱，完成後才改名並刪除來源"""
+    src = resolve_user_path(ctx.params['src'])
+    dst_dir = resolve_user_path(ctx.params['dst'])
+    if not os.path.lexists(src):
+        raise FileNotFoundError('來源不存在')
+    target = unique_destination(os.path.join(dst_dir, os.path.basename(src)))
+    is_dir = os.path.isdir(src)
+    total = tree_size(src)
+    ctx.progress(0, total)
+    try:
+        os.rename(src, target)
+        record_moved(to_rel_path(src), to_rel_path(target), is_dir)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        target = copy_into_folder(src, dst_dir, f'.copying-{ctx.job_id}', ctx)
+        # 來源先改名為隱藏名稱再刪除，刪到一半中斷時不會留下看似完整的殘缺來源
+        removing = os.path.join(os.path.dirname(src), f'.deleting-{ctx.job_id}')
+        os.rename(src, removing)
+        record_removed(to_rel_path(src), is_dir, 0 if is_dir else total)
+        remove_path(removing)
+    ctx.progress(total)
+    return {'path': to_rel_path(target)}
+
+@job_manager.register('archive')
+def job_archive(ctx):
+    """壓縮工作：將多個項目打包成 ZIP 存到指定資料夾"""
+    full_paths = [resolve_user_path(p) for p in ctx.params['paths']]
+    dst_dir = resolve_user_path(ctx.params['dst'])
+    name = secure_filename(ctx.params.get('name') or '') or 'archive'
+    if not name.lower().endswith('.zip'):
+        name += '.zip'
+    target = unique_destination(os.path.join(dst_dir, name))
+    tmp_path = os.path.join(dst_dir, f'.archive-{ctx.job_id}.part')
+    compression = zipfile.ZIP_DEFLATED if ctx.params.get('compress') else zipfile.ZIP_STORED
+    ctx.progress(0, sum(tree_size(p) for p in full_paths))
+    written = 0
+    try:
+        with open(tmp_path, 'wb') as f:
+            for chunk in generate_zip_stream(full_paths, compression):
+                f.write(chunk)
+                written += len(chunk)
+                ctx.progress(min(written, ctx.total))
+        os.replace(tmp_path, target)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    record_file_written(to_rel_path(target))
+    return {'path': to_rel_path(target), 'size': os.path.getsize(target)}
+
+def start_delete_job(rel_path, username):
+    """資料夾刪除：先改名為隱藏目錄（立即從列表消失），再交給背景工作刪除"""
+    rel_path = normalize_rel_path(rel_path)
+    full_path = resolve_user_path(rel_path)
+    size = tree_size(full_path)
+    staging = os.path.join(os.path.dirname(full_path), f'.deleting-{uuid.uuid4().hex}')
+    os.rename(full_path, staging)
+    record_removed(rel_path, True)
+    return job_manager.submit('delete', {'path': rel_path, 'staging': to_rel_path(staging), 'bytes': size},
+                              username)
+
+class RateLimiter:
+    """權杖桶速率限制：consume() 超過速率時睡眠"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate
+        self.last = time.monotonic()
+
+    def consume(self, amount=1):
+        now = time.monotonic()
+        self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+        self.last = now
+        self.allowance -= amount
+        if self.allowance < 0:
+            time.sleep(-self.allowance / self.rate)
+
+class TrashBin:
+    """資源回收筒：刪除時改名移入同一磁碟區的回收區（O(1)），中繼資料存於 SQLite；
+    背景執行緒依 auto_cleanup 設定的保留天數與容量上限，以限速方式清除"""
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS trash (
+            id TEXT PRIMARY KEY,
+            original_path TEXT NOT NULL,
+            name TEXT NOT NULL,
+            is_dir INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            location TEXT NOT NULL,
+            username TEXT,
+            deleted_at REAL NOT NULL,
+            status TEXT NOT NULL DEFAULT 'trashed',
+            claimed_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS trash_status ON trash(status, deleted_at);
+    '''
+
+    def __init__(self, root, db_file):
+        self.root = root
+        self.db_file = db_file
+        self._local = threading.local()
+        self._purge_event = threading.Event()
+        self._thread = None
+        os.makedirs(self.root, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def trash_root(self, full_path):
+        """回收區需與項目位於同一磁碟區，改名才是 O(1)；不同磁碟區時使用該磁碟區掛載點下的回收區"""
+        dev = os.stat(os.path.dirname(full_path)).st_dev
+        if os.stat(self.root).st_dev == dev:
+            return self.root
+        mount = os.path.dirname(full_path)
+        while os.path.dirname(mount) != mount and os.stat(os.path.dirname(mount)).st_dev == dev:
+            mount = os.path.dirname(mount)
+        return os.path.join(mount, TRASH_VOLUME_FOLDER)
+
+    def move_to_trash(self, rel_path, username):
+        """將檔案或資料夾移入回收筒，回傳回收項目 ID"""
+        rel_path = normalize_rel_path(rel_path)
+        full_path = resolve_user_path(rel_path)
+        is_dir = os.path.isdir(full_path)
+        size = tree_size(full_path)
+        item_id = uuid.uuid4().hex
+        root = self.trash_root(full_path)
+        os.makedirs(root, exist_ok=True)
+        location = os.path.join(root, item_id)
+        os.rename(full_path, location)
+        try:
+            with self._connect() as conn:
+                conn.execute('INSERT INTO trash (id, original_path, name, is_dir, size, location, username, deleted_at) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (item_id, rel_path, os.path.basename(full_path), int(is_dir), size,
+                              os.path.abspath(location), username, time.time()))
+        except Exception:
+            os.rename(location, full_path)
+            raise
+        record_removed(rel_path, is_dir, 0 if is_dir else size)
+        self.schedule_purge()  # 檢查容量上限
+        return item_id
+
+    def list(self):
+        rows = self._connect().execute(
+            "SELECT * FROM trash WHERE status = 'trashed' ORDER BY deleted_at DESC").fetchall()
+        return [{
+            'id': row['id'],
+            'name': row['name'],
+            'original_path': row['original_path'],
+            'type': 'folder' if row['is_dir'] else 'file',
+            'size': row['size'],
+            'size_formatted': format_file_size(row['size']),
+            'deleted_by': row['username'],
+            'deleted_at': datetime.fromtimestamp(row['deleted_at']).strftime('%Y-%m-%d %H:%M:%S')
+        } for row in rows]
+
+    def total_size(self):
+        row = self._connect().execute("SELECT COALESCE(SUM(size), 0) FROM trash WHERE status = 'trashed'").fetchone()
+        return row[0]
+
+    def restore(self, item_id):
+        """還原到原本的位置（原位置已有同名項目時改用「名稱 (n)」），回傳還原後的相對路徑；找不到時回傳 None"""
+        conn = self._connect()
+        with conn:
+            claimed = conn.execute("UPDATE trash SET status = 'restoring', claimed_at = ? "
+                                   "WHERE id = ? AND status = 'trashed'", (time.time(), item_id)).rowcount
+        if not claimed:
+            return None
+        row = conn.execute('SELECT * FROM trash WHERE id = ?', (item_id,)).fetchone()
+        try:
+            target = unique_destination(resolve_user_path(row['original_path']))
+            # 上層資料夾已被刪除時重新建立，並從最上層新建的資料夾開始更新索引
+            parent = os.path.dirname(target)
+            added = target
+            while not os.path.isdir(parent):
+                added = parent
+                parent = os.path.dirname(parent)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.rename(row['location'], target)
+        except Exception:
+            with conn:
+                conn.execute("UPDATE trash SET status = 'trashed' WHERE id = ?", (item_id,))
+            raise
+        with conn:
+            conn.execute('DELETE FROM trash WHERE id = ?', (item_id,))
+        record_tree_added(to_rel_path(added))
+        return to_rel_path(target)
+
+    def request_purge(self, item_id=None):
+        """排入永久刪除（item_id 為 None 時清空回收筒），由背景執行緒處理，回傳排入的項目數"""
+        with self._connect() as conn:
+            if item_id is None:
+                count = conn.execute("UPDATE trash SET status = 'purge' WHERE status = 'trashed'").rowcount
+            else:
+                count = conn.execute("UPDATE trash SET status = 'purge' WHERE id = ? AND status = 'trashed'",
+                                     (item_id,)).rowcount
+        if count:
+            self.schedule_purge()
+        return count
+
+    def schedule_purge(self):
+        """喚醒背景執行緒立即套用清理規則"""
+        self._purge_event.set()
+
+    def apply_policy(self):
+        """auto_cleanup 開啟時，將超過保留天數或超出容量上限（由最舊的開始）的項目排入清除"""
+        settings = load_settings()
+        if not settings.get('auto_cleanup', True):
+            return
+        retention_days = settings.get('trash_retention_days', TRASH_RETENTION_DAYS)
+        max_size = settings.get('trash_max_size_gb', TRASH_MAX_SIZE_GB) * 1024 ** 3
+        conn = self._connect()
+        with conn:
+            conn.execute("UPDATE trash SET status = 'purge' WHERE status = 'trashed' AND deleted_at < ?",
+                         (time.time() - retention_days * 86400,))
+            excess = self.total_size() - max_size
+            if excess > 0:
+                for row in conn.execute("SELECT id, size FROM trash WHERE status = 'trashed' "
+                                        "ORDER BY deleted_at").fetchall():
+                    if excess <= 0:
+                        break
+                    conn.execute("UPDATE trash SET status = 'purge' WHERE id = ?", (row['id'],))
+                    excess -= row['size']
+
+    def purge_pending(self):
+        """清除已排入的項目；其他程序清除到一半中斷的項目（超過一小時）也會接手"""
+        conn = self._connect()
+        files_limiter = RateLimiter(TRASH_PURGE_FILES_PER_SEC)
+        bytes_limiter = RateLimiter(TRASH_PURGE_BYTES_PER_SEC)
+        purged = 0
+        while True:
+            row = conn.execute("SELECT * FROM trash WHERE status = 'purge' "
+                               "OR (status = 'purging' AND claimed_at < ?) ORDER BY deleted_at LIMIT 1",
+                               (time.time() - 3600,)).fetchone()
+            if row is None:
+                break
+            with conn:
+                claimed = conn.execute("UPDATE trash SET status = 'purging', claimed_at = ? "
+                                       "WHERE id = ? AND status = ?",
+                                       (time.time(), row['id'], row['status'])).rowcount
+            if not claimed:
+                continue
+            self._remove_throttled(row['location'], files_limiter, bytes_limiter)
+            with conn:
+                conn.execute('DELETE FROM trash WHERE id = ?', (row['id'],))
+            purged += 1
+        if purged:
+            blob_store.schedule_gc()
+            app.logger.debug(f'已清除 {purged} 個回收筒項目')
+
+    @staticmethod
+    def _remove_throttled(path, files_limiter, bytes_limiter):
+        """由下而上刪除，依檔案數與位元組數限速"""
+        def remove_file(file_path):
+            try:
+                size = os.lstat(file_path).st_size
+                os.remove(file_path)
+            except FileNotFoundError:
+                return
+            files_limiter.consume()
+            bytes_limiter.consume(size)
+
+        if not os.path.isdir(path) or os.path.islink(path):
+            remove_file(path)
+            return
+        for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+            for name in filenames:
+                remove_file(os.path.join(dirpath, name))
+            for name in dirnames:
+                sub = os.path.join(dirpath, name)
+                if os.path.islink(sub):
+                    remove_file(sub)
+                else:
+                    try:
+                        os.rmdir(sub)
+                    except FileNotFoundError:
+                        pass
+        try:
+            os.rmdir(path)
+        except FileNotFoundError:
+            pass
+
+    def _run(self, interval):
+        while True:
+            try:
+                self.apply_policy()
+                self.purge_pending()
+            except Exception as e:
+                app.logger.error(f'回收筒清除失敗: {str(e)}', exc_info=True)
+            self._purge_event.wait(interval)
+            self._purge_event.clear()
+
+    def start(self, interval=TRASH_PURGE_INTERVAL):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(interval,), name='trash-purge', daemon=True)
+            self._thread.start()
+
+trash_bin = TrashBin(TRASH_FOLDER, TRASH_DB_FILE)
+
+class BatchError(Exception):
+    """批次中單一操作失敗（訊息會回傳給用戶端）"""
+
+def run_batch_operation(operation, username, permanent=False):
+    """執行批次中的一項操作（delete / move / copy / rename），回傳結果；失敗時拋出 BatchError"""
+    op = operation.get('op')
+    path = normalize_rel_path(operation.get('path', ''))
+    full_path = resolve_user_path(path) if path else None
+    if not full_path or not os.path.lexists(full_path):
+        raise BatchError('檔案或資料夾不存在')
+    is_dir = os.path.isdir(full_path)
+    
+    if op == 'delete':
+        if not permanent:
+            return {'trash_id': trash_bin.move_to_trash(path, username)}
+        if is_dir:
+            return {'job_id': start_delete_job(path, username)}
+        size = os.path.getsize(full_path)
+        os.remove(full_path)
+        record_removed(path, False, size)
+        return {}
+    
+    if op in ('move', 'copy'):
+        dst = normalize_rel_path(operation.get('destination', ''))
+        dst_full = resolve_user_path(dst)
+        if not dst_full or not os.path.isdir(dst_full):
+            raise BatchError('目的資料夾不存在')
+        if dst == path or dst.startswith(path + '/'):
+            raise BatchError('無法複製或搬移到自身內部')
+    
+    if op == 'copy':
+        if is_dir or os.path.getsize(full_path) > COPY_INLINE_MAX:
+            return {'job_id': job_manager.submit('copy', {'src': path, 'dst': dst}, username)}
+        target = copy_into_folder(full_path, dst_full, f'.copying-{uuid.uuid4().hex}')
+        return {'path': to_rel_path(target)}
+    
+    if op == 'move':
+        if os.path.dirname(full_path) == dst_full:
+            raise BatchError('已在目的資料夾中')
+        target = unique_destination(os.path.join(dst_full, os.path.basename(full_path)))
+        try:
+            os.rename(full_path, target)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # 跨檔案系統需要複製，交給背景工作
+            return {'job_id': job_manager.submit('move', {'src': path, 'dst': dst}, username)}
+        record_moved(path, to_rel_path(target), is_dir)
+        return {'path': to_rel_path(target)}
+    
+    if op == 'rename':
+        new_name = secure_filename(operation.get('new_name', ''))
+        if not new_name:
+            raise BatchError('無效的名稱')
+        target = os.path.join(os.path.dirname(full_path), new_name)
+        if os.path.lexists(target):
+            raise BatchError('同名檔案已存在')
+        os.rename(full_path, target)
+        record_moved(path, to_rel_path(target), is_dir)
+        return {'path': to_rel_path(target)}
+    
+    raise BatchError(f'未知的操作: {op}')
+
+def submit_batch(operations, permanent=False):
+    """少量操作直接執行並回傳每一項的結果，大量時建立背景工作（202）"""
+    if len(operations) > BATCH_INLINE_LIMIT:
+        job_id = job_manager.submit('batch', {'operations': operations, 'permanent': permanent,
+                                              'username': session['username']}, session['username'])
+        return jsonify({'job_id': job_id}), 202
+    return jsonify(run_batch(operations, session['username'], permanent))
+
+def run_batch(operations, username, permanent=False, ctx=None):
+    """依序執行批次操作，回傳每一項的結果；列表與變動事件於結束時一次更新"""
+    results = []
+    with batch_updates():
+        for index, operation in enumerate(operations):
+            if ctx:
+                ctx.progress(index, len(operations))
+            result = {'index': index, 'op': operation.get('op'), 'path': operation.get('path'), 'ok': True}
+            try:
+                result.update(run_batch_operation(operation, username, permanent))
+            except BatchError as e:
+                result.update(ok=False, error=str(e))
+            except Exception as e:
+                app.logger.error(f'批次操作失敗: {str(e)}', exc_info=True)
+                result.update(ok=False, error=str(e))
+            results.append(result)
+    succeeded = sum(1 for r in results if r['ok'])
+    return {'results': results, 'succeeded': succeeded, 'failed': len(results) - succeeded}
+
+@job_manager.register('batch')
+def job_batch(ctx):
+    """批次工作：大量的刪除、搬移、重新命名"""
+    operations = ctx.params['operations']
+    result = run_batch(operations, ctx.params['username'], ctx.params.get('permanent', False), ctx)
+    ctx.progress(len(operations))
+    return result
+
+def is_content_indexable(rel_path):
+    return os.path.splitext(rel_path)[1].lower().lstrip('.') in CONTENT_INDEX_EXTENSIONS
+
+class ContentIndex:
+    """全文內容索引（SQLite FTS5 trigram）：文字與程式碼檔的內容，API 異動時排入佇列，
+    由背景執行緒限速讀取並更新，並定期與磁碟同步"""
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS docs (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            truncated INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5(body, tokenize='trigram');
+        CREATE TABLE IF NOT EXISTS pending (path TEXT PRIMARY KEY, queued_at REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    '''
+
+    def __init__(self, root, db_file):
+        self.root = root
+        self.db_file = db_file
+        self._local = threading.local()
+        self._event = threading.Event()
+        self._thread = None
+        # SQLite 不支援 FTS5 trigram 時停用內容搜尋（不建立資料庫、不啟動背景索引）
+        self.available = SQLITE_TRIGRAM
+        if not self.available:
+            app.logger.warning('SQLite 不支援 FTS5 trigram，已停用檔案內容搜尋')
+            return
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def schedule(self, rel_path):
+        """排入索引佇列（檔案或整個資料夾），由背景執行緒處理"""
+        if not self.available:
+            return
+        rel_path = normalize_rel_path(rel_path)
+        if not os.path.isdir(os.path.join(self.root, rel_path)) and not is_content_indexable(rel_path):
+            return
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO pending (path, queued_at) VALUES (?, ?)', (rel_path, time.time()))
+        self._event.set()
+
+    def remove(self, rel_path):
+        """移除一筆（資料夾連同子樹）"""
+        if not self.available:
+            return
+        rel_path = normalize_rel_path(rel_path)
+        low, high = subtree_bounds(rel_path)
+        with self._connect() as conn:
+            conn.execute('DELETE FROM docs_fts WHERE rowid IN '
+                         '(SELECT id FROM docs WHERE path = ? OR (path >= ? AND path < ?))', (rel_path, low, high))
+            conn.execute('DELETE FROM docs WHERE path = ? OR (path >= ? AND path < ?)', (rel_path, low, high))
+
+    def move(self, old_path, new_path, is_dir):
+        """搬移或重新命名（資料夾連同子樹）；檔案改名後類型不再需要索引時移除"""
+        if not self.available:
+            return
+        old_path = normalize_rel_path(old_path)
+        new_path = normalize_rel_path(new_path)
+        if not is_dir and not is_content_indexable(new_path):
+            self.remove(old_path)
+            return
+        self.remove(new_path)
+        low, high = subtree_bounds(old_path)
+        with self._connect() as conn:
+            moved = conn.execute('UPDATE docs SET path = ? || substr(path, ?) WHERE path = ? OR (path >= ? AND path < ?)',
+                                 (new_path, len(old_path) + 1, old_path, low, high)).rowcount
+        if not is_dir and not moved:
+            self.schedule(new_path)  # 原本的類型不需索引
+
+    def search(self, query, scope='', offset=0, limit=CONTENT_SEARCH_PAGE_SIZE):
+        """搜尋內容（至少 3 個字元），依相關度排序，回傳 (結果, 是否還有下一頁)"""
+        conditions = ['docs_fts MATCH ?']
+        params = ['"' + query.replace('"', '""') + '"']
+        scope = normalize_rel_path(scope)
+        if scope:
+            conditions.append('d.path >= ? AND d.path < ?')
+            params.extend(subtree_bounds(scope))
+        rows = self._connect().execute(
+            f"SELECT d.path, d.size, d.mtime_ns, snippet(docs_fts, 0, char(2), char(3), '…', 16) AS snippet "
+            f"FROM docs_fts JOIN docs d ON d.id = docs_fts.rowid WHERE {' AND '.join(conditions)} "
+            f"ORDER BY rank LIMIT ? OFFSET ?", (*params, limit + 1, offset)).fetchall()
+        return rows[:limit], len(rows) > limit
+
+    def pending_count(self):
+        if not self.available:
+            return 0
+        return self._connect().execute('SELECT COUNT(*) FROM pending').fetchone()[0]
+
+    @staticmethod
+    def _read_text(full_path):
+        """讀取檔案開頭（最多 CONTENT_INDEX_MAX_BYTES），二進位檔回傳 None"""
+        with open(full_path, 'rb') as f:
+            data = f.read(CONTENT_INDEX_MAX_BYTES)
+        if b'\0' in data[:8192]:
+            return None
+        for encoding in ('utf-8-sig', 'cp950'):
+            try:
+                # final=False：忽略被截斷在結尾的不完整字元
+                return codecs.getincrementaldecoder(encoding)().decode(data, final=False)
+            except UnicodeDecodeError:
+                continue
+        return data.decode('utf-8', errors='replace')
+
+    def _index_file(self, rel_path, limiters):
+        full_path = os.path.join(self.root, rel_path)
+        try:
+            st = os.stat(full_path)
+        except OSError:
+            self.remove(rel_path)
+            return
+        conn = self._connect()
+        row = conn.execute('SELECT id, size, mtime_ns FROM docs WHERE path = ?', (rel_path,)).fetchone()
+        if row and row['size'] == st.st_size and row['mtime_ns'] == st.st_mtime_ns:
+            return
+        files_limiter, bytes_limiter = limiters
+        files_limiter.consume()
+        bytes_limiter.consume(min(st.st_size, CONTENT_INDEX_MAX_BYTES))
+        try:
+            text = self._read_text(full_path)
+        except OSError:
+            return
+        with conn:
+            if row:
+                conn.execute('DELETE FROM docs_fts WHERE rowid = ?', (row['id'],))
+                conn.execute('UPDATE docs SET size = ?, mtime_ns = ?, truncated = ? WHERE id = ?',
+                             (st.st_size, st.st_mtime_ns, int(st.st_size > CONTENT_INDEX_MAX_BYTES), row['id']))
+                doc_id = row['id']
+            else:
+                doc_id = conn.execute('INSERT INTO docs (path, size, mtime_ns, truncated) VALUES (?, ?, ?, ?)',
+                                      (rel_path, st.st_size, st.st_mtime_ns,
+                                       int(st.st_size > CONTENT_INDEX_MAX_BYTES))).lastrowid
+            if text:
+                conn.execute('INSERT INTO docs_fts (rowid, body) VALUES (?, ?)', (doc_id, text))
+
+    def _index_path(self, rel_path, limiters):
+        """索引檔案，或走訪資料夾索引其中的檔案；已不存在時移除"""
+        full_path = os.path.join(self.root, rel_path)
+        if not os.path.isdir(full_path):
+            if os.path.lexists(full_path):
+                self._index_file(rel_path, limiters)
+            else:
+                self.remove(rel_path)
+            return
+        for dirpath, dirnames, filenames in os.walk(full_path):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for name in filenames:
+                if name.startswith('.') or not is_content_indexable(name):
+                    continue
+                self._index_file(to_rel_path(os.path.join(dirpath, name)), limiters)
+
+    def process_pending(self):
+        """處理佇列：逐筆認領（其他程序已處理或期間被重新排入的項目會跳過）"""
+        conn = self._connect()
+        limiters = (RateLimiter(CONTENT_INDEX_FILES_PER_SEC), RateLimiter(CONTENT_INDEX_BYTES_PER_SEC))
+        while True:
+            rows = conn.execute('SELECT path, queued_at FROM pending ORDER BY queued_at LIMIT 100').fetchall()
+            if not rows:
+                break
+            for row in rows:
+                with conn:
+                    claimed = conn.execute('DELETE FROM pending WHERE path = ? AND queued_at = ?',
+                                           (row['path'], row['queued_at'])).rowcount
+                if claimed:
+                    self._index_path(row['path'], limiters)
+
+    def reconcile(self):
+        """與磁碟同步：排入新增或變動的檔案，移除已不存在的項目"""
+        conn = self._connect()
+        indexed = {row['path']: (row['size'], row['mtime_ns'])
+                   for row in conn.execute('SELECT path, size, mtime_ns FROM docs')}
+        changed = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for name in filenames:
+                if name.startswith('.') or not is_content_indexable(name):
+                    continue
+                rel_path = to_rel_path(os.path.join(dirpath, name))
+                try:
+                    st = os.stat(os.path.join(dirpath, name))
+                except OSError:
+                    continue
+                if indexed.pop(rel_path, None) != (st.st_size, st.st_mtime_ns):
+                    changed.append((rel_path, time.time()))
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO pending (path, queued_at) VALUES (?, ?)', changed)
+            conn.executemany('INSERT OR REPLACE INTO pending (path, queued_at) VALUES (?, ?)',
+                             [(path, time.time()) for path in indexed])  # 已不存在，處理時移除
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('reconciled_at', ?)",
+                         (datetime.now().isoformat(),))
+        if changed or indexed:
+            app.logger.debug(f'內容索引同步：{len(changed)} 個檔案待更新，{len(indexed)} 個已移除')
+
+    def _run(self, interval):
+        while True:
+            try:
+                row = self._connect().execute("SELECT value FROM meta WHERE key = 'reconciled_at'").fetchone()
+                age = (datetime.now() - datetime.fromisoformat(row['value'])).total_seconds() if row else None
+                if age is None or age >= interval:
+                    self.reconcile()
+                self.process_pending()
+            except Exception as e:
+                app.logger.error(f'內容索引更新失敗: {str(e)}', exc_info=True)
+            self._event.wait(min(interval, 60))
+            self._event.clear()
+
+    def start(self, interval=CONTENT_INDEX_RECONCILE_INTERVAL):
+        if self.available and self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(interval,), name='content-index', daemon=True)
+            self._thread.start()
+
+content_index = ContentIndex(os.path.join(UPLOAD_FOLDER, 'user'), CONTENT_DB_FILE)
+
+class HashCache:
+    """檔案雜湊快取：以 (裝置, inode) 為鍵，大小與修改時間不同即視為失效"""
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS hashes (
+            dev INTEGER NOT NULL,
+            ino INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            partial TEXT,
+            full TEXT,
+            seen_at REAL NOT NULL,
+            PRIMARY KEY (dev, ino)
+        );
+    '''
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def lookup(self, files):
+        """files 為 {(dev, ino): (路徑, 大小, mtime_ns)}，回傳仍有效的 {(dev, ino): (partial, full)}"""
+        conn = self._connect()
+        found = {}
+        keys = list(files)
+        for i in range(0, len(keys), 400):
+            chunk = keys[i:i + 400]
+            clause = ' OR '.join(['(dev = ? AND ino = ?)'] * len(chunk))
+            for row in conn.execute(f'SELECT * FROM hashes WHERE {clause}', [v for key in chunk for v in key]):
+                key = (row['dev'], row['ino'])
+                _, size, mtime_ns = files[key]
+                if row['size'] == size and row['mtime_ns'] == mtime_ns:
+                    found[key] = (row['partial'], row['full'])
+        return found
+
+    def store(self, rows):
+        """rows 為 [(dev, ino, 大小, mtime_ns, partial, full)]"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO hashes (dev, ino, size, mtime_ns, partial, full, seen_at) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?)', [(*row, now) for row in rows])
+
+    def prune(self):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM hashes WHERE seen_at < ?', (time.time() - HASH_CACHE_RETENTION_DAYS * 86400,))
+
+hash_cache = HashCache(HASH_CACHE_FILE)
+
+class IntegrityCatalog:
+    """資料完整性目錄：記錄每個檔案寫入時的 SHA-256，背景執行緒以限速方式重新讀取並比對，
+    優先檢查最久未驗證的檔案；進度逐筆存在 SQLite，重新啟動後從中斷處繼續"""
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS checksums (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            sha256 TEXT,
+            recorded_at REAL NOT NULL,
+            verified_at REAL,
+            status TEXT NOT NULL DEFAULT 'ok',
+            actual_sha256 TEXT,
+            detected_at REAL,
+            claimed_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_checksums_verified ON checksums (verified_at);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    '''
+
+    def __init__(self, root, db_file):
+        self.root = root
+        self.db_file = db_file
+        self._local = threading.local()
+        self._event = threading.Event()
+        self._thread = None
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _scope(rel_path):
+        """子樹條件（根目錄即全部）"""
+        if not rel_path:
+            return '1', ()
+        return '(path = ? OR (path >= ? AND path < ?))', (rel_path, *subtree_bounds(rel_path))
+
+    def record(self, rel_path, digest=None):
+        """記錄寫入後的檔案；未提供雜湊時留空，由背景執行緒優先建立基準"""
+        rel_path = normalize_rel_path(rel_path)
+        try:
+            st = os.stat(os.path.join(self.root, rel_path))
+        except OSError:
+            return
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO checksums (path, size, mtime_ns, sha256, recorded_at, verified_at) '
+                         'VALUES (?, ?, ?, ?, ?, ?)',
+                         (rel_path, st.st_size, st.st_mtime_ns, digest, now, now if digest else None))
+        if not digest:
+            self._event.set()
+
+    def add_tree(self, rel_path):
+        """納入整個資料夾子樹（複製、還原），雜湊留待背景建立"""
+        rel_path = normalize_rel_path(rel_path)
+        rows = []
+        now = time.time()
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.root, rel_path)):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for name in filenames:
+                if name.startswith('.'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(dirpath, name))
+                except OSError:
+                    continue
+                rows.append((to_rel_path(os.path.join(dirpath, name)), st.st_size, st.st_mtime_ns, now))
+        with self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO checksums (path, size, mtime_ns, recorded_at) '
+                             'VALUES (?, ?, ?, ?)', rows)
+        if rows:
+            self._event.set()
+
+    def remove(self, rel_path):
+        """移除一筆（資料夾連同子樹）"""
+        clause, params = self._scope(normalize_rel_path(rel_path))
+        with self._connect() as conn:
+            conn.execute(f'DELETE FROM checksums WHERE {clause}', params)
+
+    def move(self, old_path, new_path):
+        """搬移或重新命名（資料夾連同子樹），內容不變所以沿用原雜湊"""
+        old_path = normalize_rel_path(old_path)
+        new_path = normalize_rel_path(new_path)
+        self.remove(new_path)
+        clause, params = self._scope(old_path)
+        with self._connect() as conn:
+            conn.execute(f'UPDATE checksums SET path = ? || substr(path, ?) WHERE {clause}',
+                         (new_path, len(old_path) + 1, *params))
+
+    def reverify(self, rel_path=''):
+        """將檔案或資料夾子樹排到最優先重新檢查"""
+        clause, params = self._scope(normalize_rel_path(rel_path))
+        with self._connect() as conn:
+            count = conn.execute(f'UPDATE checksums SET verified_at = NULL WHERE {clause}', params).rowcount
+        self._event.set()
+        return count
+
+    def accept(self, rel_path):
+        """確認目前內容正確（例如已由備份還原），以重新讀取的雜湊作為新基準"""
+        with self._connect() as conn:
+            return conn.execute("UPDATE checksums SET sha256 = actual_sha256, status = 'ok', actual_sha256 = NULL, "
+                                "detected_at = NULL, verified_at = ? WHERE path = ? AND status = 'mismatch'",
+                                (time.time(), normalize_rel_path(rel_path))).rowcount
+
+    def summary(self):
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT COUNT(*) AS files, COALESCE(SUM(size), 0) AS bytes, "
+            "SUM(sha256 IS NULL) AS pending, SUM(status = 'mismatch') AS mismatches, "
+            "MIN(verified_at) AS oldest_verified FROM checksums").fetchone()
+        due = conn.execute('SELECT COUNT(*) FROM checksums WHERE verified_at IS NULL OR verified_at < ?',
+                           (time.time() - SCRUB_VERIFY_INTERVAL_DAYS * 86400,)).fetchone()[0]
+        return {
+            'files': row['files'],
+            'bytes': row['bytes'],
+            'pending_baseline': row['pending'] or 0,
+            'mismatches': row['mismatches'] or 0,
+            'due': due,
+            'oldest_verified': format_mtime(row['oldest_verified']) if row['oldest_verified'] else None
+        }
+
+    def mismatches(self, limit=1000):
+        return self._connect().execute(
+            "SELECT path, size, sha256, actual_sha256, recorded_at, detected_at FROM checksums "
+            "WHERE status = 'mismatch' ORDER BY detected_at DESC LIMIT ?", (limit,)).fetchall()
+
+    def mismatch_count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM checksums WHERE status = 'mismatch'").fetchone()[0]
+
+    @staticmethod
+    def _hash(full_path, limiter):
+        hasher = hashlib.sha256()
+        with open(full_path, 'rb') as f:
+            while True:
+                data = f.read(STREAM_CHUNK_SIZE)
+                if not data:
+                    break
+                limiter.consume(len(data))
+                hasher.update(data)
+        return hasher.hexdigest()
+
+    def _verify(self, row, limiter):
+        """重新讀取一個檔案：大小或修改時間變了是正常修改，更新基準；都沒變而雜湊不同才是資料損毀"""
+        conn = self._connect()
+        full_path = os.path.join(self.root, row['path'])
+        try:
+            st = os.stat(full_path)
+            digest = self._hash(full_path, limiter)
+            after = os.stat(full_path)
+            if (after.st_size, after.st_mtime_ns) != (st.st_size, st.st_mtime_ns):
+                # 讀取期間檔案被修改，雜湊不可信，留待下次檢查
+                with conn:
+                    conn.execute('UPDATE checksums SET claimed_at = NULL WHERE path = ? AND claimed_at = ?',
+                                 (row['path'], row['claimed_at']))
+                return
+        except FileNotFoundError:
+            with conn:
+                conn.execute('DELETE FROM checksums WHERE path = ? AND claimed_at = ?', (row['path'], row['claimed_at']))
+            return
+        except OSError as e:
+            # 讀取錯誤（例如磁碟壞軌）同樣視為損毀
+            app.logger.error(f'完整性檢查無法讀取 {row["path"]}: {str(e)}')
+            digest = None
+        now = time.time()
+        unchanged = digest is not None and (st.st_size, st.st_mtime_ns) == (row['size'], row['mtime_ns'])
+        with conn:
+            if digest is None or (row['sha256'] and unchanged and digest != row['sha256']):
+                app.logger.error(f'完整性檢查發現內容不符: {row["path"]}')
+                conn.execute("UPDATE checksums SET status = 'mismatch', actual_sha256 = ?, detected_at = ?, "
+                             "verified_at = ?, claimed_at = NULL WHERE path = ? AND claimed_at = ?",
+                             (digest, now, now, row['path'], row['claimed_at']))
+            else:
+                conn.execute("UPDATE checksums SET size = ?, mtime_ns = ?, sha256 = ?, status = 'ok', "
+                             "actual_sha256 = NULL, detected_at = NULL, verified_at = ?, claimed_at = NULL "
+                             "WHERE path = ? AND claimed_at = ?",
+                             (st.st_size, st.st_mtime_ns, digest, now, row['path'], row['claimed_at']))
+
+    def scrub(self):
+        """檢查到期的檔案（從未驗證的優先，其餘依上次驗證時間），逐筆認領以便多個程序同時執行"""
+        conn = self._connect()
+        limiter = RateLimiter(SCRUB_BYTES_PER_SEC)
+        checked = 0
+        while True:
+            now = time.time()
+            rows = conn.execute(
+                'SELECT path FROM checksums WHERE (verified_at IS NULL OR verified_at < ?) '
+                'AND (claimed_at IS NULL OR claimed_at < ?) '
+                'ORDER BY verified_at IS NOT NULL, verified_at LIMIT 100',
+                (now - SCRUB_VERIFY_INTERVAL_DAYS * 86400, now - SCRUB_CLAIM_TIMEOUT)).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                claimed_at = time.time()
+                with conn:
+                    claimed = conn.execute('UPDATE checksums SET claimed_at = ? WHERE path = ? '
+                                           'AND (claimed_at IS NULL OR claimed_at < ?)',
+                                           (claimed_at, row['path'], claimed_at - SCRUB_CLAIM_TIMEOUT)).rowcount
+                if not claimed:
+                    continue
+                row = conn.execute('SELECT * FROM checksums WHERE path = ?', (row['path'],)).fetchone()
+                if row is not None:
+                    self._verify(row, limiter)
+                    checked += 1
+        if checked:
+            app.logger.info(f'完整性檢查完成：{checked} 個檔案')
+
+    def reconcile(self):
+        """與磁碟同步：納入應用程式以外新增的檔案，移除已不存在的項目"""
+        conn = self._connect()
+        known = {row['path'] for row in conn.execute('SELECT path FROM checksums')}
+        added = []
+        now = time.time()
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for name in filenames:
+                if name.startswith('.'):
+                    continue
+                rel_path = to_rel_path(os.path.join(dirpath, name))
+                if rel_path in known:
+                    known.discard(rel_path)
+                    continue
+                try:
+                    st = os.stat(os.path.join(dirpath, name))
+                except OSError:
+                    continue
+                added.append((rel_path, st.st_size, st.st_mtime_ns, now))
+        with conn:
+            conn.executemany('INSERT OR IGNORE INTO checksums (path, size, mtime_ns, recorded_at) '
+                             'VALUES (?, ?, ?, ?)', added)
+            conn.executemany('DELETE FROM checksums WHERE path = ?', [(path,) for path in known])
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('reconciled_at', ?)",
+                         (datetime.now().isoformat(),))
+        if added or known:
+            app.logger.debug(f'完整性目錄同步：新增 {len(added)} 個檔案，移除 {len(known)} 個')
+
+    def _run(self, interval):
+        while True:
+            try:
+                row = self._connect().execute("SELECT value FROM meta WHERE key = 'reconciled_at'").fetchone()
+                age = (datetime.now() - datetime.fromisoformat(row['value'])).total_seconds() if row else None
+                if age is None or age >= SCRUB_RECONCILE_INTERVAL:
+                    self.reconcile()
+                self.scrub()
+            except Exception as e:
+                app.logger.error(f'完整性檢查失敗: {str(e)}', exc_info=True)
+            self._event.wait(interval)
+            self._event.clear()
+
+    def start(self, interval=SCRUB_IDLE_INTERVAL):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(interval,), name='integrity-scrub', daemon=True)
+            self._thread.start()
+
+integrity_catalog = IntegrityCatalog(os.path.join(UPLOAD_FOLDER, 'user'), INTEGRITY_DB_FILE)
+
+def hash_in_pool(executor, func, items, ctx, message, known=0):
+    """以程序池計算雜湊並回報進度，items 為 {鍵: 參數}，回傳 {鍵: 雜湊}（讀取失敗的檔案略過）；
+    known 為本階段已由快取取得、不需計算的數量，一併計入進度"""
+    results = {}
+    total = known + len(items)
+    ctx.progress(known, total, message)
+    futures = {executor.submit(func, *args): key for key, args in items.items()}
+    for done, future in enumerate(as_completed(futures), known + 1):
+        try:
+            results[futures[future]] = future.result()
+        except OSError:
+            pass  # 檔案在分析期間被刪除或無法讀取
+        ctx.progress(done)
+    ctx.progress(total, total, message)
+    return results
+
+@job_manager.register('duplicates')
+def job_duplicates(ctx):
+    """重複檔案分析：單次走訪依大小分組 → 比對檔頭檔尾雜湊 → 只對剩下的檔案計算完整雜湊；
+    同一個 inode 的硬連結（已共用儲存）視為同一份內容"""
+    scope = normalize_rel_path(ctx.params.get('path', ''))
+    min_size = max(1, int(ctx.params.get('min_size', 1)))
+    root = resolve_user_path(scope)
+    
+    # 1. 走訪並依大小分組
+    ctx.progress(0, 0, '掃描檔案')
+    by_size = {}
+    scanned = 0
+    stack = [root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            scanned += 1
+            if st.st_size >= min_size:
+                by_size.setdefault(st.st_size, []).append((to_rel_path(entry.path), st.st_dev, st.st_ino,
+                                                           st.st_mtime_ns))
+        ctx.progress(scanned)
+    
+    # 每個 inode 只需計算一次
+    inodes = {}  # (dev, ino) -> (路徑, 大小, mtime_ns)
+    paths_by_inode = {}
+    for size, files in by_size.items():
+        if len({(dev, ino) for _, dev, ino, _ in files}) < 2:
+            continue
+        for rel_path, dev, ino, mtime_ns in files:
+            inodes.setdefault((dev, ino), (resolve_user_path(rel_path), size, mtime_ns))
+            paths_by_inode.setdefault((dev, ino), []).append(rel_path)
+    
+    cached = hash_cache.lookup(inodes)
+    partial = {key: value[0] for key, value in cached.items() if value[0]}
+    full = {key: value[1] for key, value in cached.items() if value[1]}
+    
+    executor = create_process_pool(DUPLICATE_WORKERS, 'hash')
+    try:
+        # 2. 檔頭檔尾雜湊
+        missing = {key: (path, size, DUPLICATE_PARTIAL_BLOCK) for key, (path, size, _) in inodes.items()
+                   if key not in partial}
+        partial_hashed = len(missing)
+        partial.update(hash_in_pool(executor, partial_hash, missing, ctx, '比對檔頭與檔尾',
+                                    len(inodes) - partial_hashed))
+        
+        groups = {}
+        for key, digest in partial.items():
+            groups.setdefault((inodes[key][1], digest), []).append(key)
+        survivors = [key for keys in groups.values() if len(keys) > 1 for key in keys]
+        
+        # 3. 完整雜湊（小檔案的檔頭檔尾雜湊已涵蓋全部內容）
+        for key in survivors:
+            if inodes[key][1] <= 2 * DUPLICATE_PARTIAL_BLOCK:
+                full[key] = partial[key]
+        missing = {key: (inodes[key][0],) for key in survivors if key not in full}
+        full_hashed = len(missing)
+        full.update(hash_in_pool(executor, hash_file, missing, ctx, '計算完整雜湊',
+                                 len(survivors) - full_hashed))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    hash_cache.store([(dev, ino, size, mtime_ns, partial.get((dev, ino)), full.get((dev, ino)))
+                      for (dev, ino), (_, size, mtime_ns) in inodes.items() if (dev, ino) in partial])
+    hash_cache.prune()
+    
+    by_digest = {}
+    for key in survivors:
+        if key in full:
+            by_digest.setdefault((inodes[key][1], full[key]), []).append(key)
+    result_groups = []
+    for (size, digest), keys in by_digest.items():
+        if len(keys) < 2:
+            continue
+        reclaimable = size * (len(keys) - 1)
+        result_groups.append({
+            'size': size,
+            'size_formatted': format_file_size(size),
+            'sha256': digest,
+            'files': sorted(path for key in keys for path in paths_by_inode[key]),
+            'reclaimable': reclaimable,
+            'reclaimable_formatted': format_file_size(reclaimable)
+        })
+    result_groups.sort(key=lambda group: (-group['reclaimable'], group['files'][0]))
+    total_reclaimable = sum(group['reclaimable'] for group in result_groups)
+    return {
+        'path': scope,
+        'scanned_files': scanned,
+        'candidate_files': len(inodes),
+        'partial_hashed': partial_hashed,
+        'full_hashed': full_hashed,
+        'group_count': len(result_groups),
+        'reclaimable': total_reclaimable,
+        'reclaimable_formatted': format_file_size(total_reclaimable),
+        'groups': result_groups[:DUPLICATE_MAX_GROUPS],
+        'truncated': len(result_groups) > DUPLICATE_MAX_GROUPS
+    }
 
 def get_system_info():
     """獲取系統資訊"""
@@ -162,8 +3456,10 @@ def get_system_info():
     hours, remainder = divmod(uptime.seconds, 3600)
     minutes, _ = divmod(remainder, 60)
     
-    # 計算用戶檔案總大小
-    user_files_size = get_directory_size(os.path.join(UPLOAD_FOLDER, 'user'))
+    # 用戶檔案總大小（由目錄大小索引取得）與去重複後實際佔用空間
+    user_files_size = size_index.total('')
+    physical_size = max(user_files_size - blob_store.saved_bytes, 0)
+    trash_size = trash_bin.total_size()
     
     # 獲取系統儲存資訊
     try:
@@ -175,13 +3471,20 @@ def get_system_info():
         available_bytes = 95 * 1024 * 1024 * 1024  # 95GB 預設
     
     # 計算使用百分比
-    usage_percent = (user_files_size / total_bytes) * 100 if total_bytes > 0 else 0
+    usage_percent = (physical_size / total_bytes) * 100 if total_bytes > 0 else 0
     
     return {
         "uptime": f"{days} 天 {hours} 小時 {minutes} 分鐘",
         "storage": {
             "user_files_size": user_files_size,
             "user_files_formatted": format_file_size(user_files_size),
+            "logical_size": user_files_size,
+            "physical_size": physical_size,
+            "physical_formatted": format_file_size(physical_size),
+            "dedup_saved": blob_store.saved_bytes,
+            "dedup_saved_formatted": format_file_size(blob_store.saved_bytes),
+            "trash_size": trash_size,
+            "trash_formatted": format_file_size(trash_size),
             "total_size": total_bytes,
             "total_formatted": format_file_size(total_bytes),
             "available_size": available_bytes,
@@ -199,18 +3502,6 @@ def allowed_file(filename):
     """檢查檔案類型是否允許"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def get_file_info(filepath):
-    """獲取文件信息"""
-    stat = os.stat(filepath)
-    return {
-        'name': os.path.basename(filepath),
-        'size': stat.st_size,
-        'modified': datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S'),
-        'type': 'folder' if os.path.isdir(filepath) else 'file',
-        'extension': Path(filepath).suffix.lower() if os.path.isfile(filepath) else '',
-        'mime_type': mimetypes.guess_type(filepath)[0] if os.path.isfile(filepath) else None
-    }
-
 def format_file_size(size_bytes):
     """格式化文件大小"""
     if size_bytes == 0:
@@ -222,6 +3513,402 @@ def format_file_size(size_bytes):
         i += 1
     return f"{size_bytes:.1f}{size_names[i]}"
 
+def scan_directory(full_path):
+    """以 os.scandir 列出目錄，回傳 [(名稱, 是否資料夾, 大小, 修改時間)]（略過隱藏檔）"""
+    entries = []
+    with os.scandir(full_path) as it:
+        for entry in it:
+            if entry.name.startswith('.'):  # 隱藏以點開頭的文件
+                continue
+            try:
+                is_dir = entry.is_dir()
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append((entry.name, is_dir, st.st_size, st.st_mtime))
+    return entries
+
+def list_directory(rel_path, full_path):
+    """列出目錄內容，資料夾大小由目錄大小索引取得"""
+    entries = []
+    for name, is_dir, size, mtime in scan_directory(full_path):
+        if is_dir:
+            size = size_index.total(f'{rel_path}/{name}' if rel_path else name)
+        entries.append((name, is_dir, size, mtime))
+    return entries
+
+def filter_listing(entries, item_type=None, extensions=None):
+    """依類型（file/folder）與副檔名（逗號分隔）篩選"""
+    if item_type in ('file', 'folder'):
+        want_dir = item_type == 'folder'
+        entries = [e for e in entries if e[1] == want_dir]
+    if extensions:
+        exts = {'.' + ext.strip().lower().lstrip('.') for ext in extensions.split(',') if ext.strip()}
+        entries = [e for e in entries if not e[1] and os.path.splitext(e[0])[1].lower() in exts]
+    return entries
+
+def listing_sort_key(entry, sort):
+    """排序鍵：資料夾在前，接著依指定欄位，再以名稱決定順序"""
+    name, is_dir, size, mtime = entry
+    if sort == 'size':
+        value = size
+    elif sort == 'modified':
+        value = mtime
+    elif sort == 'type':
+        value = '' if is_dir else os.path.splitext(name)[1].lower()
+    else:
+        value = name.lower()
+    return (0 if is_dir else 1, value, name.lower(), name)
+
+def paginate_listing(entries, sort='name', order='asc', cursor=None, limit=None):
+    """排序後從游標之後切出一頁，回傳 (該頁項目, 最後一筆的排序鍵或 None)"""
+    groups = ([], [])  # 資料夾、檔案分開排序，降冪時資料夾仍在前
+    for entry in entries:
+        key = listing_sort_key(entry, sort)
+        groups[key[0]].append((key, entry))
+    for group in groups:
+        group.sort(key=lambda item: item[0])
+    if order == 'desc':
+        ordered = groups[0][::-1] + groups[1][::-1]
+    else:
+        ordered = groups[0] + groups[1]
+    
+    start = 0
+    if cursor is not None:
+        group = groups[cursor[0]]
+        offset = 0 if cursor[0] == 0 else len(groups[0])
+        if order == 'desc':
+            start = offset + len(group) - bisect.bisect_left(group, cursor, key=lambda item: item[0])
+        else:
+            start = offset + bisect.bisect_right(group, cursor, key=lambda item: item[0])
+    
+    end = len(ordered) if limit is None else start + limit
+    page = ordered[start:end]
+    next_key = page[-1][0] if page and end < len(ordered) else None
+    return [entry for _, entry in page], next_key
+
+def encode_listing_cursor(key, sort, order):
+    """將排序鍵編碼為游標字串"""
+    raw = json.dumps({'s': sort, 'o': order, 'k': list(key)}, ensure_ascii=False)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_listing_cursor(cursor, sort, order):
+    """解析游標，排序方式不符或格式錯誤時回傳 None"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        key = tuple(data['k'])
+        if data['s'] != sort or data['o'] != order or len(key) != 4 or key[0] not in (0, 1):
+            return None
+        if not isinstance(key[1], str if sort in ('name', 'type') else (int, float)):
+            return None
+        if not isinstance(key[2], str) or not isinstance(key[3], str):
+            return None
+        return key
+    except (ValueError, KeyError, TypeError):
+        return None
+
+def format_mtime(mtime):
+    """列表顯示用的修改時間（縮圖網址的版本參數也用這個格式）"""
+    return datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S')
+
+def format_listing_entry(entry, rel_path):
+    """將列表項目轉為 API 回傳格式"""
+    name, is_dir, size, mtime = entry
+    return {
+        'name': name,
+        'size': size,
+        'modified': format_mtime(mtime),
+        'type': 'folder' if is_dir else 'file',
+        'extension': '' if is_dir else os.path.splitext(name)[1].lower(),
+        'mime_type': None if is_dir else mimetypes.guess_type(name)[0],
+        'path': f'{rel_path}/{name}' if rel_path else name,
+        'size_formatted': '' if is_dir else format_file_size(size)
+    }
+
+def listing_entry(rel_path):
+    """單一項目的列表格式（與 /api/files 相同），不存在時回傳 None"""
+    full_path = resolve_user_path(rel_path)
+    try:
+        st = os.stat(full_path)
+    except (OSError, TypeError):
+        return None
+    rel_dir, _, name = normalize_rel_path(rel_path).rpartition('/')
+    is_dir = os.path.isdir(full_path)
+    size = size_index.total(normalize_rel_path(rel_path)) if is_dir else st.st_size
+    return format_listing_entry((name, is_dir, size, st.st_mtime), rel_dir)
+
+def resolve_user_path(rel_path):
+    """將相對路徑轉為 data/user 下的絕對路徑，超出範圍時回傳 None"""
+    root = os.path.abspath(os.path.join(UPLOAD_FOLDER, 'user'))
+    full_path = os.path.abspath(os.path.join(root, normalize_rel_path(rel_path)))
+    if full_path != root and not full_path.startswith(root + os.sep):
+        return None
+    return full_path
+
+def content_disposition(filename, as_attachment=False):
+    """產生支援中文檔名的 Content-Disposition 標頭"""
+    disposition = 'attachment' if as_attachment else 'inline'
+    return f"{disposition}; filename*=UTF-8''{quote(filename)}"
+
+class FileRangeReader:
+    """檔案 [start, end) 區段：read() 不會超出區段；保留 fileno()，伺服器可直接以 sendfile 傳送"""
+
+    def __init__(self, file_path, start, end):
+        self._file = open(file_path, 'rb')
+        self._file.seek(start)
+        self._remaining = end - start
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def close(self):
+        self._file.close()
+
+def file_range_response(file_path, start, end, status, headers, mimetype):
+    """以 wsgi.file_wrapper 回應檔案區段（gunicorn 等伺服器會改用 sendfile 零複製傳送）"""
+    headers['Content-Length'] = str(end - start)
+    body = wrap_file(request.environ, FileRangeReader(file_path, start, end), STREAM_CHUNK_SIZE)
+    return Response(body, status, headers=headers, mimetype=mimetype, direct_passthrough=True)
+
+def offload_response(file_path, headers, mimetype):
+    """交由前端反向代理傳送檔案內容（nginx: X-Accel-Redirect；Apache/lighttpd: X-Sendfile）"""
+    mode = app.config.get('DOWNLOAD_OFFLOAD')
+    if mode == 'nginx':
+        root = os.path.abspath(os.path.join(UPLOAD_FOLDER, 'user'))
+        rel_path = os.path.relpath(os.path.abspath(file_path), root).replace(os.sep, '/')
+        prefix = app.config.get('DOWNLOAD_OFFLOAD_PREFIX', '/protected/').rstrip('/')
+        headers['X-Accel-Redirect'] = f'{prefix}/{quote(rel_path)}'
+    else:
+        headers['X-Sendfile'] = os.path.abspath(file_path)
+    metrics.inc('hnas_download_offloaded_total', (('mode', mode),))
+    return Response(b'', 200, headers=headers, mimetype=mimetype)
+
+def file_etag(st):
+    """由 inode、修改時間與大小產生強驗證 ETag（內容改變或被替換時必定不同）"""
+    return f'{st.st_ino:x}-{st.st_mtime_ns:x}-{st.st_size:x}'
+
+def cache_policy(mime_type, as_attachment=False):
+    """依內容類型選擇 Cache-Control"""
+    if as_attachment:
+        return CACHE_POLICIES['attachment']
+    if mime_type.startswith(('video/', 'audio/')):
+        return CACHE_POLICIES['media']
+    return CACHE_POLICIES['document']
+
+def evaluate_preconditions(etag, mtime):
+    """依 RFC 9110 順序檢查條件式請求標頭，回傳 304、412 或 None（照常回應）"""
+    last_modified = int(mtime)
+    if request.if_match:
+        if not request.if_match.contains(etag):  # If-Match 需強比對
+            return 412
+    elif request.if_unmodified_since and last_modified > request.if_unmodified_since.timestamp():
+        return 412
+    
+    if request.if_none_match:
+        if request.if_none_match.contains_weak(etag):
+            return 304 if request.method in ('GET', 'HEAD') else 412
+    elif request.method in ('GET', 'HEAD') and request.if_modified_since \
+            and last_modified <= request.if_modified_since.timestamp():
+        return 304
+    return None
+
+def if_range_matches(etag, mtime):
+    """If-Range 驗證：不符時忽略 Range，改回傳整個檔案"""
+    # If-Range 只接受強驗證；werkzeug 解析後已去掉 W/，需檢查原始標頭
+    if request.headers.get('If-Range', '').lstrip().startswith('W/'):
+        return False
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return int(mtime) == if_range.date.timestamp()
+    return True
+
+def send_user_file(file_path, as_attachment=False):
+    """傳送使用者檔案（下載與串流共用）：權限與路徑已由呼叫端檢查。
+    帶有 ETag/Last-Modified 並處理條件式請求；設定 DOWNLOAD_OFFLOAD 時交由反向代理傳送，
+    否則以 sendfile 友善的方式回應並支援 Range"""
+    st = os.stat(file_path)
+    file_size = st.st_size
+    mime_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+    etag = file_etag(st)
+    validators = {
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(int(st.st_mtime)),
+        'Cache-Control': cache_policy(mime_type, as_attachment)
+    }
+    
+    status = evaluate_preconditions(etag, st.st_mtime)
+    if status is not None:
+        return Response(status=status, headers=validators)
+    
+    headers = dict(validators)
+    headers['Accept-Ranges'] = 'bytes'
+    headers['Content-Disposition'] = content_disposition(os.path.basename(file_path), as_attachment)
+    if app.config.get('DOWNLOAD_OFFLOAD'):
+        return offload_response(file_path, headers, mime_type)
+    return build_range_response(file_path, file_size, headers, mime_type,
+                                use_range=if_range_matches(etag, st.st_mtime))
+
+def build_range_response(file_path, file_size, headers, mime_type, use_range=True):
+    """依 Range 標頭回應整個檔案、單一區段（206）或多區段（multipart/byteranges）"""
+    range_header = request.range if use_range else None
+    if range_header is None or range_header.units != 'bytes':
+        return file_range_response(file_path, 0, file_size, 200, headers, mime_type)
+    
+    ranges = resolve_byte_ranges(range_header, file_size)
+    if not ranges:
+        headers['Content-Range'] = f'bytes */{file_size}'
+        return Response(status=416, headers=headers)
+    
+    # 單一區段
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers['Content-Range'] = f'bytes {start}-{end - 1}/{file_size}'
+        return file_range_response(file_path, start, end, 206, headers, mime_type)
+    
+    # 多區段：multipart/byteranges
+    boundary = uuid.uuid4().hex
+    parts = []
+    content_length = 0
+    for start, end in ranges:
+        part_header = (f'\r\n--{boundary}\r\n'
+                       f'Content-Type: {mime_type}\r\n'
+                       f'Content-Range: bytes {start}-{end - 1}/{file_size}\r\n\r\n').encode('ascii')
+        parts.append((part_header, start, end))
+        content_length += len(part_header) + (end - start)
+    closing = f'\r\n--{boundary}--\r\n'.encode('ascii')
+    headers['Content-Length'] = str(content_length + len(closing))
+    
+    def generate():
+        yield from iter_multipart_ranges(file_path, parts)
+        yield closing
+    
+    return Response(generate(), 206, headers=headers,
+                    content_type=f'multipart/byteranges; boundary={boundary}', direct_passthrough=True)
+
+def iter_file_range(file_path, start, end, chunk_size=STREAM_CHUNK_SIZE):
+    """逐塊讀取檔案 [start, end) 區段"""
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = f.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+def merge_ranges(ranges):
+    """排序並合併重疊或相鄰的 [(start, end)] 區段"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def resolve_byte_ranges(range_header, file_size):
+    """將 Range 標頭轉為排序、合併後的 [(start, end)] 清單（end 不含）"""
+    ranges = []
+    for start, stop in range_header.ranges[:MAX_STREAM_RANGES]:
+        if start < 0:
+            start, stop = max(file_size + start, 0), file_size
+        else:
+            stop = file_size if stop is None else min(stop, file_size)
+        if start < stop:
+            ranges.append((start, stop))
+    return merge_ranges(ranges)
+
+def iter_multipart_ranges(file_path, parts):
+    """產生 multipart/byteranges 內容"""
+    for header, start, end in parts:
+        yield header
+        yield from iter_file_range(file_path, start, end)
+
+class ZipStreamBuffer:
+    """供 zipfile 寫入的不可 seek 緩衝區，產生器每次取出已寫入的資料"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def iter_archive_entries(full_paths):
+    """列出要放進壓縮檔的 (絕對路徑, 壓縮檔內名稱, 是否資料夾)，以各項目的上層為基準"""
+    for full_path in full_paths:
+        base = os.path.dirname(full_path)
+        if not os.path.isdir(full_path):
+            yield full_path, os.path.basename(full_path), False
+            continue
+        for dirpath, dirnames, filenames in os.walk(full_path):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+            arc_dir = os.path.relpath(dirpath, base).replace(os.sep, '/')
+            yield dirpath, arc_dir, True
+            for name in sorted(filenames):
+                if not name.startswith('.'):
+                    yield os.path.join(dirpath, name), f'{arc_dir}/{name}', False
+
+def generate_zip_stream(full_paths, compression=zipfile.ZIP_STORED):
+    """邊讀檔邊產生 ZIP（支援 ZIP64），記憶體用量固定"""
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=compression, allowZip64=True) as zf:
+        for full_path, arcname, is_dir in iter_archive_entries(full_paths):
+            # 只有在寫出檔頭之前失敗（檔案消失、無權限）才略過；之後的錯誤會讓回應中止，
+            # 避免送出缺了資料卻看似完整的壓縮檔
+            try:
+                zinfo = zipfile.ZipInfo.from_file(full_path, arcname)
+                src = None if is_dir else open(full_path, 'rb')
+            except OSError as e:
+                app.logger.warning(f'壓縮時略過 {arcname}: {str(e)}')
+                continue
+            if src is None:
+                zf.writestr(zinfo, b'')
+            else:
+                zinfo.compress_type = compression
+                with src, zf.open(zinfo, 'w') as dst:
+                    while True:
+                        data = src.read(STREAM_CHUNK_SIZE)
+                        if not data:
+                            break
+                        dst.write(data)
+                        chunk = buffer.drain()
+                        if chunk:
+                            yield chunk
+            chunk = buffer.drain()
+            if chunk:
+                yield chunk
+    yield buffer.drain()
+
 # Flask 路由開始
 @app.route('/')
 def index():
@@ -276,35 +3963,110 @@ def about():
 # API 路由
 @app.route('/api/files')
 def api_files():
-    """獲取文件列表API"""
+    """獲取文件列表API（支援排序、篩選與游標分頁）"""
     if 'username' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
     
-    path = request.args.get('path', '')
-    full_path = os.path.join(UPLOAD_FOLDER, 'user', path)
+    path = normalize_rel_path(request.args.get('path', ''))
+    full_path = resolve_user_path(path)
     
-    if not os.path.exists(full_path):
+    if not full_path or not os.path.isdir(full_path):
         return jsonify({'error': 'Path not found'}), 404
     
-    files = []
+    sort = request.args.get('sort', 'name')
+    order = request.args.get('order', 'asc')
+    if sort not in LISTING_SORT_FIELDS or order not in ('asc', 'desc'):
+        return jsonify({'error': '無效的排序參數'}), 400
+    
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, min(limit, MAX_LISTING_PAGE_SIZE))
+    
+    cursor = None
+    if request.args.get('cursor'):
+        cursor = decode_listing_cursor(request.args['cursor'], sort, order)
+        if cursor is None:
+            return jsonify({'error': '無效的游標'}), 400
+    
     try:
-        for item in os.listdir(full_path):
-            item_path = os.path.join(full_path, item)
-            if not item.startswith('.'):  # 隱藏以點開頭的文件
-                file_info = get_file_info(item_path)
-                file_info['path'] = os.path.join(path, item).replace('\\', '/')
-                file_info['size_formatted'] = format_file_size(file_info['size']) if file_info['type'] == 'file' else ''
-                files.append(file_info)
+        entries, listing_etag = listing_cache.get(path, full_path)
     except PermissionError:
         return jsonify({'error': 'Permission denied'}), 403
     
-    # 排序：文件夾在前，然後按名稱排序
-    files.sort(key=lambda x: (x['type'] == 'file', x['name'].lower()))
+    # 同一份列表、同樣的查詢參數 -> 同一個 ETag
+    etag = hashlib.sha1(f'{listing_etag}?'.encode() + request.query_string).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        entries = filter_listing(entries, request.args.get('type'), request.args.get('ext'))
+        metrics.observe('hnas_listing_entries', (), len(entries))
+        page, next_key = paginate_listing(entries, sort, order, cursor, limit)
+        response = jsonify({
+            'files': [format_listing_entry(entry, path) for entry in page],
+            'current_path': path,
+            'total': len(entries),
+            'next_cursor': encode_listing_cursor(next_key, sort, order) if next_key else None
+        })
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def format_sse(event_id, event):
+    """Server-Sent Events 訊息格式"""
+    lines = f'id: {event_id}\n' if event_id else ''
+    return f'{lines}data: {json.dumps(event, ensure_ascii=False)}\n\n'
+
+event_stream_slots = threading.BoundedSemaphore(CHANGE_FEED_MAX_STREAMS)
+
+@app.route('/api/events')
+def api_events():
+    """目錄變動事件串流（Server-Sent Events），可用多個 path 參數同時訂閱數個目錄"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    paths = [normalize_rel_path(p) for p in request.args.getlist('path')] or ['']
+    for path in paths:
+        full_path = resolve_user_path(path)
+        if not full_path or not os.path.isdir(full_path):
+            return jsonify({'error': 'Path not found'}), 404
+    
+    if not event_stream_slots.acquire(blocking=False):
+        # 串流已滿：用戶端改以重新載入列表取得變動，稍後再重試
+        response = Response(f'retry: {CHANGE_FEED_BUSY_RETRY * 1000}\n\n', 503, mimetype='text/event-stream')
+        response.headers['Retry-After'] = str(CHANGE_FEED_BUSY_RETRY)
+        return response
     
-    return jsonify({
-        'files': files,
-        'current_path': path
-    })
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        sub, backlog, complete = change_feed.subscribe(set(paths), last_event_id)
+    except BaseException:
+        event_stream_slots.release()
+        raise
+    
+    def generate():
+        yield f'retry: {CHANGE_FEED_RETRY_MS}\n\n'
+        if not complete:
+            yield format_sse(None, {'type': 'reset', 'dir': None})
+        for event_id, event in backlog:
+            yield format_sse(event_id, event)
+        while True:
+            events, overflowed = sub.wait(CHANGE_FEED_HEARTBEAT)
+            if overflowed:
+                yield format_sse(None, {'type': 'reset', 'dir': None})
+            elif not events:
+                yield ': ping\n\n'  # 心跳：保持連線並偵測用戶端離線
+            for event_id, event in events:
+                yield format_sse(event_id, event)
+    
+    def close():
+        change_feed.unsubscribe(sub)
+        event_stream_slots.release()
+    
+    response = Response(generate(), mimetype='text/event-stream')
+    response.call_on_close(close)
+    response.headers['Cache-Control'] = 'no-cache, no-transform'
+    response.headers['X-Accel-Buffering'] = 'no'  # 停用 nginx 緩衝
+    return response
 
 @app.route('/api/upload', methods=['POST'])
 def api_upload():
@@ -316,23 +4078,328 @@ def api_upload():
         return jsonify({'error': 'No file provided'}), 400
     
     file = request.files['file']
-    path = request.form.get('path', '')
+    path = normalize_rel_path(request.form.get('path', ''))
     
     if file.filename == '':
         return jsonify({'error': 'No file selected'}), 400
     
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
-        upload_path = os.path.join(UPLOAD_FOLDER, 'user', path)
+        upload_path = resolve_user_path(path)
+        if not filename or not upload_path:
+            return jsonify({'error': '無效的路徑'}), 400
         os.makedirs(upload_path, exist_ok=True)
         
         file_path = os.path.join(upload_path, filename)
-        file.save(file_path)
+        old_size = os.path.getsize(file_path) if os.path.isfile(file_path) else 0
+        # 先寫暫存檔再替換，避免原地覆寫到共用內容；寫入時同時計算雜湊供完整性檢查
+        _, digest = ingest_stream(file.stream, file_path)
+        
+        # 更新目錄大小索引、列表快取與搜尋索引
+        record_file_written(os.path.join(path, filename), old_size, digest)
         
         return jsonify({'message': 'File uploaded successfully', 'filename': filename})
     
     return jsonify({'error': 'File type not allowed'}), 400
 
+def ingest_stream(stream, target_path, length=None, expected_sha256=None):
+    """將請求內容直接寫入目標目錄下的暫存檔並同時計算 SHA-256，完成後原子替換，回傳 (大小, 雜湊)"""
+    tmp_path = os.path.join(os.path.dirname(target_path),
+                            f'.{os.path.basename(target_path)}.{uuid.uuid4().hex}.part')
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as f:
+            while True:
+                data = stream.read(STREAM_CHUNK_SIZE)
+                if not data:
+                    break
+                hasher.update(data)
+                f.write(data)
+                size += len(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if length is not None and size != length:
+            raise ValueError('上傳資料不完整')
+        digest = hasher.hexdigest()
+        if expected_sha256 and expected_sha256.lower() != digest:
+            raise ValueError('檔案雜湊不符')
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return size, digest
+
+@app.route('/api/upload_stream', methods=['PUT'])
+def api_upload_stream():
+    """串流上傳API（請求內容即檔案本體，不經過 multipart 暫存）"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    original_name = request.args.get('filename', '')
+    path = normalize_rel_path(request.args.get('path', ''))
+    
+    if not original_name:
+        return jsonify({'error': 'No file selected'}), 400
+    if not allowed_file(original_name):
+        return jsonify({'error': 'File type not allowed'}), 400
+    
+    filename = secure_filename(original_name)
+    upload_path = resolve_user_path(path)
+    if not filename or not upload_path:
+        return jsonify({'error': '無效的路徑'}), 400
+    os.makedirs(upload_path, exist_ok=True)
+    
+    file_path = os.path.join(upload_path, filename)
+    old_size = os.path.getsize(file_path) if os.path.isfile(file_path) else 0
+    try:
+        size, sha256 = ingest_stream(request.stream, file_path, request.content_length,
+                                     request.headers.get('X-Content-SHA256'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    record_file_written(os.path.join(path, filename), old_size, sha256)
+    
+    return jsonify({'message': 'File uploaded successfully', 'filename': filename,
+                    'size': size, 'sha256': sha256})
+
+def get_upload_session_dir(upload_id):
+    """取得分段上傳暫存目錄，ID 格式不正確時回傳 None"""
+    if not re.fullmatch(r'[0-9a-f]{32}', upload_id or ''):
+        return None
+    return os.path.join(UPLOAD_SESSION_FOLDER, upload_id)
+
+def load_upload_session(upload_id):
+    """讀取分段上傳資訊（僅限建立者本人）"""
+    session_dir = get_upload_session_dir(upload_id)
+    if not session_dir:
+        return None
+    try:
+        with open(os.path.join(session_dir, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('username') != session.get('username'):
+        return None
+    meta['dir'] = session_dir
+    return meta
+
+def read_upload_ranges(session_dir):
+    """讀取已寫入磁碟的區段（ranges.log 每行一筆 start end）"""
+    ranges = []
+    try:
+        with open(os.path.join(session_dir, 'ranges.log'), 'r', encoding='utf-8') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2:
+                    ranges.append((int(parts[0]), int(parts[1])))
+    except FileNotFoundError:
+        pass
+    return merge_ranges(ranges)
+
+def upload_session_status(meta):
+    """分段上傳目前進度"""
+    ranges = read_upload_ranges(meta['dir'])
+    return {
+        'upload_id': meta['upload_id'],
+        'filename': meta['filename'],
+        'path': meta['path'],
+        'size': meta['size'],
+        'chunk_size': meta['chunk_size'],
+        'ranges': [list(r) for r in ranges],
+        'received_bytes': sum(end - start for start, end in ranges)
+    }
+
+def cleanup_upload_sessions():
+    """清除逾期未完成的分段上傳"""
+    try:
+        entries = list(os.scandir(UPLOAD_SESSION_FOLDER))
+    except FileNotFoundError:
+        return
+    now = time.time()
+    for entry in entries:
+        try:
+            last_active = max(os.path.getmtime(os.path.join(entry.path, name))
+                              for name in os.listdir(entry.path))
+        except (OSError, ValueError):
+            last_active = entry.stat().st_mtime
+        if now - last_active > UPLOAD_SESSION_TTL:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+@app.route('/api/upload_session', methods=['POST'])
+def api_upload_session_create():
+    """建立分段上傳（可續傳、可平行上傳區塊）"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    original_name = data.get('filename', '')
+    path = normalize_rel_path(data.get('path', ''))
+    try:
+        size = int(data.get('size', -1))
+    except (TypeError, ValueError):
+        size = -1
+    
+    if not original_name or size < 0:
+        return jsonify({'error': '缺少檔名或檔案大小'}), 400
+    if not allowed_file(original_name):
+        return jsonify({'error': 'File type not allowed'}), 400
+    filename = secure_filename(original_name)
+    if not filename or not resolve_user_path(path):
+        return jsonify({'error': '無效的路徑'}), 400
+    if size > psutil.disk_usage(UPLOAD_FOLDER).free:
+        return jsonify({'error': '儲存空間不足'}), 507
+    
+    cleanup_upload_sessions()
+    
+    upload_id = uuid.uuid4().hex
+    session_dir = os.path.join(UPLOAD_SESSION_FOLDER, upload_id)
+    os.makedirs(session_dir)
+    meta = {
+        'upload_id': upload_id,
+        'username': session['username'],
+        'filename': filename,
+        'path': path,
+        'size': size,
+        'chunk_size': UPLOAD_CHUNK_SIZE,
+        'created_at': datetime.now().isoformat()
+    }
+    # 預先建立稀疏檔，各區塊直接寫入對應位移
+    with open(os.path.join(session_dir, 'data.part'), 'wb') as f:
+        f.truncate(size)
+    with open(os.path.join(session_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    
+    meta['dir'] = session_dir
+    return jsonify(upload_session_status(meta))
+
+@app.route('/api/upload_session/<upload_id>', methods=['GET'])
+def api_upload_session_status(upload_id):
+    """查詢分段上傳已接收的區段"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    meta = load_upload_session(upload_id)
+    if not meta:
+        return jsonify({'error': '上傳工作不存在'}), 404
+    return jsonify(upload_session_status(meta))
+
+@app.route('/api/upload_session/<upload_id>', methods=['PUT'])
+def api_upload_session_chunk(upload_id):
+    """寫入一個區塊（?offset=位移，請求內容為原始位元組）"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    meta = load_upload_session(upload_id)
+    if not meta:
+        return jsonify({'error': '上傳工作不存在'}), 404
+    
+    offset = request.args.get('offset', type=int)
+    length = request.content_length
+    if offset is None or offset < 0 or length is None:
+        return jsonify({'error': '缺少 offset 或 Content-Length'}), 400
+    if length > MAX_UPLOAD_CHUNK_SIZE or offset + length > meta['size']:
+        return jsonify({'error': '區塊超出範圍'}), 400
+    
+    try:
+        fd = os.open(os.path.join(meta['dir'], 'data.part'), os.O_WRONLY)
+    except FileNotFoundError:
+        return jsonify({'error': '上傳正在完成中'}), 409
+    try:
+        position = offset
+        while position < offset + length:
+            data = request.stream.read(min(STREAM_CHUNK_SIZE, offset + length - position))
+            if not data:
+                break
+            os.pwrite(fd, data, position)
+            position += len(data)
+        if position != offset + length:
+            return jsonify({'error': '區塊資料不完整'}), 400
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    
+    # 資料落盤後才記錄區段，進度只反映伺服器端已確實寫入的位元組
+    with open(os.path.join(meta['dir'], 'ranges.log'), 'a', encoding='utf-8') as f:
+        f.write(f'{offset} {offset + length}\n')
+    
+    return jsonify(upload_session_status(meta))
+
+def move_upload_into_place(src, target_path):
+    """將上傳暫存檔移到目的地；暫存區與使用者資料在不同磁碟區時，先複製到目的資料夾的暫存檔再原子替換"""
+    try:
+        os.replace(src, target_path)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    tmp_path = os.path.join(os.path.dirname(target_path),
+                            f'.{os.path.basename(target_path)}.{uuid.uuid4().hex}.part')
+    try:
+        copy_file_with_progress(src, tmp_path)
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        remove_path(tmp_path)
+        raise
+    os.remove(src)
+
+@app.route('/api/upload_session/<upload_id>/complete', methods=['POST'])
+def api_upload_session_complete(upload_id):
+    """完成分段上傳，將暫存檔移到目的地"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    meta = load_upload_session(upload_id)
+    if not meta:
+        return jsonify({'error': '上傳工作不存在'}), 404
+    
+    status = upload_session_status(meta)
+    if status['received_bytes'] != meta['size']:
+        return jsonify({'error': '檔案尚未上傳完成', **status}), 409
+    
+    upload_path = resolve_user_path(meta['path'])
+    if not upload_path:
+        return jsonify({'error': '無效的路徑'}), 400
+    os.makedirs(upload_path, exist_ok=True)
+    file_path = os.path.join(upload_path, meta['filename'])
+    
+    # 先把暫存檔改名來認領，同時送出的另一個完成請求會找不到 data.part
+    data_path = os.path.join(meta['dir'], 'data.part')
+    claimed_path = os.path.join(meta['dir'], 'completing.part')
+    try:
+        os.rename(data_path, claimed_path)
+    except FileNotFoundError:
+        return jsonify({'error': '上傳正在完成中'}), 409
+    try:
+        old_size = os.path.getsize(file_path) if os.path.isfile(file_path) else 0
+        move_upload_into_place(claimed_path, file_path)
+    except BaseException:
+        if os.path.exists(claimed_path):
+            os.rename(claimed_path, data_path)  # 交還暫存檔，可再次完成
+        raise
+    shutil.rmtree(meta['dir'], ignore_errors=True)
+    
+    record_file_written(os.path.join(meta['path'], meta['filename']), old_size)
+    
+    return jsonify({'message': 'File uploaded successfully', 'filename': meta['filename']})
+
+@app.route('/api/upload_session/<upload_id>', methods=['DELETE'])
+def api_upload_session_cancel(upload_id):
+    """取消分段上傳並刪除暫存"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    meta = load_upload_session(upload_id)
+    if not meta:
+        return jsonify({'error': '上傳工作不存在'}), 404
+    shutil.rmtree(meta['dir'], ignore_errors=True)
+    return jsonify({'message': 'Upload cancelled'})
+
 def sanitize_folder_name(name):
     """自定義資料夾名稱驗證函數"""
     # 移除開頭和結尾的空格
@@ -392,6 +4459,7 @@ def api_create_folder():
         
         # 設置權限
         os.chmod(full_path, 0o755)
+        record_folder_created(os.path.join(path, sanitized_name))
         
         return jsonify({
             'message': 'Folder created successfully',
@@ -404,23 +4472,33 @@ def api_create_folder():
 
 @app.route('/api/delete', methods=['POST'])
 def api_delete():
-    """刪除文件/文件夾API"""
+    """刪除文件/文件夾API：預設移至資源回收筒，permanent=true 時直接永久刪除"""
     if 'username' not in session:
         return jsonify({'error': 'Unauthorized'}), 401
     
     data = request.get_json()
-    item_path = data.get('path', '')
+    item_path = normalize_rel_path(data.get('path', ''))
     
     if not item_path:
         return jsonify({'error': 'Path required'}), 400
     
-    full_path = os.path.join(UPLOAD_FOLDER, 'user', item_path)
+    full_path = resolve_user_path(item_path)
+    if not full_path or not os.path.lexists(full_path):
+        return jsonify({'error': '檔案或資料夾不存在'}), 404
     
     try:
+        if not data.get('permanent'):
+            trash_id = trash_bin.move_to_trash(item_path, session['username'])
+            return jsonify({'message': 'Item moved to trash', 'trash_id': trash_id})
+        
         if os.path.isfile(full_path):
+            size = os.path.getsize(full_path)
             os.remove(full_path)
+            record_removed(item_path, False, size)
         elif os.path.isdir(full_path):
-            shutil.rmtree(full_path)
+            # 資料夾交給背景工作刪除，避免大型目錄阻塞請求
+            job_id = start_delete_job(item_path, session['username'])
+            return jsonify({'message': 'Deletion started', 'job_id': job_id}), 202
         
         return jsonify({'message': 'Item deleted successfully'})
     except Exception as e:
@@ -432,13 +4510,95 @@ def api_download(filename):
     if 'username' not in session:
         return redirect(url_for('login'))
     
-    file_path = os.path.join(UPLOAD_FOLDER, 'user', filename)
+    file_path = resolve_user_path(filename)
     
-    if os.path.exists(file_path) and os.path.isfile(file_path):
-        return send_file(file_path, as_attachment=True)
+    if file_path and os.path.isfile(file_path):
+        return send_user_file(file_path, as_attachment=True)
     
     return "File not found", 404
 
+@app.route('/api/download_zip', methods=['GET', 'POST'])
+def api_download_zip():
+    """資料夾／多選下載API：即時串流產生 ZIP（path 可重複，compress=1 時使用壓縮）"""
+    if 'username' not in session:
+        return redirect(url_for('login'))
+    
+    paths = [normalize_rel_path(p) for p in request.values.getlist('path')]
+    if not paths or len(paths) > ZIP_ARCHIVE_LIMIT:
+        return jsonify({'error': '請選擇要下載的項目'}), 400
+    
+    full_paths = []
+    for path in paths:
+        full_path = resolve_user_path(path)
+        if not path or not full_path or not os.path.exists(full_path):
+            return jsonify({'error': f'找不到項目: {path}'}), 404
+        full_paths.append(full_path)
+    
+    if len(full_paths) == 1:
+        archive_name = os.path.basename(full_paths[0]) + '.zip'
+    else:
+        parent = paths[0].rpartition('/')[0].rpartition('/')[2]
+        archive_name = (parent or 'download') + '.zip'
+    compression = zipfile.ZIP_DEFLATED if request.values.get('compress') == '1' else zipfile.ZIP_STORED
+    
+    return Response(generate_zip_stream(full_paths, compression), mimetype='application/zip',
+                    headers={'Content-Disposition': content_disposition(archive_name, as_attachment=True)},
+                    direct_passthrough=True)
+
+@app.route('/api/thumbnail/<path:filename>')
+def api_thumbnail(filename):
+    """縮圖API（size=small|large），尚未產生時回傳 202 並於背景產生"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    if not thumbnail_cache.available:
+        return jsonify({'error': '縮圖功能未啟用（需要安裝 Pillow）'}), 501
+    
+    variant = request.args.get('size', 'small')
+    if variant not in THUMBNAIL_SIZES:
+        return jsonify({'error': '無效的縮圖大小'}), 400
+    
+    file_path = resolve_user_path(filename)
+    if not file_path or not os.path.isfile(file_path):
+        return jsonify({'error': 'File not found'}), 404
+    if os.path.splitext(file_path)[1].lower() not in THUMBNAIL_EXTENSIONS:
+        return jsonify({'error': '此檔案類型不支援縮圖'}), 415
+    
+    status, thumb_path = thumbnail_cache.lookup(filename, variant)
+    if status == 'ready':
+        # 縮圖檔名即包含原檔的修改時間與大小，可直接作為 ETag
+        st = os.stat(file_path)
+        etag = os.path.splitext(os.path.basename(thumb_path))[0]
+        versioned = request.args.get('v') == format_mtime(st.st_mtime)
+        headers = {
+            'ETag': f'"{etag}"',
+            'Cache-Control': CACHE_POLICIES['thumbnail_versioned' if versioned else 'thumbnail']
+        }
+        if request.if_none_match.contains_weak(etag):
+            return Response(status=304, headers=headers)
+        response = send_file(thumb_path, mimetype='image/jpeg', etag=False, conditional=False)
+        response.headers.update(headers)
+        return response
+    if status == 'failed':
+        return jsonify({'error': '無法產生縮圖'}), 415
+    
+    response = jsonify({'status': 'pending'})
+    response.status_code = 202
+    response.headers['Retry-After'] = '1'
+    return response
+
+@app.route('/api/stream/<path:filename>')
+def api_stream(filename):
+    """媒體串流API（支援 HTTP Range，影音預覽可直接播放與拖曳）"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    file_path = resolve_user_path(filename)
+    if not file_path or not os.path.isfile(file_path):
+        return "File not found", 404
+    
+    return send_user_file(file_path)
+
 @app.route('/api/rename', methods=['POST'])
 def api_rename():
     """重新命名檔案/資料夾API"""
@@ -467,11 +4627,178 @@ def api_rename():
             return jsonify({'error': '同名檔案已存在'}), 400
         
         os.rename(old_full_path, new_full_path)
+        record_moved(old_path, os.path.join(os.path.dirname(old_path), new_name_secure),
+                     os.path.isdir(new_full_path))
         return jsonify({'message': '重新命名成功'})
         
     except Exception as e:
         return jsonify({'error': f'重新命名失敗: {str(e)}'}), 500
 
+@app.route('/api/batch', methods=['POST'])
+def api_batch():
+    """批次操作API：operations 為 [{op: delete|move|copy|rename, path, destination?, new_name?}]，
+    少量時直接執行並回傳每一項的結果，大量時建立背景工作（202）"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    operations = data.get('operations')
+    if not isinstance(operations, list) or not operations \
+            or not all(isinstance(operation, dict) for operation in operations):
+        return jsonify({'error': '請提供操作列表'}), 400
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        return jsonify({'error': f'單次最多 {BATCH_MAX_OPERATIONS} 項操作'}), 400
+    return submit_batch(operations, bool(data.get('permanent')))
+
+def transfer_request(op):
+    """複製／搬移API共用：paths（或 path）移到 destination 資料夾"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    paths = data.get('paths') or ([data['path']] if data.get('path') else [])
+    if not isinstance(paths, list) or not paths or not all(isinstance(p, str) for p in paths):
+        return jsonify({'error': '請提供來源路徑'}), 400
+    if len(paths) > BATCH_MAX_OPERATIONS:
+        return jsonify({'error': f'單次最多 {BATCH_MAX_OPERATIONS} 項操作'}), 400
+    destination = data.get('destination', '')
+    return submit_batch([{'op': op, 'path': p, 'destination': destination} for p in paths])
+
+@app.route('/api/copy', methods=['POST'])
+def api_copy():
+    """複製API：小檔案直接複製（優先使用 reflink / copy_file_range），資料夾與大檔案交給背景工作"""
+    return transfer_request('copy')
+
+@app.route('/api/move', methods=['POST'])
+def api_move():
+    """搬移API：同一檔案系統為單一 rename，跨檔案系統時交給背景工作"""
+    return transfer_request('move')
+
+@app.route('/api/search')
+def api_search():
+    """檔名搜尋API（q=關鍵字, mode=substring|prefix, ext=副檔名, path=搜尋範圍）"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    query = request.args.get('q', '').strip()
+    mode = request.args.get('mode', 'substring')
+    ext = request.args.get('ext', '').strip()
+    if mode not in ('substring', 'prefix'):
+        return jsonify({'error': '無效的搜尋模式'}), 400
+    if not query and not ext:
+        return jsonify({'error': '請提供關鍵字或副檔名'}), 400
+    limit = max(1, min(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), MAX_SEARCH_PAGE_SIZE))
+    
+    rows, next_cursor = search_index.search(query, mode, ext, request.args.get('path', ''),
+                                            request.args.get('cursor'), limit)
+    results = [{
+        'name': row['name'],
+        'path': row['path'],
+        'type': 'folder' if row['is_dir'] else 'file',
+        'extension': '.' + row['ext'] if row['ext'] else '',
+        'size': row['size'],
+        'size_formatted': '' if row['is_dir'] else format_file_size(row['size']),
+        'modified': datetime.fromtimestamp(row['mtime']).strftime('%Y-%m-%d %H:%M:%S')
+    } for row in rows]
+    
+    return jsonify({'results': results, 'next_cursor': next_cursor, 'indexing': search_index.indexing})
+
+@app.route('/api/search/content')
+def api_search_content():
+    """檔案內容全文搜尋API（q=關鍵字，至少 3 個字元；path=搜尋範圍），回傳含關鍵字的片段"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    if not content_index.available:
+        return jsonify({'error': '此系統的 SQLite 不支援全文搜尋'}), 503
+    query = request.args.get('q', '').strip()
+    if len(query) < 3:
+        return jsonify({'error': '關鍵字至少需要 3 個字元'}), 400
+    limit = max(1, min(request.args.get('limit', CONTENT_SEARCH_PAGE_SIZE, type=int), MAX_CONTENT_SEARCH_PAGE_SIZE))
+    offset = max(0, request.args.get('cursor', 0, type=int))
+    
+    rows, has_more = content_index.search(query, request.args.get('path', ''), offset, limit)
+    results = [{
+        'name': row['path'].rpartition('/')[2],
+        'path': row['path'],
+        'type': 'file',
+        'size': row['size'],
+        'size_formatted': format_file_size(row['size']),
+        'modified': format_mtime(row['mtime_ns'] / 1e9),
+        # 片段先跳脫 HTML，再把關鍵字標記換成 <mark>
+        'snippet': html.escape(row['snippet']).replace('\x02', '<mark>').replace('\x03', '</mark>')
+    } for row in rows]
+    
+    return jsonify({'results': results, 'next_cursor': str(offset + limit) if has_more else None,
+                    'pending': content_index.pending_count()})
+
+@app.route('/api/duplicates', methods=['GET', 'POST'])
+def api_duplicates():
+    """重複檔案分析API：POST 建立分析工作（path=範圍, min_size=最小檔案大小），GET 取得最近一次的結果"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    if request.method == 'GET':
+        job = job_manager.latest(session['username'], 'duplicates')
+        if job is None:
+            return jsonify({'error': '尚未進行過重複檔案分析'}), 404
+        return jsonify(job)
+    
+    data = request.get_json(silent=True) or {}
+    path = normalize_rel_path(data.get('path', ''))
+    full_path = resolve_user_path(path)
+    if not full_path or not os.path.isdir(full_path):
+        return jsonify({'error': '資料夾不存在'}), 404
+    try:
+        min_size = max(1, int(data.get('min_size', 1)))
+    except (TypeError, ValueError):
+        return jsonify({'error': '無效的 min_size 參數'}), 400
+    job_id = job_manager.submit('duplicates', {'path': path, 'min_size': min_size}, session['username'])
+    return jsonify({'job_id': job_id}), 202
+
+@app.route('/api/integrity', methods=['GET'])
+def api_integrity():
+    """資料完整性檢查狀態：統計與內容不符（可能損毀）的檔案清單"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    mismatches = [{
+        'name': row['path'].rpartition('/')[2],
+        'path': row['path'],
+        'size': row['size'],
+        'size_formatted': format_file_size(row['size']),
+        'expected_sha256': row['sha256'],
+        'actual_sha256': row['actual_sha256'],  # None 表示無法讀取
+        'recorded': format_mtime(row['recorded_at']),
+        'detected': format_mtime(row['detected_at'])
+    } for row in integrity_catalog.mismatches()]
+    return jsonify({**integrity_catalog.summary(), 'mismatched_files': mismatches})
+
+@app.route('/api/integrity/verify', methods=['POST'])
+def api_integrity_verify():
+    """將檔案或資料夾排到最優先重新檢查（path 省略即全部）"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    path = normalize_rel_path(data.get('path', ''))
+    full_path = resolve_user_path(path)
+    if not full_path or not os.path.exists(full_path):
+        return jsonify({'error': '檔案或資料夾不存在'}), 404
+    count = integrity_catalog.reverify(path)
+    return jsonify({'message': f'已排入 {count} 個檔案', 'queued': count}), 202
+
+@app.route('/api/integrity/accept', methods=['POST'])
+def api_integrity_accept():
+    """確認內容不符的檔案目前內容正確，以其雜湊作為新基準"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    data = request.get_json(silent=True) or {}
+    if not integrity_catalog.accept(data.get('path', '')):
+        return jsonify({'error': '檔案不在內容不符清單中'}), 404
+    return jsonify({'message': '已更新檢查基準', 'success': True})
+
 @app.route('/api/settings', methods=['GET'])
 def api_get_settings():
     """獲取系統設定"""
@@ -490,6 +4817,7 @@ def api_save_settings():
     try:
         settings = request.get_json()
         save_settings(settings)
+        trash_bin.schedule_purge()  # 保留天數或容量上限可能已變更
         return jsonify({'message': '設定已儲存', 'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -520,23 +4848,211 @@ def api_change_password():
         if not current_password or not new_password:
             return jsonify({'error': '請提供當前密碼和新密碼'}), 400
         
-        users = load_users()
         username = session['username']
         current_hash = hashlib.md5(current_password.encode()).hexdigest()
         
-        if users[username]['password'] != current_hash:
-            return jsonify({'error': '當前密碼不正確'}), 400
+        def change(users):
+            if users[username]['password'] != current_hash:
+                return False
+            # 更新密碼
+            users[username]['password'] = hashlib.md5(new_password.encode()).hexdigest()
+            users[username]['password_changed_at'] = datetime.now().isoformat()
+            return True
         
-        # 更新密碼
-        users[username]['password'] = hashlib.md5(new_password.encode()).hexdigest()
-        users[username]['password_changed_at'] = datetime.now().isoformat()
-        save_users(users)
+        # 在鎖內讀取、比對並寫回，避免與其他程序的寫入互相覆蓋
+        if not users_store.update(change):
+            return jsonify({'error': '當前密碼不正確'}), 400
         
         return jsonify({'message': '密碼已成功變更', 'success': True})
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/jobs', methods=['GET', 'POST'])
+def api_jobs():
+    """背景工作API：GET 列出自己的工作，POST 建立工作（delete/copy/move/archive）"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    username = session['username']
+    if request.method == 'GET':
+        try:
+            limit = min(max(int(request.args.get('limit', 50)), 1), 500)
+        except ValueError:
+            return jsonify({'error': '無效的 limit 參數'}), 400
+        return jsonify({'jobs': job_manager.list(username, request.args.get('status'), limit)})
+    
+    data = request.get_json(silent=True) or {}
+    job_type = data.get('type')
+    
+    try:
+        if job_type == 'delete':
+            path = normalize_rel_path(data.get('path', ''))
+            full_path = resolve_user_path(path) if path else None
+            if not full_path or not os.path.exists(full_path):
+                return jsonify({'error': '路徑不存在'}), 404
+            if os.path.isdir(full_path):
+                job_id = start_delete_job(path, username)
+            else:
+                return jsonify({'error': '僅支援刪除資料夾，檔案請使用 /api/delete'}), 400
+        elif job_type in ('copy', 'move'):
+            src = normalize_rel_path(data.get('src', ''))
+            dst = normalize_rel_path(data.get('dst', ''))
+            src_full = resolve_user_path(src) if src else None
+            dst_full = resolve_user_path(dst)
+            if not src_full or not os.path.exists(src_full):
+                return jsonify({'error': '來源不存在'}), 404
+            if not dst_full or not os.path.isdir(dst_full):
+                return jsonify({'error': '目的資料夾不存在'}), 404
+            if dst == src or dst.startswith(src + '/'):
+                return jsonify({'error': '無法複製或搬移到自身內部'}), 400
+            job_id = job_manager.submit(job_type, {'src': src, 'dst': dst}, username)
+        elif job_type == 'archive':
+            paths = [normalize_rel_path(p) for p in data.get('paths', [])]
+            dst = normalize_rel_path(data.get('dst', ''))
+            if not paths or any(not p or not resolve_user_path(p) or not os.path.exists(resolve_user_path(p))
+                                for p in paths):
+                return jsonify({'error': '路徑不存在'}), 404
+            dst_full = resolve_user_path(dst)
+            if not dst_full or not os.path.isdir(dst_full):
+                return jsonify({'error': '目的資料夾不存在'}), 404
+            job_id = job_manager.submit('archive', {'paths': paths, 'dst': dst, 'name': data.get('name'),
+                                                    'compress': bool(data.get('compress'))}, username)
+        else:
+            return jsonify({'error': '不支援的工作類型'}), 400
+    except Exception as e:
+        return jsonify({'error': f'建立工作失敗: {str(e)}'}), 500
+    
+    return jsonify({'job_id': job_id, 'job': job_manager.get(job_id)}), 202
+
+@app.route('/api/jobs/<job_id>')
+def api_job_status(job_id):
+    """背景工作狀態與進度API"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    job = job_manager.get(job_id, session['username'])
+    if job is None:
+        return jsonify({'error': '工作不存在'}), 404
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def api_job_cancel(job_id):
+    """取消背景工作API"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    job = job_manager.get(job_id, session['username'])
+    if job is None:
+        return jsonify({'error': '工作不存在'}), 404
+    if job['status'] in JobManager.FINISHED:
+        return jsonify({'error': '工作已結束'}), 409
+    job_manager.cancel(job_id)
+    return jsonify(job_manager.get(job_id))
+
+@app.route('/api/trash')
+def api_trash():
+    """資源回收筒列表API"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    items = trash_bin.list()
+    total = sum(item['size'] for item in items)
+    return jsonify({'items': items, 'total_size': total, 'total_formatted': format_file_size(total)})
+
+@app.route('/api/trash/<item_id>/restore', methods=['POST'])
+def api_trash_restore(item_id):
+    """從資源回收筒還原API"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    try:
+        path = trash_bin.restore(item_id)
+    except Exception as e:
+        return jsonify({'error': f'還原失敗: {str(e)}'}), 500
+    if path is None:
+        return jsonify({'error': '回收筒中找不到此項目'}), 404
+    return jsonify({'message': '已還原', 'path': path})
+
+@app.route('/api/trash/<item_id>', methods=['DELETE'])
+def api_trash_purge(item_id):
+    """永久刪除回收筒中的項目API（背景執行）"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    if not trash_bin.request_purge(item_id):
+        return jsonify({'error': '回收筒中找不到此項目'}), 404
+    return jsonify({'message': '已排入永久刪除'}), 202
+
+@app.route('/api/trash/empty', methods=['POST'])
+def api_trash_empty():
+    """清空資源回收筒API（背景執行）"""
+    if 'username' not in session:
+        return jsonify({'error': 'Unauthorized'}), 401
+    
+    count = trash_bin.request_purge()
+    return jsonify({'message': '已排入永久刪除', 'count': count}), 202
+
+def collect_runtime_metrics():
+    """抓取時才讀取的指標：快取命中率、索引與工作佇列狀態"""
+    yield 'hnas_cache_requests_total', (('cache', 'listing'), ('result', 'hit')), listing_cache.hits
+    yield 'hnas_cache_requests_total', (('cache', 'listing'), ('result', 'miss')), listing_cache.misses
+    yield 'hnas_cache_requests_total', (('cache', 'thumbnail'), ('result', 'hit')), thumbnail_cache.hits
+    yield 'hnas_cache_requests_total', (('cache', 'thumbnail'), ('result', 'miss')), thumbnail_cache.misses
+    yield 'hnas_cache_requests_total', (('cache', 'compression'), ('result', 'hit')), compression_cache.hits
+    yield 'hnas_cache_requests_total', (('cache', 'compression'), ('result', 'miss')), compression_cache.misses
+    yield 'hnas_listing_cache_entries', (), len(listing_cache)
+    yield 'hnas_storage_used_bytes', (), size_index.total('')
+    yield 'hnas_trash_bytes', (), trash_bin.total_size()
+    yield 'hnas_integrity_mismatches', (), integrity_catalog.mismatch_count()
+    counts = job_manager.status_counts()
+    for status in ('queued', 'running'):
+        yield 'hnas_jobs', (('status', status),), counts.get(status, 0)
+    yield 'hnas_uptime_seconds', (), round((datetime.now() - START_TIME).total_seconds(), 1)
+
+metrics.describe('hnas_cache_requests_total', 'counter', '快取查詢次數（命中／未命中）')
+metrics.describe('hnas_listing_cache_entries', 'gauge', '目前快取的目錄數')
+metrics.describe('hnas_storage_used_bytes', 'gauge', '使用者檔案總大小')
+metrics.describe('hnas_trash_bytes', 'gauge', '資源回收筒內項目總大小')
+metrics.describe('hnas_integrity_mismatches', 'gauge', '完整性檢查發現內容不符的檔案數')
+metrics.describe('hnas_jobs', 'gauge', '背景工作數（依狀態）')
+metrics.describe('hnas_uptime_seconds', 'gauge', '服務啟動至今秒數')
+metrics.add_collector(collect_runtime_metrics)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus 監控指標（需登入，或提供 HNAS_METRICS_TOKEN）"""
+    # 不以來源位址放行：經同主機的反向代理時，所有外部請求都來自 127.0.0.1
+    authorized = 'username' in session or bool(METRICS_TOKEN) and hmac.compare_digest(
+        request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}')
+    if not authorized:
+        return jsonify({'error': 'Unauthorized'}), 401
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def start_background_services():
+    """啟動各索引與清理的背景執行緒，並重新排入上次中斷的背景工作"""
+    size_index.start()
+    search_index.start()
+    blob_store.start()
+    blob_store.schedule_gc()
+    trash_bin.start()
+    content_index.start()
+    integrity_catalog.start()
+    job_manager.recover()
+
+# 以 python app.py 執行時，程序池子程序會以 __mp_main__ 名稱重新執行本檔，此時不可啟動背景服務；
+# 開發模式的 reloader 會另外啟動一個子程序（設有 WERKZEUG_RUN_MAIN）實際處理請求，
+# 負責監看檔案的父程序也不需要背景服務
+def should_start_background_services():
+    if __name__ == '__mp_main__':
+        return False
+    if __name__ == '__main__' and app.config.get('DEBUG', False):
+        return os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
+    return True
+
+if should_start_background_services():
+    start_background_services()
+
 if __name__ == '__main__':
     # 確保必要目錄存在
     for directory in ['data/system', 'data/user', 'logs']:
@@ -549,4 +5065,5 @@ if __name__ == '__main__':
     print("🔑 預設密碼: admin123")
     print("=" * 50)
     
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    # 開發用伺服器；正式環境請使用 python server.py
+    app.run(debug=app.config.get('DEBUG', False), host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,410 @@
+# HNAS 效能測試
+#
+#   python bench.py run                         # 以 Flask test client 測試，結果存到 bench_results/
+#   python bench.py run --mode server           # 啟動本機伺服器，以真實 HTTP 連線測試
+#   python bench.py run --url http://nas:5000   # 測試已在執行的伺服器（--user/--password 登入）
+#   python bench.py run --profiles wide,large --large-size 4G
+#   python bench.py compare bench_results/baseline.json bench_results/latest.json
+#
+# compare 會比較各項目的延遲百分位數與吞吐量，變慢超過門檻（預設 15%）時列出並以結束碼 1 離開
+import argparse
+import atexit
+import http.cookiejar
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from datetime import datetime
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(REPO_DIR, 'bench_results')
+BENCH_ROOT = 'bench'  # 測試資料放在 data/user/bench 之下
+UPLOAD_SIZE = 1024 * 1024
+READ_CHUNK_SIZE = 1024 * 1024
+
+# 合成資料樹：名稱 -> 說明
+PROFILES = {
+    'small': '大量小檔案（20 個資料夾 × 100 個 4KB 檔案）',
+    'deep': '深層巢狀（深度 64，每層 10 個檔案）',
+    'wide': '單一資料夾內 20000 個檔案',
+    'large': '單一大型檔案（稀疏檔，大小由 --large-size 指定）',
+}
+DEFAULT_PROFILES = 'small,deep,wide,large'
+
+def parse_size(text):
+    """解析 512M / 2G 之類的大小"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def build_tree(user_dir, profile, large_size):
+    """建立合成資料樹，回傳測試用的路徑：{'dir': 列表路徑, 'file': 下載路徑}"""
+    root = os.path.join(user_dir, BENCH_ROOT, profile)
+    shutil.rmtree(root, ignore_errors=True)
+    os.makedirs(root)
+    payload = os.urandom(4096)
+    rel_root = f'{BENCH_ROOT}/{profile}'
+
+    if profile == 'small':
+        for d in range(20):
+            folder = os.path.join(root, f'dir{d:02d}')
+            os.makedirs(folder)
+            for i in range(100):
+                with open(os.path.join(folder, f'file{i:03d}.txt'), 'wb') as f:
+                    f.write(payload)
+        return {'dir': f'{rel_root}/dir00', 'file': f'{rel_root}/dir00/file000.txt'}
+
+    if profile == 'deep':
+        folder, rel = root, rel_root
+        for depth in range(64):
+            folder = os.path.join(folder, f'level{depth:02d}')
+            rel = f'{rel}/level{depth:02d}'
+            os.makedirs(folder)
+            for i in range(10):
+                with open(os.path.join(folder, f'file{i}.txt'), 'wb') as f:
+                    f.write(payload)
+        return {'dir': rel, 'file': f'{rel}/file0.txt'}
+
+    if profile == 'wide':
+        for i in range(20000):
+            with open(os.path.join(root, f'file{i:05d}.dat'), 'wb') as f:
+                f.write(payload[:256])
+        return {'dir': rel_root, 'file': f'{rel_root}/file00000.dat'}
+
+    if profile == 'large':
+        # 稀疏檔：建立很快且不佔實際空間，讀取時仍需完整傳輸
+        with open(os.path.join(root, 'large.bin'), 'wb') as f:
+            f.truncate(large_size)
+        return {'dir': rel_root, 'file': f'{rel_root}/large.bin'}
+
+    raise ValueError(f'未知的資料樹: {profile}')
+
+def summarize(samples, nbytes=0):
+    """延遲（毫秒）百分位數與吞吐量"""
+    ordered = sorted(samples)
+
+    def percentile(p):
+        index = min(int(round(p / 100 * (len(ordered) - 1))), len(ordered) - 1)
+        return ordered[index] * 1000
+
+    elapsed = sum(samples)
+    result = {
+        'n': len(samples),
+        'mean_ms': statistics.mean(samples) * 1000,
+        'min_ms': ordered[0] * 1000,
+        'p50_ms': percentile(50),
+        'p90_ms': percentile(90),
+        'p99_ms': percentile(99),
+        'max_ms': ordered[-1] * 1000,
+        'rps': len(samples) / elapsed if elapsed else 0,
+    }
+    if nbytes:
+        result['bytes'] = nbytes
+        result['throughput_mb_s'] = nbytes / elapsed / 1024 ** 2 if elapsed else 0
+    return {k: round(v, 3) if isinstance(v, float) else v for k, v in result.items()}
+
+class TestClientDriver:
+    """以 Flask test client 直接呼叫（不含網路與伺服器開銷）"""
+
+    name = 'client'
+
+    def __init__(self, app_module):
+        self.client = app_module.app.test_client()
+        with self.client.session_transaction() as sess:
+            sess['username'] = 'admin'
+
+    def get(self, url):
+        """回傳 (狀態碼, 回應位元組數)"""
+        response = self.client.get(url, buffered=False)
+        size = 0
+        for chunk in response.response:
+            size += len(chunk)
+        response.close()
+        return response.status_code, size
+
+    def upload(self, path, filename, data):
+        response = self.client.post('/api/upload', data={
+            'path': path,
+            'file': (io.BytesIO(data), filename),
+        }, content_type='multipart/form-data')
+        return response.status_code, len(data)
+
+    def close(self):
+        pass
+
+class HttpDriver:
+    """以真實 HTTP 連線呼叫伺服器"""
+
+    name = 'server'
+
+    def __init__(self, base_url, username, password):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        body = urllib.parse.urlencode({'username': username, 'password': password}).encode()
+        self.opener.open(f'{self.base_url}/login', body).read()
+        status, _ = self.get('/api/system_info')
+        if status != 200:
+            raise RuntimeError('登入失敗，請確認 --user/--password')
+
+    def get(self, url):
+        try:
+            with self.opener.open(self.base_url + url) as response:
+                size = 0
+                while True:
+                    chunk = response.read(READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                return response.status, size
+        except urllib.error.HTTPError as e:
+            return e.code, len(e.read())
+
+    def upload(self, path, filename, data):
+        boundary = uuid.uuid4().hex
+        body = b''.join([
+            f'--{boundary}\r\nContent-Disposition: form-data; name="path"\r\n\r\n{path}\r\n'.encode(),
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'.encode(),
+            data,
+            f'\r\n--{boundary}--\r\n'.encode(),
+        ])
+        request = urllib.request.Request(f'{self.base_url}/api/upload', data=body, method='POST', headers={
+            'Content-Type': f'multipart/form-data; boundary={boundary}'})
+        try:
+            with self.opener.open(request) as response:
+                response.read()
+                return response.status, len(data)
+        except urllib.error.HTTPError as e:
+            return e.code, len(data)
+
+    def close(self):
+        pass
+
+def timed(func, iterations, warmup=1):
+    """重複執行 func，回傳每次耗時與總傳輸量；任一次失敗即中止"""
+    for _ in range(warmup):
+        func()
+    samples, nbytes = [], 0
+    for _ in range(iterations):
+        start = time.perf_counter()
+        status, size = func()
+        samples.append(time.perf_counter() - start)
+        if status >= 400:
+            raise RuntimeError(f'HTTP {status}')
+        nbytes += size
+    return samples, nbytes
+
+def run_cases(driver, profile, paths, iterations, large_iterations):
+    """對一個資料樹執行各路由測試"""
+    quote = urllib.parse.quote
+    results = {}
+    n = large_iterations if profile == 'large' else iterations
+
+    cases = [
+        ('files', '/api/files', lambda: driver.get(f'/api/files?path={quote(paths["dir"])}'), False),
+        ('download', '/api/download', lambda: driver.get(f'/api/download/{quote(paths["file"])}'), True),
+    ]
+    if profile == 'small':
+        payload = os.urandom(UPLOAD_SIZE)
+        upload_dir = f'{BENCH_ROOT}/{profile}'
+        cases.append(('upload', '/api/upload',
+                      lambda: driver.upload(upload_dir, f'upload-{uuid.uuid4().hex}.zip', payload), True))
+        cases.append(('system_info', '/api/system_info', lambda: driver.get('/api/system_info'), False))
+
+    for case, route, func, count_bytes in cases:
+        print(f'  {driver.name}:{profile}:{case} ...', end=' ', flush=True)
+        samples, nbytes = timed(func, n)
+        summary = summarize(samples, nbytes if count_bytes else 0)
+        summary['route'] = route
+        results[f'{driver.name}:{profile}:{case}'] = summary
+        extra = f', {summary["throughput_mb_s"]:.1f} MB/s' if 'throughput_mb_s' in summary else ''
+        print(f'p50 {summary["p50_ms"]:.2f} ms, p99 {summary["p99_ms"]:.2f} ms{extra}')
+    return results
+
+def import_app(workspace):
+    """在測試工作目錄中載入 app（app 以相對路徑使用 data/）"""
+    os.chdir(workspace)
+    sys.path.insert(0, REPO_DIR)
+    import app as app_module
+    # send_file 的相對路徑以 root_path 為基準，需與工作目錄一致
+    app_module.app.root_path = workspace
+    app_module.app.template_folder = os.path.join(REPO_DIR, 'templates')
+    app_module.app.static_folder = os.path.join(REPO_DIR, 'static')
+    logging.getLogger().setLevel(logging.WARNING)
+    app_module.app.logger.setLevel(logging.WARNING)
+    return app_module
+
+def start_local_server(app_module):
+    """在背景執行緒啟動多執行緒 WSGI 伺服器，回傳 (伺服器, 網址)"""
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def cmd_run(args):
+    profiles = [p.strip() for p in args.profiles.split(',') if p.strip()]
+    for profile in profiles:
+        if profile not in PROFILES:
+            sys.exit(f'未知的資料樹: {profile}（可用: {", ".join(PROFILES)}）')
+    large_size = parse_size(args.large_size)
+    output = os.path.abspath(args.output) if args.output else None
+
+    results = {}
+    server = None
+    if args.url:
+        # 外部伺服器：資料樹需建立在該伺服器的 data/user 下
+        if not args.data_dir:
+            sys.exit('使用 --url 時需以 --data-dir 指定伺服器的 data 目錄，以便建立測試資料')
+        user_dir = os.path.join(args.data_dir, 'user')
+        workspace = None
+    else:
+        workspace = tempfile.mkdtemp(prefix='hnas-bench-')
+        user_dir = os.path.join(workspace, 'data', 'user')
+        if not args.keep:
+            # 在載入 app 前註冊，確保在 app 的結束處理（寫入索引）之後才刪除
+            atexit.register(shutil.rmtree, workspace, True)
+        os.makedirs(user_dir)
+
+    try:
+        print('建立測試資料...')
+        trees = {}
+        for profile in profiles:
+            start = time.perf_counter()
+            trees[profile] = build_tree(user_dir, profile, large_size)
+            print(f'  {profile}: {PROFILES[profile]}（{time.perf_counter() - start:.1f} 秒）')
+
+        if args.url:
+            driver = HttpDriver(args.url, args.user, args.password)
+        else:
+            app_module = import_app(workspace)
+            if args.mode == 'server':
+                server, url = start_local_server(app_module)
+                driver = HttpDriver(url, args.user, args.password)
+            else:
+                driver = TestClientDriver(app_module)
+
+        print('執行測試...')
+        for profile in profiles:
+            results.update(run_cases(driver, profile, trees[profile], args.iterations, args.large_iterations))
+        driver.close()
+    finally:
+        if server is not None:
+            server.shutdown()
+        if not workspace:
+            shutil.rmtree(os.path.join(user_dir, BENCH_ROOT), ignore_errors=True)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(),
+            'revision': git_revision(),
+            'mode': 'server' if args.url else args.mode,
+            'url': args.url,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'iterations': args.iterations,
+            'large_size': large_size,
+        },
+        'results': results,
+    }
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, 'latest.json')
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f'結果已儲存: {output}')
+
+# 比較的指標：名稱 -> 數值越大越好？
+COMPARE_METRICS = {
+    'p50_ms': False,
+    'p90_ms': False,
+    'p99_ms': False,
+    'throughput_mb_s': True,
+}
+
+def cmd_compare(args):
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+    with open(args.current, encoding='utf-8') as f:
+        current = json.load(f)['results']
+
+    regressions = []
+    print(f'{"項目":<36}{"指標":<18}{"基準":>12}{"目前":>12}{"變化":>10}')
+    for key in sorted(baseline.keys() & current.keys()):
+        for metric, higher_is_better in COMPARE_METRICS.items():
+            if metric not in baseline[key] or metric not in current[key]:
+                continue
+            old, new = baseline[key][metric], current[key][metric]
+            if not old:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            # p99 抖動大，只列出變化而不判定為退步
+            flagged = worse > args.threshold and metric != 'p99_ms'
+            flag = '  ← 退步' if flagged else ''
+            print(f'{key:<36}{metric:<18}{old:>12.2f}{new:>12.2f}{change:>+10.1%}{flag}')
+            if flagged:
+                regressions.append((key, metric, change))
+
+    for key in sorted(baseline.keys() - current.keys()):
+        print(f'{key:<36}（目前結果中沒有此項目）')
+
+    if regressions:
+        print(f'\n發現 {len(regressions)} 項退步（門檻 {args.threshold:.0%}）')
+        sys.exit(1)
+    print('\n沒有發現退步')
+
+def main():
+    parser = argparse.ArgumentParser(description='HNAS API 效能測試')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run = sub.add_parser('run', help='執行效能測試')
+    run.add_argument('--mode', choices=['client', 'server'], default='client',
+                     help='client: Flask test client；server: 啟動本機伺服器並以 HTTP 測試')
+    run.add_argument('--url', help='測試已在執行的伺服器（需搭配 --data-dir）')
+    run.add_argument('--data-dir', help='--url 伺服器的 data 目錄')
+    run.add_argument('--user', default='admin')
+    run.add_argument('--password', default='admin123')
+    run.add_argument('--profiles', default=DEFAULT_PROFILES,
+                     help='資料樹: ' + '；'.join(f'{k}={v}' for k, v in PROFILES.items()))
+    run.add_argument('--large-size', default='2G', help='large 資料樹的檔案大小（預設 2G）')
+    run.add_argument('--iterations', type=int, default=50, help='每個項目的重複次數')
+    run.add_argument('--large-iterations', type=int, default=3, help='large 資料樹的重複次數')
+    run.add_argument('--output', help='結果 JSON 路徑（預設 bench_results/latest.json）')
+    run.add_argument('--keep', action='store_true', help='保留測試工作目錄')
+    run.set_defaults(func=cmd_run)
+
+    compare = sub.add_parser('compare', help='與基準結果比較')
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=0.15, help='視為退步的變慢比例（預設 0.15）')
+    compare.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+# HNAS 程序池工作函式
+#
+# 縮圖、雜湊等 CPU 密集的工作交給程序池執行。程序池以 forkserver／spawn 建立子程序，
+# 子程序只需載入本模組：這裡不可匯入 app，也不可有任何啟動執行緒或開啟資料庫的副作用。
+import hashlib
+import os
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # 未安裝 Pillow 時停用縮圖功能
+    Image = None
+
+def render_thumbnail(src_path, dst_path, max_px):
+    """產生 JPEG 縮圖（於背景程序執行），回傳縮圖大小"""
+    with Image.open(src_path) as img:
+        img.draft('RGB', (max_px, max_px))  # JPEG 可直接以較低解析度解碼
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_px, max_px))
+        if img.mode not in ('RGB', 'L'):
+            rgba = img.convert('RGBA')
+            img = Image.new('RGB', rgba.size, (255, 255, 255))
+            img.paste(rgba, mask=rgba.split()[-1])
+        tmp_path = f'{dst_path}.{os.getpid()}.tmp'
+        img.save(tmp_path, 'JPEG', quality=82, optimize=True)
+    os.replace(tmp_path, dst_path)
+    return os.path.getsize(dst_path)
+
+def hash_file(file_path, chunk_size=256 * 1024):
+    """計算檔案 SHA-256"""
+    hasher = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+def partial_hash(file_path, size, block):
+    """檔頭與檔尾各一塊的 SHA-256；不超過兩塊的小檔案即等於完整內容的雜湊"""
+    hasher = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        hasher.update(f.read(block))
+        if size > 2 * block:
+            f.seek(size - block)
+        hasher.update(f.read(block))
+    return hasher.hexdigest()
@@ -0,0 +1,75 @@
+# HNAS 正式環境啟動程式
+#
+#   HNAS_ENV=production python server.py
+#
+# 以 gunicorn（多程序 + 每程序多執行緒）提供服務，設定取自 static/config.py 對應 HNAS_ENV 的設定類別，
+# 可用 HNAS_BIND、HNAS_WORKERS、HNAS_THREADS、HNAS_KEEPALIVE 等環境變數覆寫。
+#
+#   kill -HUP <master pid>   平順重啟：啟動新 worker 後讓舊 worker 處理完進行中的請求再結束
+#   kill -TERM <master pid>  平順關閉：最多等待 GRACEFUL_TIMEOUT 秒
+import importlib.util
+import multiprocessing
+import os
+import sys
+
+os.environ.setdefault('HNAS_ENV', 'production')
+os.chdir(os.path.dirname(os.path.abspath(__file__)))  # app 以相對路徑使用 data/
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    sys.exit('找不到 gunicorn，請先執行 pip install -r requirements.txt')
+
+def load_config_class(env):
+    """讀取 static/config.py 的設定類別（不載入 app，避免 master 程序啟動背景執行緒）"""
+    spec = importlib.util.spec_from_file_location('hnas_config', os.path.join('static', 'config.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.config.get(env, module.config['default'])
+
+def build_options(config):
+    """由設定類別產生 gunicorn 選項"""
+    workers = config.WORKERS or multiprocessing.cpu_count()
+    return {
+        'bind': config.BIND,
+        'workers': workers,
+        'worker_class': 'gthread',
+        'threads': config.THREADS,
+        'worker_connections': config.WORKER_CONNECTIONS,
+        'keepalive': config.KEEPALIVE,
+        'timeout': config.TIMEOUT,
+        'graceful_timeout': config.GRACEFUL_TIMEOUT,
+        'max_requests': config.MAX_REQUESTS,
+        'max_requests_jitter': config.MAX_REQUESTS // 10,
+        # 不預先載入：索引、監看與背景工作的執行緒需在各 worker 內啟動
+        'preload_app': False,
+        'accesslog': '-',
+        'errorlog': '-',
+        'loglevel': config.LOG_LEVEL.lower(),
+        'proc_name': 'hnas',
+    }
+
+class HNASServer(BaseApplication):
+    """以程式方式啟動 gunicorn"""
+
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from app import app
+        return app
+
+def main():
+    config = load_config_class(os.environ['HNAS_ENV'])
+    options = build_options(config)
+    print(f"🚀 HNAS（{os.environ['HNAS_ENV']}）啟動於 {options['bind']}："
+          f"{options['workers']} 個 worker × {options['threads']} 個執行緒")
+    HNASServer(options).run()
+
+if __name__ == '__main__':
+    main()
@@ -33,6 +33,21 @@ class Config:
     LOG_MAX_SIZE = 10 * 1024 * 1024  # 10MB
     LOG_BACKUP_COUNT = 5
     
+    # 正式環境伺服器設定（server.py，皆可用環境變數覆寫）
+    BIND = os.environ.get('HNAS_BIND', '0.0.0.0:5000')
+    WORKERS = int(os.environ.get('HNAS_WORKERS', 0))  # 0 = 依 CPU 核心數
+    THREADS = int(os.environ.get('HNAS_THREADS', 8))  # 每個 worker 的執行緒數（同時處理的傳輸數）
+    EVENT_STREAMS = int(os.environ.get('HNAS_EVENT_STREAMS', 0))  # 每個 worker 同時開啟的變動事件串流上限，0 = 執行緒數的一半
+    KEEPALIVE = int(os.environ.get('HNAS_KEEPALIVE', 5))  # keep-alive 連線閒置秒數
+    WORKER_CONNECTIONS = int(os.environ.get('HNAS_WORKER_CONNECTIONS', 1000))
+    TIMEOUT = int(os.environ.get('HNAS_TIMEOUT', 300))  # worker 無回應多久後重啟（大檔案傳輸需較長）
+    GRACEFUL_TIMEOUT = int(os.environ.get('HNAS_GRACEFUL_TIMEOUT', 60))  # 重啟時等待進行中請求的秒數
+    MAX_REQUESTS = int(os.environ.get('HNAS_MAX_REQUESTS', 0))  # 處理多少請求後輪替 worker，0 = 不輪替
+    
+    # 下載交由反向代理傳送：'nginx'（X-Accel-Redirect）或 'sendfile'（Apache/lighttpd 的 X-Sendfile），空字串為停用
+    DOWNLOAD_OFFLOAD = os.environ.get('HNAS_DOWNLOAD_OFFLOAD', '')
+    DOWNLOAD_OFFLOAD_PREFIX = os.environ.get('HNAS_DOWNLOAD_OFFLOAD_PREFIX', '/protected/')  # nginx internal location
+    
     # 資料庫設定（如果需要）
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///hnas.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
@@ -41,6 +56,7 @@ class DevelopmentConfig(Config):
     """開發環境配置"""
     DEBUG = True
     SECRET_KEY = 'dev-secret-key-not-for-production'
+    LOG_LEVEL = 'DEBUG'
 
 class ProductionConfig(Config):
     """生產環境配置"""
@@ -51,7 +67,7 @@ class ProductionConfig(Config):
     # 安全標頭
     SECURITY_HEADERS = {
         'X-Content-Type-Options': 'nosniff',
-        'X-Frame-Options': 'DENY',
+        'X-Frame-Options': 'SAMEORIGIN',  # 桌面介面以 iframe 載入各視窗
         'X-XSS-Protection': '1; mode=block',
         'Strict-Transport-Security': 'max-age=31536000; includeSubDomains'
     }